@@ -2,31 +2,75 @@
 from __future__ import print_function
 import numpy as np
 import argparse
-import os
-from scipy import ndimage
+import collections
+import concurrent.futures
+import glob
 import itertools
-
-
-def parse_inputs():
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+# The input grid is downsampled in slabs of (approximately) this many bytes.
+_SLAB_BYTES = 2**22
+
+# Bricked grid files start with these bytes, then the length of a JSON header
+# (a little-endian uint32), the header itself and the brick index table.  The
+# table holds the byte offset and length of every brick, in C order, as
+# little-endian uint64s; it starts on a multiple of ``_BRICK_ALIGN`` bytes.
+_BRICK_MAGIC = b"GRDBRK\x00\x01"
+_BRICK_ALIGN = 64
+
+# Default number of cells along each dimension of a brick.
+_BRICK_SIZE = 64
+
+# Describes how a grid is downsampled: the number of input cells in each output
+# cell along each dimension, the datatype the blocks are summed with, the
+# datatype of the output grid and the kernel that reduces each block.
+_Reduction = collections.namedtuple("_Reduction",
+                                    ["factors", "accumulator", "dtype",
+                                     "kernel"])
+
+
+def parse_inputs(argv=None):
     """
     Parses the command line input arguments.
 
     If there has not been an input or output grid specified a ValueError will
-    be raised.
-
-    The only accepted arguments for `precision` is "float" or "double"; any
-    other input (including no input at all) will raise a ValueError.
+    be raised.  Each input can be a file or a glob pattern (e.g.,
+    "grids/*.bin"); a pattern that matches no files will raise a ValueError.
+    The matching files are stored as `fnames_in`.  With several input files,
+    `fname_out` is the directory the output grids are written to, so inputs
+    sharing a filename (e.g., from different directories) will raise a
+    ValueError rather than overwrite each other, as will a `fname_out` that
+    is an existing file rather than a directory.
+
+    The only accepted arguments for `precision` are "int", "float" or
+    "double"; any other input (including no input at all) will raise a
+    ValueError.  The same options are accepted for `output_precision` and
+    `accumulator`.
 
     If the size of the input grid is less than the size of the output grid a
     ValueError will be raised. This is a downsampler.
 
     If the size of the output grid is not a multiple of the input grid a
-    ValueError will be raised.
+    ValueError will be raised.  When several output gridsizes are passed, each
+    must also divide the next largest.
+
+    The input grid is given by either `gridsize_in` (a cube) or `shape`, and
+    the output grid(s) by either `gridsize_out` or the per-axis `factors`.
+    These checks are made along every axis.  The resulting shapes are stored
+    as `shape_in` and `shapes_out`.
 
     Parameters
     ----------
 
-    None.
+    argv : list of Strings, optional
+        The arguments to parse.  Default : ``sys.argv[1:]``.
 
     Returns
     ----------
@@ -39,23 +83,90 @@ def parse_inputs():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-f", "--fname_in", dest="fname_in",
-                        help="Path to the input grid file. Required.")
+                        help="Path(s) to the input grid file(s). Glob "
+                             "patterns (e.g., 'grids/*.bin') are expanded. "
+                             "Required.",
+                        nargs="+")
     parser.add_argument("-o", "--fname_out", dest="fname_out",
-                        help="Path to the output grid file. Required.")
+                        help="Path to the output grid file. With several "
+                             "input files, the directory the output grids "
+                             "are written to (using the input file names). "
+                             "Required.")
     parser.add_argument("-p", "--precision", dest="precision",
-                        help="Precision for the grids. Accepted values are "
-                             "'float' and 'double'. Required.")
+                        help="Precision of the input grid. Accepted values "
+                             "are 'int', 'float' and 'double'. Required.")
+    parser.add_argument("-q", "--output_precision", dest="output_precision",
+                        help="Precision of the output grid. Accepted values "
+                             "are 'int', 'float' and 'double'. Default: the "
+                             "input precision for 'float' and 'double' grids, "
+                             "'double' for 'int' grids.")
+    parser.add_argument("-a", "--accumulator", dest="accumulator",
+                        help="Precision each block is summed with. Accepted "
+                             "values are 'int', 'float' and 'double'. "
+                             "Default: 'double'.",
+                        default="double")
     parser.add_argument("-s", "--gridsize_in", dest="gridsize_in",
                         help="Size of the grid (i.e., number of cells per "
-                             "dimension) of input grid. Required.",
+                             "dimension) of input grid. Either this or "
+                             "--shape is required.",
                         type = int)
+    parser.add_argument("--shape", dest="shape",
+                        help="Number of cells along each dimension of a "
+                             "non-cubic input grid, e.g. '--shape 256 256 "
+                             "64'.",
+                        type=int, nargs=3)
 
     parser.add_argument("-d", "--gridsize_out", dest="gridsize_out",
                         help="Size of the grid (i.e., number of cells per "
-                             "dimension) of output grid. Required.",
-                        type=int)
-
-    args = parser.parse_args()
+                             "dimension) of output grid. Several sizes can "
+                             "be passed to build a pyramid of grids, each "
+                             "downsampled from the next largest. Either "
+                             "this or --factors is required.",
+                        type=int, nargs="+")
+    parser.add_argument("--factors", dest="factors",
+                        help="Number of input cells averaged into an output "
+                             "cell along each dimension, e.g. '--factors 4 4 "
+                             "2'.",
+                        type=int, nargs=3)
+    parser.add_argument("-m", "--separate_files", dest="separate_files",
+                        help="If several output gridsizes are passed, write "
+                             "each grid to '<fname_out>_<gridsize>' rather "
+                             "than all of them to 'fname_out'.",
+                        action="store_true")
+
+    parser.add_argument("--format", dest="fmt",
+                        help="Format of the output grid(s). Accepted values "
+                             "are 'raw' and 'bricks' (compressed 64^3 bricks "
+                             "that can be read partially). Bricked input "
+                             "grids are detected automatically. Default: "
+                             "'raw'.",
+                        default="raw")
+    parser.add_argument("-k", "--kernel", dest="kernel",
+                        help="How each block of the input grid is reduced. "
+                             "Accepted values are 'mean', 'sum', 'max', "
+                             "'min', 'median' and 'weighted_mean'. Default: "
+                             "'mean'.",
+                        default="mean")
+    parser.add_argument("--weights", dest="fname_weights",
+                        help="Path to a grid, with the same gridsize and "
+                             "precision as the input grid, that weights each "
+                             "cell. Required for the 'weighted_mean' kernel.")
+
+    parser.add_argument("-w", "--workers", dest="workers",
+                        help="Number of slabs of the output grid processed in "
+                             "parallel. Default: 1.",
+                        type=int, default=1)
+    parser.add_argument("-j", "--jobs", dest="jobs",
+                        help="Number of input files processed at once, each "
+                             "using --workers workers. Default: 1.",
+                        type=int, default=1)
+    parser.add_argument("-b", "--backend", dest="backend",
+                        help="How the slabs are processed in parallel. "
+                             "Accepted values are 'thread' and 'process'. "
+                             "Default: 'thread'.",
+                        default="thread")
+
+    args = parser.parse_args(argv)
 
     # We require an input file and an output one.
     if args.fname_in is None or args.fname_out is None:
@@ -63,47 +174,147 @@ def parse_inputs():
         parser.print_help()
         raise ValueError
 
-    # Check a valid precision was entered.
-    if args.precision == "float" or args.precision == "double":
-        pass
+    args.fnames_in = []
+    for pattern in args.fname_in:
+        if glob.has_magic(pattern):
+            fnames = sorted(glob.glob(pattern))
+        else:
+            fnames = [pattern]
+
+        if not fnames:
+            print("No input grids match {0}".format(pattern))
+            raise ValueError
+
+        args.fnames_in.extend(fnames)
+
+    # Several outputs are named after their inputs, so the names must differ.
+    if len(args.fnames_in) > 1:
+        basenames = [os.path.basename(fname) for fname in args.fnames_in]
+        for basename in sorted(set(basenames)):
+            if basenames.count(basename) > 1:
+                print("Several input grids are named {0}; their outputs would "
+                      "overwrite each other.".format(basename))
+                raise ValueError
+
+        if os.path.exists(args.fname_out) and \
+                not os.path.isdir(args.fname_out):
+            print("With several input grids the output path {0} must be a "
+                  "directory, not a file.".format(args.fname_out))
+            raise ValueError
+
+    # Check valid precisions were entered.
+    precisions = [args.precision, args.accumulator]
+    if args.output_precision is not None:
+        precisions.append(args.output_precision)
+
+    for precision in precisions:
+        if precision not in ("int", "float", "double"):
+            print("The only accepted precision options are 'int', 'float' or "
+                  "'double' (don't use apostrophes).")
+            parser.print_help()
+            raise ValueError
+
+    # Check there was exactly one input and output size specified.
+    if (args.gridsize_in is None) == (args.shape is None) or \
+       (args.gridsize_out is None) == (args.factors is None):
+        print("Both an input and ouput gridsize is required.  Use one of "
+              "--gridsize_in or --shape and one of --gridsize_out or "
+              "--factors.")
+        parser.print_help()
+        raise ValueError
+
+    if args.shape is None:
+        args.shape_in = (args.gridsize_in, args.gridsize_in, args.gridsize_in)
     else:
-        print("The only accepted precision options are 'float' or 'double' "
-              "(don't use apostrophes).")
+        args.shape_in = tuple(args.shape)
+
+    if args.factors is None:
+        args.shapes_out = _pyramid_shapes(args.gridsize_out)
+    else:
+        if min(args.factors) < 1:
+            print("The downsampling factors must be positive.")
+            raise ValueError
+
+        # Check before dividing, otherwise the output size is rounded down and
+        # the grid is reduced by a different factor than was asked for.
+        for (size, factor) in zip(args.shape_in, args.factors):
+            if size % factor != 0:
+                print("The downsampling factor {0} does not divide the input "
+                      "size {1}.".format(factor, size))
+                raise ValueError
+
+        args.shapes_out = [tuple(size // factor for (size, factor) in
+                                 zip(args.shape_in, args.factors))]
+
+    # Then check the gridsizes are valid.  Each level of a pyramid is
+    # downsampled from the previous one.
+    shape_in = args.shape_in
+    for shape_out in args.shapes_out:
+        for (size_in, size_out) in zip(shape_in, shape_out):
+            if size_in < size_out:
+                print("This is a downsampler, the output grid must have a "
+                      "smaller gridsize than the input grid.")
+                raise ValueError
+
+            if size_out < 1 or size_in % size_out != 0:
+                print("The size of the output grid must be a multiple of the "
+                      "input grid.")
+                raise ValueError
+
+        shape_in = shape_out
+
+    if args.fmt not in ("raw", "bricks"):
+        print("The only accepted format options are 'raw' or 'bricks' (don't "
+              "use apostrophes).")
+        parser.print_help()
+        raise ValueError
+
+    if args.fmt == "bricks" and len(args.shapes_out) > 1:
+        args.separate_files = True
+
+    if args.kernel not in _KERNELS:
+        print("The only accepted kernel options are {0} (don't use "
+              "apostrophes).".format(", ".join(sorted(_KERNELS))))
         parser.print_help()
         raise ValueError
 
-    # Check there was two gridsizes specified.
-    if args.gridsize_in is None or args.gridsize_out is None:
-        print("Both an input and ouput gridsize is required.")
+    if args.kernel == "weighted_mean" and args.fname_weights is None:
+        print("The 'weighted_mean' kernel requires a grid of weights.")
         parser.print_help()
         raise ValueError
 
-    # Then check the gridsizes are valid.
-    if args.gridsize_in < args.gridsize_out:
-        print("This is a downsampler, the output grid must have a smaller "
-              "gridsize than the input grid.")
+    if args.workers < 1 or args.jobs < 1:
+        print("At least one worker and job is required.")
         raise ValueError
 
-    if args.gridsize_in % args.gridsize_out != 0:
-        print("The size of the output grid must be a multiple of the input "
-              "grid.")
+    if args.backend not in ("thread", "process"):
+        print("The only accepted backend options are 'thread' or 'process' "
+              "(don't use apostrophes).")
+        parser.print_help()
         raise ValueError
 
     # Print some useful startup info. #
     print("")
     print("======================================")
-    print("Input grid: {0}".format(args.fname_in))
+    print("Input grid: {0}".format(" ".join(args.fnames_in)))
     print("Output grid: {0}".format(args.fname_out))
-    print("Input gridsize: {0}".format(args.gridsize_in))
-    print("Output gridsize: {0}".format(args.gridsize_out))
+    print("Input gridsize: {0}".format(_shape_label(args.shape_in)))
+    print("Output gridsize: {0}".format(" ".join(_shape_label(shape_out) for
+                                                 shape_out in
+                                                 args.shapes_out)))
     print("Precision: {0}".format(args.precision))
+    print("Output precision: {0}".format(args.output_precision))
+    print("Accumulator: {0}".format(args.accumulator))
+    print("Kernel: {0}".format(args.kernel))
+    print("Workers: {0} ({1})".format(args.workers, args.backend))
+    print("Jobs: {0}".format(args.jobs))
     print("======================================")
     print("")
 
     return vars(args)
 
 
-def read_grid(filepath, gridsize, precision):
+def read_grid(filepath, gridsize, precision, memmap=False):
     """
     Reads in a cartesian binary grid.
 
@@ -111,10 +322,9 @@ def read_grid(filepath, gridsize, precision):
     different datatype is specified a ValueError will be raised.
 
     If the size of the input grid does not match the expect value (i.e., the
-    precision * cube(gridsize)) a RuntimeError will be raised.
+    precision * the number of cells) a RuntimeError will be raised.
 
-    Note: This function only handles 3D Cartesian grids with the same number of
-    cells in each dimension.
+    Note: This function only handles 3D Cartesian grids.
 
     Parameters
     ----------
@@ -122,14 +332,20 @@ def read_grid(filepath, gridsize, precision):
     filepath: String. Required.
         Location of the grid to be read.
 
-    gridsize: int. Required.
-        Number of cells along one dimension of the grid to be read in.
+    gridsize: int or tuple of 3 ints. Required.
+        Number of cells along one dimension of the grid to be read in.  For
+        non-cubic grids, the number of cells along each dimension.
 
     precision: String. Required.
         Dictates what the precision of the input grid is.  Only reading of
         ints, floats or doubles is currently supported.  Any other datatype
         will raise a ValueError.
 
+    memmap: Boolean. Optional.
+        If True, the grid is not read.  Instead a read-only `~numpy.memmap`
+        of the file is returned; the operating system pages the grid in as it
+        is used and can share it between processes.  Default : False.
+
     Returns
     ----------
 
@@ -137,42 +353,557 @@ def read_grid(filepath, gridsize, precision):
         The read binary grid.
     """
 
-    # Parse the input precision.
+    shape = _grid_shape(gridsize)
+    precision_dtype = _check_grid_file(filepath, shape, precision)
+
+    if memmap:
+        return np.memmap(filepath, dtype=precision_dtype, mode="r",
+                         shape=shape)
+
+    # Everything's good, open the file and reshape the 1D grid.
+    fd = open(filepath, 'rb')
+    grid = np.fromfile(fd, count = shape[0] * shape[1] * shape[2],
+                       dtype = precision_dtype)
+
+    grid.shape = shape
+    fd.close()
+
+    return grid
+
+
+def _precision_dtype(precision):
+    """
+    Converts a precision string ("int", "float" or "double") into the matching
+    numpy datatype.  Any other precision will raise a ValueError.
+    """
+
     if precision == "int":
-        byte_size = 4
-        precision_dtype = np.int32
+        return np.dtype(np.int32)
     elif precision == "float":
-        byte_size = 4
-        precision_dtype = np.float32
+        return np.dtype(np.float32)
     elif precision == "double":
-        byte_size = 8
-        precision_dtype = np.float64
-    else:
-        print("The input precision type for reading the grid was {0}" \
-              .format(precision))
-        print("Currently I only support reading of ints, floats or doubles.")
+        return np.dtype(np.float64)
+
+    print("The input precision type for reading the grid was {0}" \
+          .format(precision))
+    print("Currently I only support reading of ints, floats or doubles.")
+    raise ValueError
+
+
+def _grid_shape(gridsize):
+    """
+    Converts the number of cells along every dimension (an int) or along each
+    dimension (3 ints) into the shape of a 3D grid.  Anything else will raise
+    a ValueError.
+    """
+
+    if np.ndim(gridsize) == 0:
+        return (int(gridsize), int(gridsize), int(gridsize))
+
+    shape = tuple(int(size) for size in gridsize)
+    if len(shape) != 3:
+        print("Only 3D grids are supported.  The gridsize passed was {0}"
+              .format(gridsize))
         raise ValueError
 
+    return shape
+
+
+def _shape_label(shape):
+    """
+    Describes a grid shape as its gridsize if it is cubic, otherwise as
+    ``"NxxNyxNz"``.
+    """
+
+    if shape[0] == shape[1] == shape[2]:
+        return str(shape[0])
+
+    return "x".join(str(size) for size in shape)
+
+
+def _pyramid_shapes(gridsizes):
+    """
+    Converts the gridsizes of a pyramid into shapes, ordered from the largest
+    to smallest grid.
+    """
+
+    shapes = [_grid_shape(gridsize) for gridsize in gridsizes]
+    return sorted(shapes, key=lambda shape: (shape[0] * shape[1] * shape[2],
+                                             shape), reverse=True)
+
+
+def _check_grid_file(filepath, shape, precision):
+    """
+    Checks that a binary grid file holds a grid of `shape` with the specified
+    precision.  See `read_grid` for the errors raised.
+
+    Returns
+    ----------
+
+    precision_dtype : `~numpy.dtype`
+        The datatype of the grid cells.
+    """
+
+    precision_dtype = _precision_dtype(precision)
+    byte_size = precision_dtype.itemsize
+
     # Check the size of the input grid to ensure it's correct.
     filesize = os.stat(filepath).st_size
-    if(pow(gridsize, 3.0) * byte_size != filesize):
+    expected_size = shape[0] * shape[1] * shape[2] * byte_size
+    if(expected_size != filesize):
         print("The size of the input grid is {0} bytes whereas we expected it "
-              "to be {1} (for a grid of size {2}^3 with {3} precision)" \
-               .format(filesize, pow(gridsize, 3.0) * byte_size, gridsize,
-                       precision) )
+              "to be {1} (for a grid of shape {2} with {3} precision)" \
+               .format(filesize, expected_size, shape, precision) )
         raise RuntimeError
 
-    # Everything's good, open the file and reshape the 1D grid.
-    fd = open(filepath, 'rb')
-    grid = np.fromfile(fd, count = gridsize**3, dtype = precision_dtype)
+    return precision_dtype
 
-    grid.shape = (gridsize, gridsize, gridsize)
-    fd.close()
 
-    return grid
+class BrickedGrid(object):
+    """
+    A grid stored in a bricked grid file (see `write_bricked_grid`).
+
+    The grid is split into bricks (e.g., 64^3 cells) that are each stored,
+    optionally compressed, at an offset listed in the file's index table.
+    Indexing a `BrickedGrid` like an array (e.g., ``grid[10:20, :, 5]``) only
+    reads and decompresses the bricks overlapping the requested subvolume.
+
+    The file is opened for each read, so a `BrickedGrid` can be shared by
+    threads and sent to other processes.
+
+    Parameters
+    ----------
+
+    filepath : String
+        Location of the bricked grid file.
+
+    Errors
+    ----------
+
+    If the file is not a bricked grid file a RuntimeError will be raised.
+    """
+
+    def __init__(self, filepath):
+
+        header, offset = _read_brick_header(filepath)
+        if header is None:
+            print("{0} is not a bricked grid file.".format(filepath))
+            raise RuntimeError
+
+        self.filepath = filepath
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        self.brick_shape = tuple(header["brick_shape"])
+        self.compression = header["compression"]
+
+        self._bricks_per_dim = tuple(-(-size // brick_size) for
+                                     (size, brick_size) in
+                                     zip(self.shape, self.brick_shape))
+
+        num_bricks = int(np.prod(self._bricks_per_dim))
+        self._index = np.fromfile(filepath, dtype="<u8", count=num_bricks * 2,
+                                  offset=offset).reshape(num_bricks, 2)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def itemsize(self):
+        return self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None):
+        grid = self[...]
+        if dtype is not None:
+            grid = grid.astype(dtype, copy=False)
+        return grid
+
+    def __repr__(self):
+        return "BrickedGrid({0}, shape={1}, dtype={2}, brick_shape={3})" \
+               .format(self.filepath, self.shape, self.dtype, self.brick_shape)
+
+    def __getitem__(self, key):
+        """
+        Reads the subvolume selected by `key`, which may hold ints, slices
+        (with any step) and an Ellipsis, like basic numpy indexing.
+        """
+
+        ranges, squeeze = _normalize_key(key, self.shape)
+
+        # Read the cells spanned by each range, then pick out the ones
+        # selected when there are steps.
+        starts = [min(cells[0], cells[-1]) if len(cells) else 0 for cells in
+                  ranges]
+        stops = [max(cells[0], cells[-1]) + 1 if len(cells) else 0 for cells
+                 in ranges]
+        subvolume = self.read_subvolume(starts, stops)
+
+        if any(cells.step != 1 for cells in ranges):
+            subvolume = subvolume[np.ix_(*[np.arange(cells.start, cells.stop,
+                                                     cells.step) - start
+                                           for (cells, start) in
+                                           zip(ranges, starts)])]
+
+        return subvolume.reshape(tuple(size for (axis, size) in
+                                       enumerate(subvolume.shape)
+                                       if axis not in squeeze))
+
+    def read_subvolume(self, start, stop):
+        """
+        Reads the cells ``start[d] <= i[d] < stop[d]`` along each dimension
+        ``d``, decompressing only the bricks that overlap them.
+
+        Parameters
+        ----------
+
+        start, stop : lists of 3 ints
+            Bounds of the subvolume, within the grid.
+
+        Returns
+        ----------
+
+        subvolume : `~numpy.ndarray`
+            The cells of the subvolume.
+        """
+
+        subvolume = np.empty(tuple(max(0, last - first) for (first, last) in
+                                   zip(start, stop)), dtype=self.dtype)
+        if subvolume.size == 0:
+            return subvolume
+
+        brick_ranges = [range(first // brick_size, -(-last // brick_size))
+                        for (first, last, brick_size) in
+                        zip(start, stop, self.brick_shape)]
+
+        with open(self.filepath, "rb") as f_in:
+            for brick_coords in itertools.product(*brick_ranges):
+                brick = self._read_brick(f_in, brick_coords)
+
+                brick_first = [coord * brick_size for (coord, brick_size) in
+                               zip(brick_coords, self.brick_shape)]
+
+                # Copy the overlap of the brick and the subvolume.
+                overlap_first = [max(first, brick_start) for
+                                 (first, brick_start) in zip(start,
+                                                             brick_first)]
+                overlap_last = [min(last, brick_start + brick_size) for
+                                (last, brick_start, brick_size) in
+                                zip(stop, brick_first, brick.shape)]
+
+                source = tuple(slice(first - brick_start, last - brick_start)
+                               for (first, last, brick_start) in
+                               zip(overlap_first, overlap_last, brick_first))
+                target = tuple(slice(first - origin, last - origin)
+                               for (first, last, origin) in
+                               zip(overlap_first, overlap_last, start))
+                subvolume[target] = brick[source]
+
+        return subvolume
+
+    def _read_brick(self, f_in, brick_coords):
+        """
+        Reads and decompresses the brick at `brick_coords` in the brick grid.
+        """
+
+        brick_num = np.ravel_multi_index(brick_coords, self._bricks_per_dim)
+        offset, num_bytes = self._index[brick_num]
+
+        f_in.seek(int(offset))
+        data = f_in.read(int(num_bytes))
+        if self.compression == "zlib":
+            data = zlib.decompress(data)
+
+        brick_shape = tuple(min(brick_size, size - coord * brick_size) for
+                            (coord, brick_size, size) in
+                            zip(brick_coords, self.brick_shape, self.shape))
+
+        return np.frombuffer(data, dtype=self.dtype).reshape(brick_shape)
+
+
+def read_bricked_grid(filepath):
+    """
+    Opens a bricked grid file written by `write_bricked_grid`.  No cells are
+    read until the returned grid is indexed.
+
+    Parameters
+    ----------
+
+    filepath : String
+        Location of the grid.
+
+    Returns
+    ----------
+
+    grid : `BrickedGrid`
+        The grid.  Use ``grid[...]`` or `~numpy.asarray` to read all of it.
+    """
+
+    return BrickedGrid(filepath)
+
+
+def write_bricked_grid(filepath, grid, brick_size=_BRICK_SIZE,
+                       compression="zlib"):
+    """
+    Writes a 3D grid as a bricked grid file.
+
+    The grid is split into bricks of `brick_size` cells along each dimension
+    (the bricks along the far edges of the grid may be smaller).  Each brick is
+    compressed on its own, so any subvolume can be read back without
+    decompressing the whole grid; see `BrickedGrid`.
+
+    Parameters
+    ----------
+
+    filepath : String
+        Where the grid is written.
+
+    grid : `~numpy.ndarray`
+        The grid.  It is read a layer of bricks at a time, so this can be an
+        `~numpy.memmap` or a `BrickedGrid`.
+
+    brick_size : int or tuple of 3 ints, optional
+        Number of cells along each dimension of a brick.  Default : 64.
+
+    compression : String or None, optional
+        Either "zlib" (fast zlib compression of each brick) or None.  Default :
+        "zlib".
+
+    Returns
+    ----------
+
+    None.
+    """
+
+    with _BrickWriter(filepath, grid.shape, grid.dtype, brick_size,
+                      compression) as writer:
+        for first_plane in range(0, grid.shape[0], writer.brick_shape[0]):
+            writer.write_planes(np.asarray(
+                grid[first_plane:first_plane + writer.brick_shape[0]]))
+
+
+class _BrickWriter(object):
+    """
+    Writes a bricked grid file from planes of the grid passed in order.  Only a
+    layer of bricks is held in memory at once; each layer is written as soon as
+    it is full.  The index table is written when the writer is closed.
+    """
+
+    def __init__(self, filepath, shape, dtype, brick_size=_BRICK_SIZE,
+                 compression="zlib"):
+
+        if compression not in (None, "zlib"):
+            print("The only accepted compression options are 'zlib' or None. "
+                  "The compression passed was {0}".format(compression))
+            raise ValueError
+
+        self.shape = _grid_shape(shape)
+        self.dtype = np.dtype(dtype)
+        self.brick_shape = tuple(min(brick, size) for (brick, size) in
+                                 zip(_grid_shape(brick_size), self.shape))
+        self.compression = compression
+
+        self._bricks_per_dim = tuple(-(-size // max(1, brick_size)) for
+                                     (size, brick_size) in
+                                     zip(self.shape, self.brick_shape))
+        self._index = np.zeros((int(np.prod(self._bricks_per_dim)), 2),
+                               dtype="<u8")
+        self._layer = []
+        self._layer_planes = 0
+        self._num_bricks = 0
+
+        header = {"shape": list(self.shape), "dtype": self.dtype.str,
+                  "brick_shape": list(self.brick_shape),
+                  "compression": compression}
+        header_bytes = json.dumps(header).encode("utf-8")
+
+        self._f_out = open(filepath, "wb")
+        self._f_out.write(_BRICK_MAGIC)
+        self._f_out.write(struct.pack("<I", len(header_bytes)))
+        self._f_out.write(header_bytes)
+
+        unpadded = len(_BRICK_MAGIC) + 4 + len(header_bytes)
+        self._index_offset = -(-unpadded // _BRICK_ALIGN) * _BRICK_ALIGN
+        self._f_out.write(b"\0" * (self._index_offset - unpadded))
+
+        # Reserve space for the index table; it's filled in by `close`.
+        self._index.tofile(self._f_out)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_planes(self, planes):
+        """
+        Adds the next planes (along the first dimension) of the grid.
+        """
+
+        self._layer.append(planes)
+        self._layer_planes += planes.shape[0]
+
+        while self._layer_planes >= self.brick_shape[0]:
+            layer = np.concatenate(self._layer)
+            self._write_layer(layer[:self.brick_shape[0]])
+
+            self._layer = [layer[self.brick_shape[0]:]]
+            self._layer_planes = self._layer[0].shape[0]
 
+    def close(self):
+        """
+        Writes any remaining planes and the index table, then closes the file.
+        """
 
-def downsample_grid(input_grid, output_gridsize):
+        if self._f_out.closed:
+            return
+
+        if self._layer_planes > 0:
+            self._write_layer(np.concatenate(self._layer))
+
+        self._f_out.seek(self._index_offset)
+        self._index.tofile(self._f_out)
+        self._f_out.close()
+
+    def _write_layer(self, layer):
+        """
+        Splits a layer of planes into bricks and writes them.
+        """
+
+        layer = layer.astype(self.dtype, copy=False)
+
+        for (first_y, first_x) in itertools.product(
+                range(0, self.shape[1], self.brick_shape[1]),
+                range(0, self.shape[2], self.brick_shape[2])):
+
+            brick = layer[:, first_y:first_y + self.brick_shape[1],
+                          first_x:first_x + self.brick_shape[2]]
+            data = np.ascontiguousarray(brick).tobytes()
+            if self.compression == "zlib":
+                data = zlib.compress(data, 1)
+
+            self._index[self._num_bricks] = (self._f_out.tell(), len(data))
+            self._f_out.write(data)
+            self._num_bricks += 1
+
+
+def _read_brick_header(filepath):
+    """
+    Reads the header of a bricked grid file.
+
+    Returns
+    ----------
+
+    header : dict or None
+        The header, or None if the file isn't a bricked grid file.
+
+    offset : int or None
+        Byte offset of the brick index table.
+    """
+
+    with open(filepath, "rb") as f_in:
+        if f_in.read(len(_BRICK_MAGIC)) != _BRICK_MAGIC:
+            return None, None
+
+        header_length = struct.unpack("<I", f_in.read(4))[0]
+        header = json.loads(f_in.read(header_length).decode("utf-8"))
+
+    unpadded = len(_BRICK_MAGIC) + 4 + header_length
+    offset = -(-unpadded // _BRICK_ALIGN) * _BRICK_ALIGN
+
+    return header, offset
+
+
+def _normalize_key(key, shape):
+    """
+    Converts a basic numpy index into the `range` of cells selected along each
+    dimension of a grid with `shape`, and the dimensions indexed by an int
+    (which are removed from the result).  Anything other than ints, slices and
+    an Ellipsis will raise a ValueError.
+    """
+
+    if not isinstance(key, tuple):
+        key = (key,)
+
+    if any(item is Ellipsis for item in key):
+        position = [item is Ellipsis for item in key].index(True)
+        key = key[:position] + (slice(None),) * (len(shape) - len(key) + 1) + \
+              key[position + 1:]
+    key = key + (slice(None),) * (len(shape) - len(key))
+
+    if len(key) != len(shape):
+        print("Too many indices ({0}) for a grid of shape {1}"
+              .format(len(key), shape))
+        raise ValueError
+
+    ranges = []
+    squeeze = []
+    for (axis, (item, size)) in enumerate(zip(key, shape)):
+        if isinstance(item, slice):
+            ranges.append(range(*item.indices(size)))
+        elif isinstance(item, (int, np.integer)):
+            index = int(item)
+            if index < 0:
+                index += size
+            if not 0 <= index < size:
+                print("Index {0} is out of bounds for axis {1} with size {2}"
+                      .format(item, axis, size))
+                raise ValueError
+            ranges.append(range(index, index + 1))
+            squeeze.append(axis)
+        else:
+            print("Bricked grids can only be indexed by ints and slices.")
+            raise ValueError
+
+    return ranges, squeeze
+
+
+def _check_gridsizes(input_shape, output_gridsize):
+    """
+    Checks that a grid with shape `input_shape` can be downsampled to
+    `output_gridsize` (an int or the number of cells along each dimension).
+    See `downsample_grid` for the errors raised.
+
+    Returns
+    ----------
+
+    factors : tuple of 3 ints
+        Number of input cells along each dimension of an output cell.
+    """
+
+    output_shape = _grid_shape(output_gridsize)
+
+    if len(input_shape) != 3:
+        print("The input grid must be 3D.  The shape of the input grid is "
+              "{0}.".format(tuple(input_shape)))
+        raise RuntimeError
+
+    for (input_size, output_size) in zip(input_shape, output_shape):
+        if input_size < output_size:
+            print("This is a downsampler.  The output gridsize must be "
+                  "smaller than the input gridsize.")
+            raise RuntimeError
+
+        if output_size < 1 or not input_size % output_size == 0:
+            print("The input grid has shape {0} and the requested output grid "
+                  "has shape {1}. These must be an integer multiple of each "
+                  "other along every dimension.".format(tuple(input_shape),
+                                                        output_shape))
+            raise RuntimeError
+
+    return tuple(input_size // output_size for (input_size, output_size) in
+                 zip(input_shape, output_shape))
+
+
+def downsample_grid(input_grid, output_gridsize, workers=1, backend="thread",
+                    dtype=None, accumulator=np.float64, kernel="mean",
+                    weights=None):
     """
     Takes an input grid and downsamples it to a smaller grid size.
 
@@ -181,15 +912,63 @@ def downsample_grid(input_grid, output_gridsize):
     of 2x2x2 cubes and then take their average.  The average of each 2x2x2 cube
     would then give each new element of the 128^3 grid.
 
+    Grids don't need to be cubic.  Each dimension is downsampled by its own
+    factor, e.g., a (256, 256, 64) grid can be downsampled to (64, 64, 32) by
+    averaging 4x4x2 blocks.
+
+    Only the block sums that are needed are computed, working through the grid
+    a slab at a time.  The blocks are centred the same way as the periodic
+    convolution this function used to perform (see `_gather_planes`).
+
+    Rather than the average, each block can be reduced to its sum, maximum,
+    minimum, median or weighted average by choosing a different `kernel`.
+    Every kernel works through the grid a slab at a time.
+
+    The blocks are summed using the `accumulator` datatype, normalized, then
+    stored with the output datatype.  By default, floating point grids keep
+    their precision (e.g., a grid of floats is averaged using doubles but
+    returned as floats) while integer grids are averaged into doubles.
+
     Parameters
     ----------
 
     input_grid : `~numpy.ndarray`
-        The 3D data array we will be downsampling from.
-
-    output_gridsize : int
-        The size of the grid we're downsampling to.  Must be an integer multiple
-        of the `input_grid` shape.
+        The 3D data array we will be downsampling from.  This can be an
+        `~numpy.memmap` (see `read_grid`); it is only read a slab at a time.
+
+    output_gridsize : int or tuple of 3 ints
+        The size of the grid we're downsampling to, either the number of cells
+        along every dimension or along each dimension.  Must be an integer
+        multiple of the `input_grid` shape along every dimension.
+
+    workers : int, optional
+        Number of slabs of the output grid processed at once.  Default : 1.
+
+    backend : String, optional
+        Either "thread" or "process".  With "thread", the slabs are processed
+        by a thread pool (numpy releases the GIL while reducing).  With
+        "process", they're processed by a process pool; a memory mapped
+        `input_grid` (see `read_grid`) is mapped again by each process rather
+        than being copied to it.  The output is identical for every backend
+        and number of workers.  Default : "thread".
+
+    dtype : `~numpy.dtype`, optional
+        Datatype of the output grid.  Default : the datatype of `input_grid` if
+        it is floating point, otherwise `~numpy.float64`.
+
+    accumulator : `~numpy.dtype`, optional
+        Datatype used to sum each block.  Default : `~numpy.float64`.
+
+    kernel : String or function, optional
+        How each block is reduced.  One of "mean", "sum", "max", "min",
+        "median" or "weighted_mean".  Otherwise, a function
+        ``kernel(blocks, weights, reduction)``; see `_KERNELS`.  With the
+        "process" backend the function must be defined at the top level of a
+        module.  Default : "mean".
+
+    weights : `~numpy.ndarray`, optional
+        Grid with the same shape as `input_grid` that weights each cell.
+        Required by the "weighted_mean" kernel.  Default : None.
 
     Returns
     ----------
@@ -209,65 +988,1010 @@ def downsample_grid(input_grid, output_gridsize):
         requested dimensions of the output grid.
     """
 
-    input_gridsize = input_grid.shape[0]
+    factors = _check_gridsizes(input_grid.shape, output_gridsize)
+    reduction = _make_reduction(factors, input_grid.dtype, accumulator, dtype,
+                                kernel)
+    grids = _with_weights(input_grid, weights)
 
-    if input_gridsize < output_gridsize:
-        print("This is a downsampler.  The output gridsize must be smaller "
-              "than the input gridsize.")
-        raise RuntimeError
+    output_shape = _grid_shape(output_gridsize)
+    final_new_density = np.zeros(output_shape, dtype=reduction.dtype)
 
-    if not input_grid.shape == (input_gridsize,
-                                input_gridsize,
-                                input_gridsize):
-        print("The dimensions of the input grid must be cubic (i.e., all "
-              "equal). The shape of the input grid is "
-              "{0}.".format(input_grid.shape))
-        raise RuntimeError
+    # Work through the output grid a slab of planes at a time so the temporary
+    # arrays stay small.  Make sure every worker gets at least one slab.
+    num_planes = output_shape[0]
+    planes_per_slab = min(_planes_per_slab(input_grid, reduction.factors),
+                          -(-num_planes // max(1, workers)))
+    slabs = [(first_plane, min(first_plane + planes_per_slab, num_planes))
+             for first_plane in range(0, num_planes, planes_per_slab)]
 
-    if not input_gridsize % output_gridsize == 0:
-        print("The input grid has gridsize {0} and the requested output grid "
-              "has gridsize {1}. These must be an integer multiple of each "
-              "other.".format(input_gridsize, output_gridsize))
-        raise RuntimeError
+    tasks = (_slab_task(grids, reduction, first_plane, last_plane, backend)
+             for (first_plane, last_plane) in slabs)
+
+    for (first_plane, last_plane), output_planes in \
+            zip(slabs, _run_tasks(tasks, workers, backend)):
+        final_new_density[first_plane:last_plane] = output_planes
 
-    conversion = int(input_gridsize / output_gridsize)
+    return final_new_density
 
-    footprint = np.ones((conversion, conversion, conversion))
 
-    # First generate a grid that contains the sliding sum of the original
-    # density.
-    new_density = ndimage.convolve(input_grid, footprint, mode='wrap')
+def downsample_file(fname_in, fname_out, gridsize_in, gridsize_out, precision,
+                    workers=1, backend="thread", output_precision=None,
+                    accumulator_precision="double", kernel="mean",
+                    fname_weights=None, weights_precision=None, fmt="raw"):
+    """
+    Downsamples a binary grid file without reading the whole grid into memory.
 
-    # Now since we want our new cells to be the discrete average (i.e., no
-    # overlaps), we will only use every ``conversion`` cells.
+    The input grid is memory mapped and read a slab of `conversion` planes at
+    a time (where `conversion` is the downsampling factor along the first
+    dimension).  Each slab is reduced to one plane of the output grid which is
+    immediately appended to `fname_out`.  Hence the memory used is
+    proportional to `gridsize_in`^2 * `conversion` rather than
+    `gridsize_in`^3.
 
-    print("Convolution done, now reading the correct cells and normalizing.")
-    final_new_density = np.zeros((output_gridsize, output_gridsize,
-                                  output_gridsize))
+    The output is identical to `downsample_grid`.
 
-    # This loop is equivalent to three nested `for` loops. Will iterate through all
-    # combinations of i, j, k.
-    for (i, j, k) in itertools.product(range(output_gridsize),
-                                       range(output_gridsize),
-                                       range(output_gridsize)):
-        final_new_density[i, j, k] = new_density[i * conversion,
-                                                 j * conversion,
-                                                 k * conversion] \
-                                                / pow(conversion,3.0)
+    The input grid can also be a bricked grid file (see `write_bricked_grid`),
+    which is downsampled a layer of bricks at a time.
 
-    return final_new_density
+    Parameters
+    ----------
 
+    fname_in, fname_out : String
+        Location of the input grid and where the output grid is written.
 
-if __name__ == '__main__':
+    gridsize_in, gridsize_out : int or tuple of 3 ints
+        Number of cells along one dimension (or each dimension) of the
+        input/output grids.
+
+    precision : String
+        Precision of the input grid.  See `read_grid`.
+
+    workers, backend : optional
+        Number of output planes computed at once and how.  See
+        `downsample_grid`.  The planes are still written in order, with at most
+        a few planes per worker held in memory.
+
+    output_precision : String, optional
+        Precision ("int", "float" or "double") the output grid is written
+        with.  Default : `precision` for float and double grids, "double" for
+        int grids.
+
+    accumulator_precision : String, optional
+        Precision used to sum each block.  Default : "double".
+
+    kernel : String or function, optional
+        How each block is reduced.  See `downsample_grid`.  Default : "mean".
+
+    fname_weights : String, optional
+        Location of a grid with the same gridsize as the input grid that
+        weights each cell.  It is memory mapped and streamed alongside the
+        input grid.  Required by the "weighted_mean" kernel.  Default : None.
 
-    args = parse_inputs()
+    weights_precision : String, optional
+        Precision of the weights grid.  Default : `precision`.
 
-    input_grid = read_grid(args["fname_in"], args["gridsize_in"],
-                           args["precision"])
+    fmt : String, optional
+        Format of the output grid, either "raw" (as read by `read_grid`) or
+        "bricks" (as read by `read_bricked_grid`).  Default : "raw".
+
+    Returns
+    ----------
+
+    None.
+
+    Errors
+    ----------
+
+    See `read_grid` and `downsample_grid`.
+    """
+
+    input_grid = _open_grid(fname_in, gridsize_in, precision)
+    weights = _read_weights(fname_weights, gridsize_in,
+                            weights_precision or precision)
+
+    output_dtype = None
+    if output_precision is not None:
+        output_dtype = _precision_dtype(output_precision)
+
+    factors = _check_gridsizes(input_grid.shape, gridsize_out)
+    reduction = _make_reduction(factors, input_grid.dtype,
+                                _precision_dtype(accumulator_precision),
+                                output_dtype, kernel)
+
+    output_shape = _grid_shape(gridsize_out)
+    with _open_output(fname_out, output_shape, reduction.dtype, fmt) as f_out:
+        _write_downsampled(_with_weights(input_grid, weights), f_out,
+                           reduction, workers, backend)
+
+    print("Subsampled grid saved to {0}".format(fname_out))
+
+
+def downsample_pyramid(input_grid, output_gridsizes, workers=1,
+                       backend="thread", dtype=None, accumulator=np.float64,
+                       kernel="mean", weights=None):
+    """
+    Downsamples a grid to several gridsizes at once (e.g., 256, 128 and 64).
+
+    Only the first (largest) level is computed from `input_grid`.  Each of the
+    other levels is computed from the level before it, so the cost of the
+    pyramid is dominated by the first level.
+
+    Note: Each level is the downsampled previous level.  For conversion factors
+    larger than 2 the blocks of a level aren't centred exactly as they would be
+    if `downsample_grid` was called on `input_grid` directly.  Likewise, the
+    "median" kernel gives the median of the medians.  For the "weighted_mean"
+    kernel, each level is weighted by the summed weights of the previous one.
+
+    Parameters
+    ----------
+
+    input_grid : `~numpy.ndarray`
+        The 3D data array we're downsampling from.
+
+    output_gridsizes : list of ints or tuples of 3 ints
+        Number of cells along one dimension (or each dimension) of each output
+        grid, in any order.  Each grid must divide the next largest one.  See
+        `power_of_two_gridsizes` for the usual halvings.
+
+    workers, backend, dtype, accumulator, kernel, weights : optional
+        See `downsample_grid`.
+
+    Returns
+    ----------
+
+    output_grids : list of `~numpy.ndarray`
+        The downsampled grids, ordered from the largest to smallest gridsize.
+
+    Errors
+    ----------
+
+    See `downsample_grid`.
+    """
+
+    output_grids = []
+    for output_shape in _pyramid_shapes(output_gridsizes):
+        output_grid = downsample_grid(input_grid, output_shape, workers,
+                                      backend, dtype, accumulator, kernel,
+                                      weights)
+
+        if weights is not None:
+            weights = downsample_grid(weights, output_shape, workers, backend,
+                                      accumulator, accumulator, "sum")
+
+        input_grid = output_grid
+        output_grids.append(output_grid)
+
+    return output_grids
+
+
+def downsample_pyramid_file(fname_in, fname_out, gridsize_in, gridsizes_out,
+                            precision, workers=1, backend="thread",
+                            output_precision=None,
+                            accumulator_precision="double", kernel="mean",
+                            fname_weights=None, weights_precision=None,
+                            fmt="raw"):
+    """
+    Downsamples a binary grid file to several gridsizes, streaming through the
+    input grid only once.
+
+    The first (largest) level is computed from the input grid as in
+    `downsample_file`.  Each of the other levels is then computed from the
+    level before it, memory mapped from where it was written.  See
+    `downsample_pyramid` for how the levels relate.
+
+    Parameters
+    ----------
+
+    fname_in : String
+        Location of the input grid.
+
+    fname_out : String or list of Strings
+        If a single String, every level is written (from the largest to
+        smallest gridsize) into one file; see `read_pyramid`.  Otherwise, the
+        location of each level, ordered from the largest to smallest gridsize.
+
+    gridsize_in : int or tuple of 3 ints
+        Number of cells along one dimension (or each dimension) of the input
+        grid.
+
+    gridsizes_out : list of ints or tuples of 3 ints
+        Number of cells along one dimension (or each dimension) of each output
+        grid, in any order.  Each grid must divide the next largest one.
+
+    precision, workers, backend, output_precision, accumulator_precision,
+    kernel, fname_weights, weights_precision, fmt :
+        See `downsample_file`.  Every level is written with the same
+        precision.  The summed weights of each level are written to a
+        temporary directory next to the (last) output file.  Bricked levels
+        must be written to separate files.
+
+    Returns
+    ----------
+
+    None.
+
+    Errors
+    ----------
+
+    If `fname_out` is a list with a different length to `gridsizes_out` a
+    ValueError will be raised.
+
+    See `read_grid` and `downsample_grid` for the other errors.
+    """
 
-    print("Input grid read, now convolving with the footprint.")
-    output_grid = downsample_grid(input_grid, args["gridsize_in"],
-                                  args["gridsize_out"])
+    shapes_out = _pyramid_shapes(gridsizes_out)
 
-    final_new_density.tofile(args["fname_out"])
-    print("Subsampled grid saved to {0}".format(args["fname_out"]))
+    single_file = isinstance(fname_out, str)
+    if single_file:
+        fnames_out = [fname_out] * len(shapes_out)
+    else:
+        fnames_out = list(fname_out)
+
+    if len(fnames_out) != len(shapes_out):
+        print("{0} output files were passed for {1} output gridsizes."
+              .format(len(fnames_out), len(shapes_out)))
+        raise ValueError
+
+    if fmt == "bricks" and single_file and len(shapes_out) > 1:
+        print("Each level of a bricked pyramid must be written to its own "
+              "file.")
+        raise ValueError
+
+    input_grid = _open_grid(fname_in, gridsize_in, precision)
+    weights = _read_weights(fname_weights, gridsize_in,
+                            weights_precision or precision)
+
+    output_dtype = None
+    if output_precision is not None:
+        output_dtype = _precision_dtype(output_precision)
+    accumulator = _precision_dtype(accumulator_precision)
+
+    scratch_dir = os.path.dirname(os.path.abspath(fnames_out[-1]))
+    with tempfile.TemporaryDirectory(dir=scratch_dir) as weights_dir:
+
+        offset = 0
+        for (level, (shape_out, fname)) in enumerate(zip(shapes_out,
+                                                         fnames_out)):
+
+            factors = _check_gridsizes(input_grid.shape, shape_out)
+            reduction = _make_reduction(factors, input_grid.dtype,
+                                        accumulator, output_dtype, kernel)
+
+            # Later levels of a single file are appended to the earlier ones.
+            if single_file and offset > 0:
+                mode = "ab"
+            else:
+                mode = "wb"
+
+            with _open_output(fname, shape_out, reduction.dtype, fmt,
+                              mode) as f_out:
+                _write_downsampled(_with_weights(input_grid, weights), f_out,
+                                   reduction, workers, backend)
+
+            # The next level is weighted by the summed weights of this one.
+            if weights is not None and level < len(shapes_out) - 1:
+                weights_reduction = _make_reduction(factors, weights.dtype,
+                                                    accumulator, accumulator,
+                                                    "sum")
+                fname_weights = os.path.join(weights_dir,
+                                             "weights_{0}".format(level))
+                with open(fname_weights, "wb") as f_weights:
+                    _write_downsampled([weights], f_weights, weights_reduction,
+                                       workers, backend)
+                weights = np.memmap(fname_weights, dtype=accumulator,
+                                    mode="r", shape=shape_out)
+
+            # The next level is computed from the one we just wrote.
+            if fmt == "bricks":
+                input_grid = BrickedGrid(fname)
+            else:
+                input_grid = np.memmap(fname, dtype=reduction.dtype, mode="r",
+                                       shape=shape_out, offset=offset)
+            if single_file:
+                offset += input_grid.size * input_grid.dtype.itemsize
+
+            print("Subsampled grid of size {0} saved to {1}"
+                  .format(_shape_label(shape_out), fname))
+
+
+def read_pyramid(filepath, gridsizes, precision, memmap=False):
+    """
+    Reads the grids written into a single file by `downsample_pyramid_file`.
+
+    If the size of the file does not match the expected value (i.e., the
+    precision * the total number of cells) a RuntimeError will be raised.
+
+    Parameters
+    ----------
+
+    filepath : String
+        Location of the file.
+
+    gridsizes : list of ints or tuples of 3 ints
+        Number of cells along one dimension (or each dimension) of each grid,
+        in any order.
+
+    precision, memmap : optional
+        See `read_grid`.
+
+    Returns
+    ----------
+
+    grids : list of `~numpy.ndarray`
+        The grids, ordered from the largest to smallest gridsize.
+    """
+
+    shapes = _pyramid_shapes(gridsizes)
+    precision_dtype = _precision_dtype(precision)
+
+    expected_size = sum(shape[0] * shape[1] * shape[2] for shape in shapes) * \
+                    precision_dtype.itemsize
+    filesize = os.stat(filepath).st_size
+    if expected_size != filesize:
+        print("The size of the pyramid file is {0} bytes whereas we expected "
+              "it to be {1} (for grids of shape {2} with {3} precision)"
+              .format(filesize, expected_size, shapes, precision))
+        raise RuntimeError
+
+    grids = []
+    offset = 0
+    for shape in shapes:
+        grid = np.memmap(filepath, dtype=precision_dtype, mode="r",
+                         shape=shape, offset=offset)
+        offset += grid.nbytes
+
+        if not memmap:
+            grid = np.array(grid)
+        grids.append(grid)
+
+    return grids
+
+
+def power_of_two_gridsizes(gridsize_in, gridsize_min=1):
+    """
+    The gridsizes found by repeatedly halving `gridsize_in`, stopping at
+    `gridsize_min` or when the gridsize is no longer even.
+
+    E.g., ``power_of_two_gridsizes(512, 64)`` is ``[256, 128, 64]``.
+    """
+
+    gridsizes = []
+    gridsize = gridsize_in
+    while gridsize % 2 == 0 and gridsize // 2 >= gridsize_min:
+        gridsize //= 2
+        gridsizes.append(gridsize)
+
+    return gridsizes
+
+
+def _write_downsampled(grids, f_out, reduction, workers, backend):
+    """
+    Downsamples the first of `grids` (weighted by the second, if passed) one
+    output plane at a time, writing each plane to `f_out` (an open file or a
+    `_BrickWriter`) as soon as it's computed.  Bricked grids are instead
+    downsampled a layer of bricks at a time.
+    """
+
+    num_planes = grids[0].shape[0] // reduction.factors[0]
+
+    planes_per_slab = 1
+    if isinstance(grids[0], BrickedGrid):
+        planes_per_slab = _planes_per_slab(grids[0], reduction.factors)
+
+    tasks = (_slab_task(grids, reduction, first_plane,
+                        min(first_plane + planes_per_slab, num_planes),
+                        backend)
+             for first_plane in range(0, num_planes, planes_per_slab))
+
+    for output_planes in _run_tasks(tasks, workers, backend):
+        if isinstance(f_out, _BrickWriter):
+            f_out.write_planes(output_planes)
+        else:
+            output_planes.tofile(f_out)
+
+
+def _with_weights(input_grid, weights):
+    """
+    The list of grids read for each slab: `input_grid` followed by `weights`,
+    if passed.  If `weights` has a different shape to `input_grid` a
+    RuntimeError will be raised.
+    """
+
+    if weights is None:
+        return [input_grid]
+
+    if not weights.shape == input_grid.shape:
+        print("The weights grid has shape {0} but the input grid has shape "
+              "{1}. They must be identical.".format(weights.shape,
+                                                    input_grid.shape))
+        raise RuntimeError
+
+    return [input_grid, weights]
+
+
+def _read_weights(fname_weights, gridsize, precision):
+    """
+    Opens the weights grid, if there is one.  See `_open_grid`.
+    """
+
+    if fname_weights is None:
+        return None
+
+    return _open_grid(fname_weights, gridsize, precision)
+
+
+def _open_grid(filepath, gridsize, precision):
+    """
+    Opens a grid file without reading it.  Bricked grid files (see
+    `write_bricked_grid`) are opened as a `BrickedGrid` and any other file is
+    memory mapped by `read_grid`.
+
+    The datatype of a bricked grid is read from the file, so `precision` is
+    ignored.  If its shape doesn't match `gridsize` a RuntimeError will be
+    raised.
+    """
+
+    header, _ = _read_brick_header(filepath)
+    if header is None:
+        return read_grid(filepath, gridsize, precision, memmap=True)
+
+    grid = BrickedGrid(filepath)
+    if grid.shape != _grid_shape(gridsize):
+        print("The bricked grid {0} has shape {1} whereas we expected it to "
+              "be {2}".format(filepath, grid.shape, _grid_shape(gridsize)))
+        raise RuntimeError
+
+    return grid
+
+
+def _open_output(fname_out, shape, dtype, fmt, mode="wb"):
+    """
+    Opens where a downsampled grid is written: a file for "raw" grids or a
+    `_BrickWriter` for "bricks".  Any other `fmt` will raise a ValueError.
+    """
+
+    if fmt == "raw":
+        return open(fname_out, mode)
+
+    if fmt == "bricks":
+        return _BrickWriter(fname_out, shape, dtype)
+
+    print("The only accepted formats are 'raw' or 'bricks'. The format "
+          "passed was {0}".format(fmt))
+    raise ValueError
+
+
+def _make_reduction(factors, input_dtype, accumulator, dtype=None,
+                    kernel="mean"):
+    """
+    Builds the `_Reduction` for a grid of datatype `input_dtype`, downsampled
+    by `factors` along each dimension.
+
+    If `dtype` is None, floating point grids keep their datatype and any other
+    grid is averaged into doubles.  If the grid values can't be summed using
+    the `accumulator` datatype (e.g., a float grid with an int accumulator) a
+    ValueError will be raised.  An unknown `kernel` will also raise a
+    ValueError.
+    """
+
+    accumulator = np.dtype(accumulator)
+    if not np.can_cast(input_dtype, accumulator, casting="same_kind"):
+        print("A grid of {0} can't be summed using {1}."
+              .format(np.dtype(input_dtype), accumulator))
+        raise ValueError
+
+    if not callable(kernel) and kernel not in _KERNELS:
+        print("The only accepted kernels are {0}. The kernel passed was {1}"
+              .format(", ".join(sorted(_KERNELS)), kernel))
+        raise ValueError
+
+    if dtype is None:
+        if np.issubdtype(input_dtype, np.floating):
+            dtype = input_dtype
+        else:
+            dtype = np.float64
+
+    return _Reduction(tuple(factors), accumulator, np.dtype(dtype), kernel)
+
+
+def _downsample_planes(grids, reduction, first_plane, last_plane):
+    """
+    Computes the output planes `first_plane` to `last_plane` of the
+    downsampled grid.
+
+    Parameters
+    ----------
+
+    grids : list of `~numpy.ndarray`
+        The 3D data array we're downsampling from, followed by its weights (if
+        any).  Only the required planes are read.
+
+    reduction : `_Reduction`
+        How the grid is downsampled.
+
+    first_plane, last_plane : int
+        Range of output planes being computed.
+
+    Returns
+    ----------
+
+    output_planes : `~numpy.ndarray`
+        The reduced blocks.
+    """
+
+    slabs = [_gather_planes(grid, reduction.factors[0], first_plane,
+                            last_plane) for grid in grids]
+
+    return _reduce_slab(slabs, reduction)
+
+
+def _reduce_slab(slabs, reduction):
+    """
+    Reduces each block of the slabs gathered by `_gather_planes` using the
+    kernel of `reduction`.
+
+    Returns
+    ----------
+
+    output_planes : `~numpy.ndarray`
+        The reduced blocks with datatype `reduction.dtype`.
+    """
+
+    blocks = [_block_view(slab, reduction.factors) for slab in slabs]
+
+    weights = None
+    if len(blocks) > 1:
+        weights = blocks[1]
+
+    kernel = reduction.kernel
+    if not callable(kernel):
+        kernel = _KERNELS[kernel]
+
+    output_planes = np.asarray(kernel(blocks[0], weights, reduction))
+
+    return output_planes.astype(reduction.dtype, copy=False)
+
+
+def _slab_task(grids, reduction, first_plane, last_plane, backend):
+    """
+    Packages the work needed for output planes `first_plane` to `last_plane`
+    so it can be run by `_downsample_task`.
+
+    Processes can't share an in-memory grid, so for the "process" backend we
+    either send the names of the memory mapped files (bricked grids are sent as
+    they are and read by the process) or the gathered slabs themselves.
+    """
+
+    if backend != "process":
+        return (grids, reduction, first_plane, last_plane)
+
+    if all(isinstance(grid, BrickedGrid) or
+           (isinstance(grid, np.memmap) and isinstance(grid.base, mmap.mmap))
+           for grid in grids):
+        memmap_specs = [grid if isinstance(grid, BrickedGrid) else
+                        (grid.filename, grid.dtype.str, grid.shape,
+                         grid.offset) for grid in grids]
+        return (memmap_specs, reduction, first_plane, last_plane)
+
+    slabs = [_gather_planes(grid, reduction.factors[0], first_plane,
+                            last_plane) for grid in grids]
+    return (slabs, reduction, None, None)
+
+
+def _downsample_task(task):
+    """
+    Computes the output planes described by a task built by `_slab_task`.
+    """
+
+    sources, reduction, first_plane, last_plane = task
+
+    # The slabs were gathered for us.
+    if first_plane is None:
+        return _reduce_slab(sources, reduction)
+
+    grids = []
+    for source in sources:
+        if isinstance(source, tuple):
+            filename, dtype, shape, offset = source
+            source = np.memmap(filename, dtype=dtype, mode="r", shape=shape,
+                               offset=offset)
+        grids.append(source)
+
+    return _downsample_planes(grids, reduction, first_plane, last_plane)
+
+
+def _run_tasks(tasks, workers, backend):
+    """
+    Runs `_downsample_task` over `tasks`, yielding the results in order.
+
+    With more than one worker the tasks are run by a thread or process pool.
+    Only a few tasks per worker are submitted ahead of the results being
+    consumed, so memory use stays bounded.
+    """
+
+    if backend not in ("thread", "process"):
+        print("The only accepted backends are 'thread' or 'process'. The "
+              "backend passed was {0}".format(backend))
+        raise ValueError
+
+    if workers <= 1:
+        for task in tasks:
+            yield _downsample_task(task)
+        return
+
+    if backend == "thread":
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    else:
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    with pool:
+        pending = collections.deque()
+
+        for task in tasks:
+            pending.append(pool.submit(_downsample_task, task))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def _planes_per_slab(input_grid, factors):
+    """
+    Number of output planes to process at once so that each slab of the input
+    grid is roughly `_SLAB_BYTES` in size.  Always at least 1.
+
+    For a `BrickedGrid`, each slab instead covers a layer of bricks so that
+    (most) bricks are only decompressed once.
+    """
+
+    if isinstance(input_grid, BrickedGrid):
+        return max(1, input_grid.brick_shape[0] // factors[0])
+
+    input_plane_bytes = int(np.prod(input_grid.shape[1:])) * \
+        input_grid.dtype.itemsize
+    slab_plane_bytes = input_plane_bytes * factors[0]
+
+    return max(1, _SLAB_BYTES // max(1, slab_plane_bytes))
+
+
+def _gather_planes(input_grid, conversion, first_plane, last_plane):
+    """
+    Reads the input planes that are averaged into the output planes
+    ``first_plane:last_plane``.
+
+    Each output cell ``i`` (along any dimension) averages input cells
+    ``i * conversion - shift`` to ``i * conversion - shift + conversion - 1``
+    where ``shift = (conversion - 1) // 2``, wrapping around the grid.  This is
+    the region covered by the centred footprint of the convolution this module
+    originally used.
+
+    Parameters
+    ----------
+
+    input_grid : `~numpy.ndarray`
+        The 3D data array we're downsampling from.  Only the required planes
+        are read, so this can be an `~numpy.memmap`.
+
+    conversion : int
+        Ratio of the input and output gridsizes along the first dimension.
+
+    first_plane, last_plane : int
+        Range of output planes being computed.
+
+    Returns
+    ----------
+
+    slab : `~numpy.ndarray`
+        The ``(last_plane - first_plane) * conversion`` input planes, in order.
+    """
+
+    num_planes = input_grid.shape[0]
+    shift = (conversion - 1) // 2
+
+    start = first_plane * conversion - shift
+    stop = last_plane * conversion - shift
+
+    # Read contiguous runs of planes, splitting where we wrap around the grid.
+    pieces = []
+    while start < stop:
+        wrapped_start = start % num_planes
+        run = min(stop - start, num_planes - wrapped_start)
+        pieces.append(input_grid[wrapped_start:wrapped_start + run])
+        start += run
+
+    if len(pieces) == 1:
+        return np.asarray(pieces[0])
+
+    return np.concatenate(pieces)
+
+
+def _block_view(slab, factors):
+    """
+    Views a slab of the input grid so each block is spread over the odd
+    numbered axes, i.e., with shape ``(n0, factors[0], n1, factors[1], n2,
+    factors[2])``.
+
+    The first dimension of `slab` has already been wrapped by
+    `_gather_planes`; the other dimensions are wrapped here.
+    """
+
+    for axis in (1, 2):
+        shift = (factors[axis] - 1) // 2
+        if shift:
+            slab = np.roll(slab, shift, axis=axis)
+
+    output_shape = tuple(size // factor for (size, factor) in
+                         zip(slab.shape, factors))
+
+    return slab.reshape(output_shape[0], factors[0], output_shape[1],
+                        factors[1], output_shape[2], factors[2])
+
+
+def _block_cells(blocks):
+    """
+    Iterates over the cells of every block of a view made by `_block_view`,
+    yielding a 3D array that holds the same cell of each block.
+    """
+
+    for (i, j, k) in itertools.product(range(blocks.shape[1]),
+                                       range(blocks.shape[3]),
+                                       range(blocks.shape[5])):
+        yield blocks[:, i, :, j, :, k]
+
+
+def _accumulate_blocks(ufunc, blocks, accumulator=np.float64):
+    """
+    Combines the cells of each block using a binary `ufunc` (e.g.,
+    `~numpy.add` or `~numpy.maximum`).
+
+    Parameters
+    ----------
+
+    ufunc : `~numpy.ufunc`
+        How two cells are combined.
+
+    blocks : `~numpy.ndarray`
+        Blocks viewed by `_block_view`.
+
+    accumulator : `~numpy.dtype`, optional
+        Datatype the cells are combined in.  Default : `~numpy.float64`.
+
+    Returns
+    ----------
+
+    block_values : `~numpy.ndarray`
+        The combined value of each block.
+
+    Notes
+    ----------
+
+    The cells of each block are combined one at a time in C order.  For sums
+    this is the same order the convolution added them in, so the sums are
+    bit-for-bit identical.
+    """
+
+    block_values = None
+    for cells in _block_cells(blocks):
+        if block_values is None:
+            block_values = cells.astype(accumulator)
+        else:
+            ufunc(block_values, cells, out=block_values)
+
+    return block_values
+
+
+def _sum_kernel(blocks, weights, reduction):
+    """
+    The sum of each block, e.g., to conserve the mass of a density grid.
+    """
+
+    return _accumulate_blocks(np.add, blocks, reduction.accumulator)
+
+
+def _mean_kernel(blocks, weights, reduction):
+    """
+    The average of each block.  This is the default kernel.
+    """
+
+    block_sums = _sum_kernel(blocks, weights, reduction)
+
+    factors = reduction.factors
+    num_cells = factors[0] * factors[1] * factors[2]
+    if np.issubdtype(block_sums.dtype, np.inexact):
+        block_sums /= num_cells
+    else:
+        block_sums = block_sums / num_cells
+
+    return block_sums
+
+
+def _max_kernel(blocks, weights, reduction):
+    """
+    The largest value in each block, e.g., for peak finding.
+    """
+
+    return _accumulate_blocks(np.maximum, blocks, reduction.accumulator)
+
+
+def _min_kernel(blocks, weights, reduction):
+    """
+    The smallest value in each block.
+    """
+
+    return _accumulate_blocks(np.minimum, blocks, reduction.accumulator)
+
+
+def _median_kernel(blocks, weights, reduction):
+    """
+    The median of each block.  Unlike the other kernels, this copies the
+    blocks of the slab so their cells are contiguous.
+    """
+
+    output_shape = blocks.shape[0::2]
+    cells = blocks.transpose(0, 2, 4, 1, 3, 5).reshape(output_shape + (-1,))
+
+    return np.median(cells, axis=-1)
+
+
+def _weighted_mean_kernel(blocks, weights, reduction):
+    """
+    The average of each block weighted by a second grid (e.g., the mass of each
+    cell).  Blocks with zero total weight are NaN.  If no weights were passed a
+    ValueError will be raised.
+    """
+
+    if weights is None:
+        print("The 'weighted_mean' kernel requires a grid of weights.")
+        raise ValueError
+
+    weighted_sums = np.zeros(blocks.shape[0::2], dtype=reduction.accumulator)
+    weight_sums = np.zeros(blocks.shape[0::2], dtype=reduction.accumulator)
+
+    for (cells, cell_weights) in zip(_block_cells(blocks),
+                                     _block_cells(weights)):
+        weighted_sums += cells * cell_weights
+        weight_sums += cell_weights
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return weighted_sums / weight_sums
+
+
+# The reduction kernels that can be selected by name.  Any other kernel is a
+# function ``kernel(blocks, weights, reduction)`` that takes the blocks of a
+# slab (see `_block_view`), the matching blocks of the weights grid (or None)
+# and the `_Reduction`, and returns the reduced value of each block.
+_KERNELS = {"mean": _mean_kernel,
+            "sum": _sum_kernel,
+            "max": _max_kernel,
+            "min": _min_kernel,
+            "median": _median_kernel,
+            "weighted_mean": _weighted_mean_kernel}
+
+
+def main(argv=None):
+    """
+    Runs the downsampler from the command line.  See `parse_inputs` for the
+    arguments.
+
+    Each input file is downsampled by `downsample_pyramid_file`, with up to
+    `jobs` files processed at once.  The time taken and the throughput (input
+    gigabytes read per second) of each file is printed.  A file that can't be
+    downsampled (e.g., it is missing or has the wrong size) is reported and
+    skipped.
+
+    Parameters
+    ----------
+
+    argv : list of Strings, optional
+        The command line arguments.  Default : ``sys.argv[1:]``.
+
+    Returns
+    ----------
+
+    exit_code : int
+        0 if every file was downsampled, 1 if any file failed and 2 if the
+        arguments were invalid.
+    """
+
+    try:
+        args = parse_inputs(argv)
+    except ValueError:
+        return 2
+    except SystemExit as err:
+        # ``argparse`` exits itself for --help and malformed arguments.
+        return err.code
+
+    fnames_in = args["fnames_in"]
+    if len(fnames_in) > 1 and not os.path.isdir(args["fname_out"]):
+        os.makedirs(args["fname_out"])
+
+    start_time = time.perf_counter()
+    jobs = args["jobs"]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(lambda fname_in: _downsample_job(fname_in,
+                                                                 args),
+                                fnames_in))
+    elapsed = time.perf_counter() - start_time
+
+    num_bytes = sum(file_bytes for file_bytes in results
+                    if file_bytes is not None)
+    num_failed = sum(file_bytes is None for file_bytes in results)
+
+    print("Downsampled {0} of {1} grids ({2:.3f} GB) in {3:.2f} seconds "
+          "({4:.3f} GB/s)".format(len(results) - num_failed, len(results),
+                                  num_bytes / 1e9, elapsed,
+                                  _throughput(num_bytes, elapsed)))
+
+    if num_failed:
+        return 1
+
+    return 0
+
+
+def _downsample_job(fname_in, args):
+    """
+    Downsamples one input file for `main`.
+
+    Returns
+    ----------
+
+    num_bytes : int or None
+        The number of input bytes read, or None if the file couldn't be
+        downsampled.
+    """
+
+    shapes_out = args["shapes_out"]
+
+    fname_out = args["fname_out"]
+    if len(args["fnames_in"]) > 1:
+        fname_out = os.path.join(fname_out, os.path.basename(fname_in))
+
+    if args["separate_files"] and len(shapes_out) > 1:
+        fname_out = ["{0}_{1}".format(fname_out, _shape_label(shape_out))
+                     for shape_out in shapes_out]
+
+    start_time = time.perf_counter()
+    try:
+        downsample_pyramid_file(fname_in, fname_out, args["shape_in"],
+                                shapes_out, args["precision"],
+                                workers=args["workers"],
+                                backend=args["backend"],
+                                output_precision=args["output_precision"],
+                                accumulator_precision=args["accumulator"],
+                                kernel=args["kernel"],
+                                fname_weights=args["fname_weights"],
+                                fmt=args["fmt"])
+    except Exception as error:
+        # Our own errors have already printed why they were raised. Anything
+        # else (e.g., a corrupt brick failing to decompress) fails this file
+        # without aborting the others.
+        if str(error):
+            print("{0}: {1}".format(type(error).__name__, error))
+        print("Failed to downsample {0}".format(fname_in))
+        return None
+    elapsed = time.perf_counter() - start_time
+
+    num_bytes = os.stat(fname_in).st_size
+    if args["fname_weights"] is not None:
+        num_bytes += os.stat(args["fname_weights"]).st_size
+
+    print("Downsampled {0} in {1:.2f} seconds ({2:.3f} GB/s)"
+          .format(fname_in, elapsed, _throughput(num_bytes, elapsed)))
+
+    return num_bytes
+
+
+def _throughput(num_bytes, elapsed):
+    """
+    Gigabytes per second, or 0 if no time has elapsed.
+    """
+
+    if elapsed <= 0:
+        return 0.0
+
+    return num_bytes / 1e9 / elapsed
+
+
+if __name__ == '__main__':
+    sys.exit(main())
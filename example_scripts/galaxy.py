@@ -19,92 +19,3037 @@ Look at ``test_galaxy.py`` for some ideas on some tasks for you to implement.
 Author: Jacob Seiler
 """
 
+import collections
+import concurrent.futures
+import contextlib
+import functools
+import itertools
+import json
+import math
+import os
+import struct
+import threading
+import weakref
+
 import numpy as np
 
+# Region reductions work through the galaxies this many at a time. This keeps the
+# temporary masks in cache and fixes the order in which masses are summed.
+_REDUCTION_BLOCK = 2**16
+
+# Binary galaxy files start with these bytes. The columns following the header start on a
+# multiple of ``_BINARY_ALIGN`` bytes and are stored as little-endian doubles.
+_BINARY_MAGIC = b"GALCAT\x00\x01"
+_BINARY_ALIGN = 64
+_BINARY_DTYPE = "<f8"
+
+# Number of galaxies formatted at once when writing text galaxy files.
+_TEXT_CHUNK = 2**16
+
+# Default number of galaxies in each chunk yielded by ``read_data_chunks``.
+_READ_CHUNK = 2**20
+
+# Number of galaxies generated at once when ``generate_random_data`` writes to file.
+_GENERATE_CHUNK = 2**16
+
+# Pair counts and profiles measure the separations of this many candidate pairs at once.
+_PAIR_BLOCK = 2**20
+
+# Number of cells each galaxy's mass is spread over along each dimension for the mass
+# assignment schemes of ``assign_mass``.
+_ASSIGNMENT_SUPPORT = {"ngp": 1, "cic": 2, "tsc": 3}
+
+# Galaxies deposited onto a grid at once by ``assign_mass``. Each galaxy touches up to
+# 3**D cells so this bounds the size of the temporary index and weight arrays.
+_ASSIGN_BLOCK = 2**16
+
+# Datatypes of the grids written by ``assign_mass``, matching ``downsampler.read_grid``.
+_GRID_PRECISIONS = {"int": np.int32, "float": np.float32, "double": np.float64}
+
+# Hands out the tokens identifying each catalog and index for ``RegionCache``.
+_TOKENS = itertools.count()
+
+# Names of the first spatial dimensions. Any further dimensions are named ``x3``, ``x4``...
+_DIM_NAMES = ("x", "y", "z")
+
 
 class Galaxy(object):
     """
     Class to hold data associate with a galaxy.
     """
 
-    def __init__(self, x, y, mass):
+    def __init__(self, x, y=None, *extra, mass=None):
         """
         Instantiates a galaxy at a given position and mass.
 
-        Parameters
-        ----------
+        Parameters
+        ----------
+
+        x, y: float
+            The spatial positions of the galaxy along the first two dimensions. ``y`` can be
+            left out for a galaxy with one spatial dimension, e.g., ``Galaxy(x, mass=mass)``.
+
+        *extra: floats
+            Positions along any further spatial dimensions, followed by the mass unless it
+            is passed by keyword, e.g., ``Galaxy(x, y, mass)``, ``Galaxy(x, y, z, mass)``
+            or ``Galaxy(x, y, z, mass=mass)``.
+
+        mass: float, optional
+            The mass of the galaxy. Units are arbitrary.
+        """
+
+        values = [x] + ([] if y is None else [y]) + list(extra)
+
+        if mass is None:
+            if len(values) < 2:
+                print("A galaxy needs at least one spatial position and a mass. The "
+                      "values passed were {0}".format(values))
+                raise ValueError
+            mass = values.pop()
+
+        self.pos = values
+        self.mass = mass
+
+    @property
+    def ndim(self):
+        return len(self.pos)
+
+    @property
+    def x(self):
+        return self._coord(0)
+
+    @x.setter
+    def x(self, value):
+        self.pos[0] = value
+
+    @property
+    def y(self):
+        return self._coord(1)
+
+    @y.setter
+    def y(self, value):
+        self.pos[1] = value
+
+    @property
+    def z(self):
+        return self._coord(2)
+
+    @z.setter
+    def z(self, value):
+        self.pos[2] = value
+
+    def _coord(self, dim):
+        if dim >= len(self.pos):
+            raise AttributeError("This galaxy only has {0} spatial dimensions"
+                                 .format(len(self.pos)))
+        return self.pos[dim]
+
+    def __repr__(self):
+        """
+        A ``Galaxy`` will be represented as "[<x>, <y>, ...] mass: <mass>". Much more useful
+        than <Galaxy object at BLAH-USELESS-MEMORY-ADDRESS>
+        """
+
+        string = "[{0}] mass: {1}".format(", ".join(str(coord) for coord in self.pos),
+                                          self.mass)
+        return string
+
+
+class _CatalogGalaxy(Galaxy):
+    """
+    Read-only ``Galaxy`` holding a row of a ``GalaxyCatalog``.
+
+    The values are copied out of the catalog, so changing them couldn't change the
+    catalog. Rather than silently losing such changes, setting any attribute raises an
+    ``AttributeError`` and the position is a tuple. Change the catalog itself inside
+    :py:meth:`~GalaxyCatalog.modify()`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(_CatalogGalaxy, self).__init__(*args, **kwargs)
+        object.__setattr__(self, "pos", tuple(self.pos))
+        object.__setattr__(self, "_frozen", True)
+
+    def __setattr__(self, name, value):
+        if getattr(self, "_frozen", False):
+            raise AttributeError("Galaxies taken from a GalaxyCatalog are read-only. Change "
+                                 "the catalog inside GalaxyCatalog.modify() instead, e.g., "
+                                 "``with gals.modify(): gals.mass[i] = mass``.")
+        object.__setattr__(self, name, value)
+
+
+class GalaxyCatalog(object):
+    """
+    Columnar container for a set of galaxies.
+
+    Rather than holding one ``Galaxy`` instance per galaxy, the positions and masses are
+    stored as contiguous ``float64`` arrays. Indexing with an integer returns a ``Galaxy``
+    holding the values of that row and iterating over the catalog yields ``Galaxy``
+    instances, so code written for a list of galaxies keeps working. These galaxies are
+    read-only copies of the rows: assigning to them (e.g., ``gals[0].mass = 5.0``) raises
+    an ``AttributeError`` rather than leaving the catalog unchanged without warning.
+
+    Catalogs can have any number of spatial dimensions; see
+    :py:meth:`~GalaxyCatalog.from_positions()`.
+
+    The columns are read-only so that cached query results (see ``RegionCache``) can't go
+    stale. Change them in place inside :py:meth:`~GalaxyCatalog.modify()`.
+    """
+
+    def __init__(self, x, y, mass, boxsize=None, mass_factor=None, seed=None):
+        """
+        Instantiates a 2D catalog from the columns of galaxy properties.
+
+        Parameters
+        ----------
+
+        x, y, mass: array-like of floats
+            The spatial positions and masses of the galaxies. Must all have the same
+            length. Units are arbitrary.
+
+        boxsize, mass_factor, seed: optional
+            The parameters used to generate the galaxies. See
+            :py:func:`~generate_random_data()`. These are carried around so they can be
+            written to the header of a galaxy file.
+        """
+
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+        mass = np.array(mass, dtype=np.float64).ravel()
+
+        if not (len(x) == len(y) == len(mass)):
+            print("The x, y and mass columns must have the same length. They had lengths "
+                  "{0}, {1} and {2}.".format(len(x), len(y), len(mass)))
+            raise ValueError
+
+        # Each spatial dimension is a contiguous row of ``_pos``.
+        pos = np.empty((2, len(x)), dtype=np.float64)
+        pos[0] = x
+        pos[1] = y
+
+        self._set_columns(pos, mass, boxsize, mass_factor, seed)
+
+    def _set_columns(self, pos, mass, boxsize, mass_factor, seed, edits=None):
+        """
+        Attaches already validated columns to the catalog without copying them. The
+        catalog holds read-only views of the columns.
+
+        ``edits`` is a one element list counting the modifications of the columns. It is
+        shared by catalogs viewing the same memory, so modifying one invalidates the
+        cached results of all of them.
+        """
+
+        self._pos = _read_only(pos)
+        self._mass = _read_only(mass)
+        self._edits = edits if edits is not None else [0]
+
+        self.boxsize = boxsize
+        self.mass_factor = mass_factor
+        self.seed = seed
+
+        # Set when the columns are memory mapped from a binary galaxy file, so worker
+        # processes can map the same file rather than being sent a copy of the columns.
+        self.filename = None
+
+        self._token = next(_TOKENS)
+
+    @property
+    def mass(self):
+        return self._mass
+
+    @mass.setter
+    def mass(self, mass):
+        mass = np.array(mass, dtype=np.float64).ravel()
+
+        if len(mass) != len(self):
+            print("The mass column must have one value for each of the {0} galaxies. It "
+                  "had length {1}.".format(len(self), len(mass)))
+            raise ValueError
+
+        self._mass = _read_only(mass)
+        self._edits[0] += 1
+
+    @property
+    def fingerprint(self):
+        """
+        Identifies the current contents of the catalog. Every catalog built or read from
+        file gets a new fingerprint, which also changes whenever its columns are modified
+        or its ``boxsize`` is changed.
+        """
+        return (self._token, self._edits[0], self.boxsize)
+
+    @contextlib.contextmanager
+    def modify(self):
+        """
+        Context manager allowing the columns to be changed in place::
+
+            with gals.modify():
+                gals.mass[:] = 1.0
+
+        On exit, the columns are made read-only again and the fingerprint of the catalog
+        (and any catalog sharing its memory) is changed.
+        """
+
+        try:
+            self._pos.flags.writeable = True
+            self._mass.flags.writeable = True
+        except ValueError:
+            self._pos.flags.writeable = False
+            print("The columns of this catalog can't be modified, e.g., because they're "
+                  "memory mapped from a read-only file.")
+            raise
+
+        try:
+            yield self
+        finally:
+            self._pos.flags.writeable = False
+            self._mass.flags.writeable = False
+            self._edits[0] += 1
+
+    @classmethod
+    def _from_columns(cls, pos, mass, boxsize=None, mass_factor=None, seed=None,
+                      edits=None):
+        """
+        Builds a catalog that shares memory with the passed ``(D, N)`` position array and
+        ``(N,)`` mass array.
+        """
+
+        cat = cls.__new__(cls)
+        cat._set_columns(pos, mass, boxsize, mass_factor, seed, edits)
+
+        return cat
+
+    @classmethod
+    def from_positions(cls, pos, mass, boxsize=None, mass_factor=None, seed=None):
+        """
+        Builds a catalog with any number of spatial dimensions.
+
+        Parameters
+        ----------
+
+        pos: array-like of floats with shape ``(N, D)``
+            The position of each galaxy in ``D`` spatial dimensions.
+
+        mass: array-like of floats with shape ``(N,)``
+            The mass of each galaxy.
+
+        boxsize, mass_factor, seed: optional
+            See :py:meth:`~GalaxyCatalog.__init__()`.
+
+        Returns
+        -------
+
+        cat: ``GalaxyCatalog``
+            Catalog holding the galaxies.
+        """
+
+        pos = np.asarray(pos, dtype=np.float64)
+        mass = np.array(mass, dtype=np.float64).ravel()
+
+        if pos.ndim != 2 or pos.shape[0] != len(mass) or pos.shape[1] < 1:
+            print("The positions must have shape (N, D) with N = {0} galaxies. The "
+                  "positions had shape {1}.".format(len(mass), pos.shape))
+            raise ValueError
+
+        # Each spatial dimension is stored as a contiguous row.
+        return cls._from_columns(np.array(pos.T, order="C"), mass, boxsize, mass_factor,
+                                 seed)
+
+    @classmethod
+    def from_galaxies(cls, gals, boxsize=None, mass_factor=None, seed=None):
+        """
+        Builds a catalog from an iterable of ``Galaxy`` instances.
+
+        Parameters
+        ----------
+
+        gals: list of ``Galaxy`` class instances.
+            Galaxies to be stored in the catalog.
+
+        boxsize, mass_factor, seed: optional
+            See :py:meth:`~GalaxyCatalog.__init__()`.
+
+        Returns
+        -------
+
+        cat: ``GalaxyCatalog``
+            Catalog holding the properties of ``gals``.
+        """
+
+        gals = list(gals)
+        N = len(gals)
+
+        ndim = gals[0].ndim if N else 2
+        if any(gal.ndim != ndim for gal in gals):
+            print("Every galaxy must have the same number of spatial dimensions.")
+            raise ValueError
+
+        pos = np.empty((ndim, N), dtype=np.float64)
+        for dim in range(ndim):
+            pos[dim] = np.fromiter((gal.pos[dim] for gal in gals), dtype=np.float64,
+                                   count=N)
+        mass = np.fromiter((gal.mass for gal in gals), dtype=np.float64, count=N)
+
+        return cls._from_columns(pos, mass, boxsize, mass_factor, seed)
+
+    @property
+    def x(self):
+        return self._pos[0]
+
+    @property
+    def y(self):
+        return self._pos[1]
+
+    @property
+    def z(self):
+        if self.ndim < 3:
+            raise AttributeError("This catalog only has {0} spatial dimensions"
+                                 .format(self.ndim))
+        return self._pos[2]
+
+    @property
+    def pos(self):
+        """
+        ``(N, D)`` view of the galaxy positions.
+        """
+        return self._pos.T
+
+    @property
+    def ndim(self):
+        return self._pos.shape[0]
+
+    def __len__(self):
+        return self._pos.shape[1]
+
+    def __getitem__(self, key):
+        """
+        An integer returns a read-only ``Galaxy`` holding that row; change the row inside
+        :py:meth:`~GalaxyCatalog.modify()` instead. Anything else (a slice, a boolean mask,
+        an array of indices) returns a new ``GalaxyCatalog`` with the selected rows.
+        """
+
+        if isinstance(key, (int, np.integer)):
+            return _CatalogGalaxy(*self._pos[:, key].tolist(), mass=self.mass[key])
+
+        pos = self._pos[:, key]
+        mass = self._mass[key]
+
+        # Slices view the same memory, so share the count of modifications.
+        shared = np.may_share_memory(pos, self._pos) or np.may_share_memory(mass,
+                                                                            self._mass)
+
+        return GalaxyCatalog._from_columns(pos, mass, self.boxsize, self.mass_factor,
+                                           self.seed, self._edits if shared else None)
+
+    def __iter__(self):
+        for values in zip(*(list(self._pos) + [self.mass])):
+            yield _CatalogGalaxy(*values[:-1], mass=values[-1])
+
+    def __repr__(self):
+        string = "GalaxyCatalog with {0} galaxies in {1}D (boxsize {2}, mass_factor {3}, " \
+                 "seed {4})".format(len(self), self.ndim, self.boxsize, self.mass_factor,
+                                    self.seed)
+        return string
+
+
+class GalaxyIndex(object):
+    """
+    Uniform grid of cells over the galaxy positions, used to answer region queries without
+    looking at every galaxy.
+
+    The galaxies are sorted by the cell they sit in and each cell keeps its total mass,
+    number of galaxies and the bounding box of its galaxies. Summed-area tables over the
+    cell totals give the mass and number of galaxies of any block of cells in a handful of
+    lookups. A region query reads the cells strictly inside the region from the tables,
+    adds the cached totals of edge cells entirely inside the region, skips edge cells
+    entirely outside it, and only checks the individual galaxies of cells straddling the
+    region's edges.
+    """
+
+    # Number of galaxies we aim to have in each cell when choosing the grid resolution.
+    gals_per_cell = 32
+
+    def __init__(self, gals, cells_per_dim=None, boxsize=None):
+        """
+        Builds the index.
+
+        Parameters
+        ----------
+
+        gals: ``GalaxyCatalog`` or list of ``Galaxy`` class instances.
+            Galaxies being indexed.
+
+        cells_per_dim: int, optional
+            Number of cells along each spatial dimension. If ``None``, chosen so there are
+            roughly ``gals_per_cell`` galaxies per cell.
+
+        boxsize: float, optional
+            Size of the box the cells cover, starting from 0. If ``None``, uses the
+            ``boxsize`` of the catalog or, failing that, the largest galaxy position.
+            Galaxies outside of the box are placed into the edge cells.
+        """
+
+        gals = _as_catalog(gals)
+        pos = gals._pos
+        ndim, N = pos.shape
+
+        finite = np.all(np.isfinite(pos), axis=0)
+
+        if boxsize is None:
+            boxsize = gals.boxsize
+        if boxsize is None:
+            boxsize = float(pos[:, finite].max()) if np.any(finite) else 1.0
+        if boxsize <= 0:
+            boxsize = 1.0
+
+        if cells_per_dim is None:
+            cells_per_dim = int(round((N / self.gals_per_cell) ** (1.0 / ndim)))
+        cells_per_dim = max(int(cells_per_dim), 1)
+
+        self.boxsize = float(boxsize)
+        self.cells_per_dim = cells_per_dim
+        self.cell_width = self.boxsize / cells_per_dim
+        self.catalog_header = {"boxsize": gals.boxsize, "mass_factor": gals.mass_factor,
+                               "seed": gals.seed}
+
+        # Galaxies without a finite position can't be binned. Keep them aside and check
+        # them on every query.
+        self._unbinned_pos = pos[:, ~finite]
+        self._unbinned_mass = gals.mass[~finite]
+
+        binned_pos = pos[:, finite]
+        binned_mass = gals.mass[finite]
+
+        cell_ids = np.ravel_multi_index(self._cell_coords(binned_pos),
+                                        (cells_per_dim,) * ndim)
+
+        # Sort the galaxies so each cell is a contiguous range.
+        order = np.argsort(cell_ids, kind="stable")
+        self._pos = binned_pos[:, order]
+        self._mass = binned_mass[order]
+        cell_ids = cell_ids[order]
+
+        num_cells = cells_per_dim ** ndim
+        cell_counts = np.bincount(cell_ids, minlength=num_cells)
+        self._cell_start = np.concatenate(([0], np.cumsum(cell_counts)))
+
+        self._build_cell_summaries()
+
+    @property
+    def ndim(self):
+        return self._pos.shape[0]
+
+    @property
+    def fingerprint(self):
+        """
+        Identifies the index. See :py:attr:`~GalaxyCatalog.fingerprint`.
+        """
+        return (self._token, 0, self.boxsize)
+
+    def _cell_coords(self, pos):
+        """
+        Returns the integer cell coordinates of each position, clipped onto the grid.
+        """
+
+        coords = np.floor(pos / self.cell_width)
+        np.clip(coords, 0, self.cells_per_dim - 1, out=coords)
+
+        return coords.astype(np.int64)
+
+    def _build_cell_summaries(self):
+        """
+        Computes the mass, number of galaxies and bounding box of each cell from the sorted
+        galaxies.
+        """
+
+        ndim = self._pos.shape[0]
+        grid_shape = (self.cells_per_dim,) * ndim
+        num_cells = self.cells_per_dim ** ndim
+
+        cell_counts = np.diff(self._cell_start)
+        occupied = cell_counts > 0
+        starts = self._cell_start[:-1][occupied]
+
+        cell_mass = np.zeros(num_cells)
+        cell_mass[occupied] = np.add.reduceat(self._mass, starts) if len(starts) else 0.0
+
+        # Empty cells get an inverted box so they're never treated as straddling an edge.
+        cell_min = np.full((ndim, num_cells), np.inf)
+        cell_max = np.full((ndim, num_cells), -np.inf)
+        for dim in range(ndim):
+            if len(starts):
+                cell_min[dim, occupied] = np.minimum.reduceat(self._pos[dim], starts)
+                cell_max[dim, occupied] = np.maximum.reduceat(self._pos[dim], starts)
+
+        self._cell_counts = cell_counts.reshape(grid_shape)
+        self._cell_mass = cell_mass.reshape(grid_shape)
+        self._cell_min = cell_min.reshape((ndim,) + grid_shape)
+        self._cell_max = cell_max.reshape((ndim,) + grid_shape)
+
+        self._count_table = _summed_area_table(self._cell_counts)
+        self._mass_table = _summed_area_table(self._cell_mass)
+
+        self._token = next(_TOKENS)
+
+    def _query(self, region_bounds, boxsize=None):
+        """
+        Sums the mass and number of galaxies inside a region.
+
+        Parameters
+        ----------
+
+        region_bounds: list of [float, float]
+            The minimum and maximum (inclusive) bound for each spatial dimension.
+
+        boxsize: float, optional
+            If specified, the region is periodic with this box size and is split into the
+            boxes it covers inside ``[0, boxsize)``. See :py:func:`~_periodic_intervals()`.
+
+        Returns
+        -------
+
+        mass_in_region: float
+            The total galaxy mass within the region.
+
+        num_gals_in_region: int
+            The number of galaxies within the region.
+        """
+
+        region_bounds = np.asarray(region_bounds, dtype=np.float64)
+
+        if boxsize is None:
+            boxes = [region_bounds]
+        else:
+            boxes = _periodic_boxes(region_bounds, boxsize)
+
+        mass_in_region = 0.0
+        num_gals_in_region = 0
+
+        for box in boxes:
+            box_mass, box_count = self._binned_query(box)
+            mass_in_region += box_mass
+            num_gals_in_region += box_count
+
+        if len(self._unbinned_mass):
+            mask = _region_mask(self._unbinned_pos, region_bounds, boxsize)
+            mass_in_region += self._unbinned_mass[mask].sum()
+            num_gals_in_region += int(np.count_nonzero(mask))
+
+        return float(mass_in_region), num_gals_in_region
+
+    def _binned_query(self, region_bounds):
+        """
+        Sums the mass and number of binned galaxies inside a region that doesn't wrap
+        around the box. See :py:meth:`~GalaxyIndex._query()`.
+        """
+
+        ndim = len(region_bounds)
+
+        # The cells containing the lower and upper bounds. As positions are binned with the
+        # same (monotonic) function, every galaxy in a cell strictly between these is
+        # inside the region along that dimension.
+        first = self._cell_coords(region_bounds[:, 0])
+        last = self._cell_coords(region_bounds[:, 1])
+
+        mass_in_region = 0.0
+        num_gals_in_region = 0
+
+        if np.all(first <= last):
+
+            # The interior cells are summed using the summed-area tables.
+            interior_first = first + 1
+            interior_stop = np.maximum(last, interior_first)
+            mass_in_region += _table_sum(self._mass_table, interior_first, interior_stop)
+            num_gals_in_region += int(_table_sum(self._count_table, interior_first,
+                                                 interior_stop))
+
+            # Then split the ring of edge cells into non-overlapping slabs. The slab at
+            # each end of dimension ``dim`` spans the interior of the earlier dimensions
+            # and the full range of the later ones.
+            straddle_ids = []
+            for dim in range(ndim):
+                for edge in sorted(set([first[dim], last[dim]])):
+
+                    block = [slice(interior_first[d], interior_stop[d]) for d in range(dim)]
+                    block.append(slice(edge, edge + 1))
+                    block += [slice(first[d], last[d] + 1) for d in range(dim + 1, ndim)]
+                    block = tuple(block)
+
+                    slab_mass, slab_count, slab_ids = self._edge_cells(block,
+                                                                       region_bounds)
+                    mass_in_region += slab_mass
+                    num_gals_in_region += slab_count
+                    straddle_ids.append(slab_ids)
+
+            # Cells straddling the region need their galaxies checked one by one.
+            cell_ids = np.concatenate(straddle_ids)
+            rows = _concatenate_ranges(self._cell_start[cell_ids],
+                                       self._cell_start[cell_ids + 1])
+
+            mask = _region_mask(self._pos[:, rows], region_bounds)
+            mass_in_region += self._mass[rows][mask].sum()
+            num_gals_in_region += int(np.count_nonzero(mask))
+
+        return mass_in_region, num_gals_in_region
+
+    def _aperture_query(self, centre, radius, boxsize=None):
+        """
+        Sums the mass and number of galaxies within ``radius`` of ``centre``.
+
+        The cells overlapping the aperture's bounding box are classified using their
+        bounding boxes: cells entirely inside the aperture add their cached totals, cells
+        entirely outside are skipped and only the galaxies of the remaining cells are
+        checked individually.
+
+        Parameters
+        ----------
+
+        centre: ``(D,)`` array of floats
+            Centre of the aperture.
+
+        radius: float
+            Radius of the aperture (inclusive).
+
+        boxsize: float, optional
+            If specified, the box is periodic with this size and each galaxy is measured
+            from its nearest periodic image. Must be equal to ``self.boxsize``.
+
+        Returns
+        -------
+
+        mass_in_aperture: float
+            The total galaxy mass within the aperture.
+
+        num_gals_in_aperture: int
+            The number of galaxies within the aperture.
+        """
+
+        ndim = len(centre)
+        radius_sq = radius**2
+
+        first = np.floor((centre - radius) / self.cell_width).astype(np.int64)
+        last = np.floor((centre + radius) / self.cell_width).astype(np.int64)
+        if boxsize is None:
+            first = np.clip(first, 0, self.cells_per_dim - 1)
+            last = np.clip(last, 0, self.cells_per_dim - 1)
+
+        # For a periodic box the cell coordinates run past the edges of the grid. Each one
+        # maps onto a cell of the grid and shifts its galaxies by a whole number of boxes.
+        dim_cells = []
+        dim_shifts = []
+        for dim in range(ndim):
+            coords = np.arange(first[dim], last[dim] + 1)
+            dim_cells.append(coords % self.cells_per_dim)
+            dim_shifts.append((coords // self.cells_per_dim) * self.boxsize)
+
+        block = np.ix_(*dim_cells)
+        cell_min = self._cell_min[(slice(None),) + block]
+        cell_max = self._cell_max[(slice(None),) + block]
+
+        # Distances are built exactly as in ``_aperture_mask``, so the cell bounds bracket
+        # the distance of every galaxy in the cell.
+        near_sq = np.zeros(cell_min.shape[1:])
+        far_sq = np.zeros(cell_min.shape[1:])
+        for dim in range(ndim):
+            shift = dim_shifts[dim].reshape([-1 if d == dim else 1 for d in range(ndim)])
+            lower = (cell_min[dim] - centre[dim]) + shift
+            upper = (cell_max[dim] - centre[dim]) + shift
+
+            near_sq += np.maximum(np.maximum(lower, -upper), 0.0)**2
+            far_sq += np.maximum(np.abs(lower), np.abs(upper))**2
+
+        inside = far_sq <= radius_sq
+        straddle = ~inside & (near_sq <= radius_sq)
+
+        mass_in_aperture = self._cell_mass[block][inside].sum()
+        num_gals_in_aperture = int(self._cell_counts[block][inside].sum())
+
+        straddle_coords = np.nonzero(straddle)
+        cell_ids = np.ravel_multi_index([dim_cells[dim][straddle_coords[dim]]
+                                         for dim in range(ndim)], self._cell_counts.shape)
+        starts = self._cell_start[cell_ids]
+        stops = self._cell_start[cell_ids + 1]
+        rows = _concatenate_ranges(starts, stops)
+
+        dist_sq = np.zeros(len(rows))
+        for dim in range(ndim):
+            row_shift = np.repeat(dim_shifts[dim][straddle_coords[dim]], stops - starts)
+            dist_sq += ((self._pos[dim, rows] - centre[dim]) + row_shift)**2
+
+        mask = dist_sq <= radius_sq
+        mass_in_aperture += self._mass[rows][mask].sum()
+        num_gals_in_aperture += int(np.count_nonzero(mask))
+
+        # Galaxies without a finite position are never within a distance of anything.
+        return float(mass_in_aperture), num_gals_in_aperture
+
+    def _edge_cells(self, block, region_bounds):
+        """
+        Classifies a block of cells on the edge of a region using their bounding boxes.
+
+        Parameters
+        ----------
+
+        block: tuple of slices
+            The cells being classified.
+
+        region_bounds: ``(D, 2)`` array of floats
+            The minimum and maximum (inclusive) bound for each spatial dimension.
+
+        Returns
+        -------
+
+        mass_inside, num_gals_inside: float, int
+            The cached totals of the cells entirely inside the region.
+
+        straddle_ids: array of ints
+            The flattened ids of the cells straddling the region's edges.
+        """
+
+        cell_min = self._cell_min[(slice(None),) + block]
+        cell_max = self._cell_max[(slice(None),) + block]
+        lower = region_bounds[:, 0].reshape((-1,) + (1,) * len(block))
+        upper = region_bounds[:, 1].reshape((-1,) + (1,) * len(block))
+
+        inside = np.all((cell_min >= lower) & (cell_max <= upper), axis=0)
+        outside = np.any((cell_max < lower) | (cell_min > upper), axis=0)
+        straddle = ~inside & ~outside
+
+        mass_inside = self._cell_mass[block][inside].sum()
+        num_gals_inside = int(self._cell_counts[block][inside].sum())
+
+        straddle_coords = tuple(coords + cells.start for (coords, cells) in
+                                zip(np.nonzero(straddle), block))
+        straddle_ids = np.ravel_multi_index(straddle_coords, self._cell_counts.shape)
+
+        return mass_inside, num_gals_inside, straddle_ids
+
+    def mass_within_region(self, *bounds, approximate=False, periodic=False):
+        """
+        Calculate the total mass and number of galaxies within a specified region. See
+        :py:func:`~mass_within_region()`.
+
+        Parameters
+        ----------
+
+        *bounds: [float, float] for each spatial dimension
+            The minimum and maximum bounds that define the region we're summing inside,
+            either one argument per dimension (``x_bound, y_bound, ...``) or a single list
+            of them.
+
+        approximate: bool, optional
+            If ``True``, the bounds are snapped to the nearest cell edges and the answer is
+            read from the summed-area tables with four lookups. Otherwise, the tables are
+            used for the cells fully inside the region and the galaxies in the cells on the
+            region's edges are checked individually.
+
+        periodic: bool, optional
+            If ``True``, the region wraps around the edges of the index's box, which is
+            assumed to hold all the galaxies. See :py:func:`~mass_within_region()`.
+
+        Returns
+        -------
+
+        mass_in_region: float
+            The total galaxy mass within the specified region.
+
+        num_gals_in_region: int
+            The number of galaxies within the specified region.
+
+        Notes
+        -----
+
+        Without ``approximate``, the number of galaxies is identical to a full scan of the
+        catalog. As cached cell totals are used, the mass agrees to floating point
+        rounding.
+        """
+
+        region_bounds = _region_bounds(bounds, self.ndim)
+        boxsize = self.boxsize if periodic else None
+
+        if not approximate:
+            return self._query(region_bounds, boxsize)
+
+        if boxsize is None:
+            return self._approximate_query(region_bounds)
+
+        results = [self._approximate_query(box)
+                   for box in _periodic_boxes(region_bounds, boxsize)]
+
+        return float(sum(box_mass for (box_mass, _) in results)), \
+            sum(box_count for (_, box_count) in results)
+
+    def mass_within_aperture(self, centre, radius, periodic=False):
+        """
+        Calculate the total mass and number of galaxies within a distance of a point. See
+        :py:func:`~mass_within_aperture()`.
+
+        Parameters
+        ----------
+
+        centre: array-like of floats with shape ``(D,)``
+            Centre of the aperture.
+
+        radius: float
+            Radius of the aperture. Galaxies exactly ``radius`` away are inside.
+
+        periodic: bool, optional
+            If ``True``, distances are measured to the nearest periodic image of each
+            galaxy in the index's box, which is assumed to hold all the galaxies.
+
+        Returns
+        -------
+
+        mass_in_aperture: float
+            The total galaxy mass within the aperture.
+
+        num_gals_in_aperture: int
+            The number of galaxies within the aperture.
+        """
+
+        boxsize = self.boxsize if periodic else None
+        centre, radius = _aperture(centre, radius, self.ndim, boxsize)
+
+        return self._aperture_query(centre, radius, boxsize)
+
+    def _approximate_query(self, region_bounds):
+        """
+        Sums the mass and number of galaxies of the cells covered by a region after
+        snapping its bounds to the nearest cell edges. Galaxies outside of the box (or
+        without a finite position) are ignored.
+        """
+
+        region_bounds = np.asarray(region_bounds, dtype=np.float64)
+
+        edges = np.rint(region_bounds / self.cell_width)
+        np.clip(edges, 0, self.cells_per_dim, out=edges)
+        edges = edges.astype(np.int64)
+
+        first = edges[:, 0]
+        stop = np.maximum(edges[:, 1], first)
+
+        mass_in_region = _table_sum(self._mass_table, first, stop)
+        num_gals_in_region = int(_table_sum(self._count_table, first, stop))
+
+        return float(mass_in_region), num_gals_in_region
+
+    def save(self, fname):
+        """
+        Saves the index to a ``.npz`` file so it can be reloaded using
+        :py:meth:`~GalaxyIndex.load()` rather than rebuilt.
+
+        Parameters
+        ----------
+
+        fname: string
+            Name of the file the index is saved to.
+        """
+
+        # Stored as JSON so the index can be loaded without unpickling anything.
+        header = {key: _json_value(value) for (key, value) in self.catalog_header.items()}
+
+        with open(fname, "wb") as f_out:
+            np.savez(f_out, boxsize=self.boxsize, cells_per_dim=self.cells_per_dim,
+                     catalog_header=json.dumps(header),
+                     pos=self._pos, mass=self._mass, cell_start=self._cell_start,
+                     unbinned_pos=self._unbinned_pos, unbinned_mass=self._unbinned_mass)
+
+        print("Successfully wrote index to {0}".format(fname))
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Reads an index saved by :py:meth:`~GalaxyIndex.save()`.
+
+        Parameters
+        ----------
+
+        fname: string
+            Name of the file the index was saved to.
+
+        Returns
+        -------
+
+        index: ``GalaxyIndex``
+            The reloaded index.
+        """
+
+        with np.load(fname) as data:
+
+            index = cls.__new__(cls)
+
+            index.boxsize = float(data["boxsize"])
+            index.cells_per_dim = int(data["cells_per_dim"])
+            index.cell_width = index.boxsize / index.cells_per_dim
+            index.catalog_header = json.loads(str(data["catalog_header"]))
+
+            index._pos = data["pos"]
+            index._mass = data["mass"]
+            index._cell_start = data["cell_start"]
+            index._unbinned_pos = data["unbinned_pos"]
+            index._unbinned_mass = data["unbinned_mass"]
+
+        index._build_cell_summaries()
+
+        return index
+
+    @classmethod
+    def for_file(cls, fname, **kwargs):
+        """
+        Returns the index for a galaxy file, stored next to it as ``<fname>.index.npz``.
+
+        If the index file exists, is newer than the galaxy file and was built with the
+        ``cells_per_dim`` and ``boxsize`` passed (if any) it is loaded. Otherwise the
+        galaxies are read, indexed and the index is saved for next time.
+
+        Parameters
+        ----------
+
+        fname: string
+            Name of the galaxy file.
+
+        **kwargs:
+            Passed to :py:meth:`~GalaxyIndex.__init__()` if the index must be built.
+
+        Returns
+        -------
+
+        index: ``GalaxyIndex``
+            Index over the galaxies in ``fname``.
+        """
+
+        fname_index = "{0}.index.npz".format(fname)
+
+        if os.path.exists(fname_index) and \
+           os.path.getmtime(fname_index) >= os.path.getmtime(fname):
+
+            with np.load(fname_index) as data:
+                saved = {"cells_per_dim": int(data["cells_per_dim"]),
+                         "boxsize": float(data["boxsize"])}
+
+            if all(kwargs.get(key) is None or kwargs[key] == value
+                   for (key, value) in saved.items()):
+                return cls.load(fname_index)
+
+        index = cls(read_data(fname), **kwargs)
+        index.save(fname_index)
+
+        return index
+
+
+class RegionCache(object):
+    """
+    Least recently used cache of region and aperture query results.
+
+    Results are keyed on the fingerprint of the ``GalaxyCatalog`` or ``GalaxyIndex`` being
+    queried and on the query itself, so a catalog that is rebuilt, reloaded using
+    :py:func:`~read_data()` or modified (see :py:meth:`~GalaxyCatalog.modify()`) is
+    queried afresh. The results of a catalog are dropped once the catalog is garbage
+    collected or modified. The cache can be shared between threads.
+    """
+
+    CacheInfo = collections.namedtuple("CacheInfo", ["hits", "misses", "maxsize",
+                                                     "currsize"])
+
+    def __init__(self, maxsize=128):
+        """
+        Builds an empty cache.
+
+        Parameters
+        ----------
+
+        maxsize: int, optional
+            Largest number of results held. Once full, the least recently used result is
+            evicted.
+        """
+
+        if maxsize < 0:
+            print("The cache size must be non-negative. It was {0}".format(maxsize))
+            raise ValueError
+
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        self._results = collections.OrderedDict()
+        self._versions = {}
+        self._lock = threading.RLock()
+
+    def mass_within_region(self, gals, *bounds, workers=None, periodic=False):
+        """
+        Cached :py:func:`~mass_within_region()`. Galaxies other than a ``GalaxyCatalog``
+        or ``GalaxyIndex`` (e.g., a stream of chunks) are queried without caching.
+        """
+
+        region_bounds = _region_bounds(bounds)
+        key = ("region", tuple(map(tuple, region_bounds.tolist())), bool(periodic))
+
+        return self._lookup(gals, key, mass_within_region, gals, region_bounds,
+                            workers=workers, periodic=periodic)
+
+    def mass_within_aperture(self, gals, centre, radius, workers=None, periodic=False):
+        """
+        Cached :py:func:`~mass_within_aperture()`. See
+        :py:meth:`~RegionCache.mass_within_region()`.
+        """
+
+        key = ("aperture", tuple(np.asarray(centre, dtype=np.float64).ravel().tolist()),
+               float(radius), bool(periodic))
+
+        return self._lookup(gals, key, mass_within_aperture, gals, centre, radius,
+                            workers=workers, periodic=periodic)
+
+    def cache_info(self):
+        """
+        Returns the number of hits, misses, the maximum and current size of the cache.
+        """
+
+        with self._lock:
+            return self.CacheInfo(self.hits, self.misses, self.maxsize,
+                                  len(self._results))
+
+    def clear(self):
+        """
+        Drops every result and resets the counters.
+        """
+
+        with self._lock:
+            self._results.clear()
+            self._versions.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def invalidate(self, gals):
+        """
+        Drops every result of a catalog or index.
+        """
+
+        self._forget(gals.fingerprint[0])
+
+    def __len__(self):
+        return len(self._results)
+
+    def _lookup(self, gals, key, function, *args, **kwargs):
+        """
+        Returns the cached result of ``function(*args, **kwargs)`` for query ``key`` on
+        ``gals``, running and caching it on a miss.
+        """
+
+        fingerprint = getattr(gals, "fingerprint", None)
+        if fingerprint is None:
+            return function(*args, **kwargs)
+
+        token, version = fingerprint[0], fingerprint[1:]
+        key = fingerprint + key
+
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                self.hits += 1
+                return self._results[key]
+
+            self.misses += 1
+
+            # Results of earlier versions of the catalog will never be used again.
+            if token not in self._versions:
+                weakref.finalize(gals, self._release, token)
+            elif self._versions[token] != version:
+                self._forget(token)
+            self._versions[token] = version
+
+        # Run the query without holding the lock so other threads aren't blocked.
+        result = function(*args, **kwargs)
+
+        with self._lock:
+            if self.maxsize > 0 and self._versions.get(token) == version:
+                self._results[key] = result
+                self._results.move_to_end(key)
+                while len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+
+        return result
+
+    def _forget(self, token):
+        """
+        Drops every result of the catalog or index identified by ``token``.
+        """
+
+        with self._lock:
+            for key in [key for key in self._results if key[0] == token]:
+                del self._results[key]
+
+    def _release(self, token):
+        """
+        Called once the catalog or index identified by ``token`` is garbage collected.
+        """
+
+        with self._lock:
+            self._forget(token)
+            self._versions.pop(token, None)
+
+
+def _summed_area_table(grid):
+    """
+    Builds the summed-area table (integral image) of a grid.
+
+    Parameters
+    ----------
+
+    grid: array with ``D`` dimensions
+        The values being summed.
+
+    Returns
+    -------
+
+    table: array with ``D`` dimensions
+        One larger than ``grid`` along each dimension. ``table[i, j, ...]`` is the sum of
+        ``grid[:i, :j, ...]``.
+    """
+
+    table = np.zeros(tuple(size + 1 for size in grid.shape), dtype=grid.dtype)
+    table[(slice(1, None),) * grid.ndim] = grid
+
+    for dim in range(grid.ndim):
+        np.cumsum(table, axis=dim, out=table)
+
+    return table
+
+
+def _table_sum(table, first, stop):
+    """
+    Sums ``grid[first[0]:stop[0], first[1]:stop[1], ...]`` using the summed-area table
+    built by :py:func:`~_summed_area_table()`. This takes ``2**D`` lookups.
+    """
+
+    if np.any(stop <= first):
+        return table.dtype.type(0)
+
+    total = table.dtype.type(0)
+    for corner in itertools.product((0, 1), repeat=len(first)):
+        index = tuple(stop[dim] if use_stop else first[dim]
+                      for (dim, use_stop) in enumerate(corner))
+
+        # Inclusion-exclusion; the sign flips with every lower corner used.
+        if (len(corner) - sum(corner)) % 2:
+            total -= table[index]
+        else:
+            total += table[index]
+
+    return total
+
+
+def _concatenate_ranges(starts, stops):
+    """
+    Returns the concatenation of ``np.arange(start, stop)`` for each pair of ``starts``
+    and ``stops`` without looping in Python.
+    """
+
+    lengths = stops - starts
+    nonempty = lengths > 0
+    starts = starts[nonempty]
+    stops = stops[nonempty]
+
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Every element steps by one, apart from the first element of each range which jumps
+    # from the end of the previous range to the start of its own.
+    steps = np.ones(int(lengths[nonempty].sum()), dtype=np.int64)
+    first_rows = np.concatenate(([0], np.cumsum(lengths[nonempty])[:-1]))
+    steps[first_rows] = starts - np.concatenate(([0], stops[:-1] - 1))
+
+    return np.cumsum(steps)
+
+
+def _read_only(column):
+    """
+    Returns a read-only view of ``column``. The column itself is untouched.
+    """
+
+    column = column.view()
+    column.flags.writeable = False
+
+    return column
+
+
+def _as_catalog(gals):
+    """
+    Returns ``gals`` as a ``GalaxyCatalog``, converting a list of ``Galaxy`` instances if
+    required.
+    """
+
+    if isinstance(gals, GalaxyCatalog):
+        return gals
+
+    return GalaxyCatalog.from_galaxies(gals)
+
+
+def _region_bounds(bounds, ndim=None):
+    """
+    Converts the bounds passed to :py:func:`~mass_within_region()` into a ``(D, 2)`` array.
+
+    Parameters
+    ----------
+
+    bounds: tuple
+        Either one ``[min, max]`` pair per spatial dimension or a single list of them.
+
+    ndim: int, optional
+        If specified, the number of spatial dimensions the bounds must have.
+
+    Returns
+    -------
+
+    region_bounds: ``(D, 2)`` array of floats
+        The minimum and maximum (inclusive) bound for each spatial dimension.
+    """
+
+    if len(bounds) == 1 and np.ndim(bounds[0]) == 2:
+        bounds = bounds[0]
+
+    region_bounds = np.asarray(bounds, dtype=np.float64)
+
+    if region_bounds.ndim != 2 or region_bounds.shape[1] != 2 or \
+       (ndim is not None and region_bounds.shape[0] != ndim):
+        print("The region needs a [min, max] bound for each of the {0} spatial dimensions. "
+              "The passed bounds had shape {1}".format(ndim if ndim is not None else "D",
+                                                       region_bounds.shape))
+        raise ValueError
+
+    return region_bounds
+
+
+def _aperture(centre, radius, ndim=None, boxsize=None):
+    """
+    Checks the centre and radius passed to :py:func:`~mass_within_aperture()`.
+
+    Parameters
+    ----------
+
+    centre: array-like of floats
+        Centre of the aperture.
+
+    radius: float
+        Radius of the aperture.
+
+    ndim: int, optional
+        If specified, the number of spatial dimensions the centre must have.
+
+    boxsize: float, optional
+        If specified, the box is periodic and the aperture must fit inside it without
+        overlapping itself.
+
+    Returns
+    -------
+
+    centre: ``(D,)`` array of floats
+        The centre of the aperture.
+
+    radius: float
+        The radius of the aperture.
+    """
+
+    centre = np.asarray(centre, dtype=np.float64)
+
+    if centre.ndim != 1 or (ndim is not None and len(centre) != ndim):
+        print("The aperture centre needs a position for each of the {0} spatial "
+              "dimensions. The passed centre had shape {1}"
+              .format(ndim if ndim is not None else "D", centre.shape))
+        raise ValueError
+
+    radius = float(radius)
+    if not radius >= 0:
+        print("The aperture radius must be non-negative. It was {0}".format(radius))
+        raise ValueError
+
+    if boxsize is not None and not radius < boxsize / 2.0:
+        print("In a periodic box, the aperture radius must be smaller than half the "
+              "boxsize ({0}). It was {1}".format(boxsize, radius))
+        raise ValueError
+
+    return centre, radius
+
+
+def _periodic_boxsize(boxsize):
+    """
+    Checks the size of the box used by a periodic query.
+    """
+
+    if boxsize is None or not boxsize > 0:
+        print("Periodic queries need the catalog to have a positive boxsize. The boxsize "
+              "was {0}".format(boxsize))
+        raise ValueError
+
+    return float(boxsize)
+
+
+def _peek_boxsize(gals):
+    """
+    Returns the ``boxsize`` of a catalog, index or iterable of galaxies (see
+    :py:func:`~_as_chunks()`) along with the galaxies themselves. An iterable of chunks is
+    re-chained after peeking at its first chunk.
+    """
+
+    if isinstance(gals, (GalaxyCatalog, GalaxyIndex)):
+        return gals, gals.boxsize
+
+    chunks, first = _peek_chunks(gals)
+
+    return chunks, first.boxsize
+
+
+def _peek_chunks(gals):
+    """
+    Returns ``gals`` as chunks (see :py:func:`~_as_chunks()`) along with the first chunk,
+    or an empty catalog if there are no galaxies. A stream of chunks is re-chained after
+    peeking at its first chunk.
+    """
+
+    chunks = _as_chunks(gals)
+
+    if isinstance(chunks, list):
+        return chunks, chunks[0] if chunks else GalaxyCatalog.from_galaxies([])
+
+    first = next(chunks)
+
+    return itertools.chain([first], chunks), first
+
+
+def _periodic_intervals(bound, boxsize):
+    """
+    Splits the bound of a periodic region along one dimension into the intervals it covers
+    inside the box ``[0, boxsize)``.
+
+    Parameters
+    ----------
+
+    bound: [float, float]
+        The minimum and maximum (inclusive) bound. A minimum larger than the maximum (e.g.,
+        ``[90.0, 10.0]``) describes a region that wraps around the edge of the box.
+
+    boxsize: float
+        Size of the periodic box.
+
+    Returns
+    -------
+
+    intervals: list of [float, float]
+        One or two non-overlapping inclusive intervals. A bound spanning the whole box
+        gives ``[-inf, inf]``.
+    """
+
+    lower, upper = float(bound[0]), float(bound[1])
+    if upper < lower:
+        upper += boxsize
+
+    width = upper - lower
+    if width >= boxsize:
+        return [[-np.inf, np.inf]]
+
+    lower = lower % boxsize
+    upper = lower + width
+    if upper < boxsize:
+        return [[lower, upper]]
+
+    # Wraps around the edge. Positions inside the box are strictly smaller than boxsize.
+    return [[lower, np.nextafter(boxsize, 0.0)], [0.0, upper - boxsize]]
+
+
+def _periodic_boxes(region_bounds, boxsize):
+    """
+    Splits a periodic region into the ``(D, 2)`` boxes it covers inside ``[0, boxsize)``,
+    none of which wrap around the edges of the box.
+    """
+
+    intervals = [_periodic_intervals(bound, boxsize) for bound in region_bounds]
+
+    return [np.array(box, dtype=np.float64) for box in itertools.product(*intervals)]
+
+
+def _aperture_mask(pos, centre, radius, boxsize=None):
+    """
+    Flags which galaxies lie within ``radius`` (inclusive) of ``centre``.
+
+    Parameters
+    ----------
+
+    pos: ``(D, N)`` array of floats
+        Positions of the galaxies, one row per spatial dimension.
+
+    centre: ``(D,)`` array of floats
+        Centre of the aperture.
+
+    radius: float
+        Radius of the aperture.
+
+    boxsize: float, optional
+        If specified, the box is periodic with this size and each galaxy is measured from
+        its nearest periodic image.
+
+    Returns
+    -------
+
+    mask: ``(N,)`` array of bools
+        ``True`` for every galaxy inside the aperture.
+    """
+
+    dist_sq = np.zeros(pos.shape[1])
+    for dim_centre, dim_pos in zip(centre, pos):
+        offset = dim_pos - dim_centre
+        if boxsize is not None:
+            offset -= boxsize * np.rint(offset / boxsize)
+        dist_sq += offset**2
+
+    return dist_sq <= radius**2
+
+
+def _region_mask(pos, region_bounds, boxsize=None):
+    """
+    Flags which galaxies lie inside a region.
+
+    Parameters
+    ----------
+
+    pos: ``(D, N)`` array of floats
+        Positions of the galaxies, one row per spatial dimension.
+
+    region_bounds: list of [float, float]
+        The minimum and maximum (inclusive) bound for each spatial dimension.
+
+    boxsize: float, optional
+        If specified, the region is periodic with this box size. The positions are wrapped
+        into the box and the bounds may wrap around its edges. See
+        :py:func:`~_periodic_intervals()`.
+
+    Returns
+    -------
+
+    mask: ``(N,)`` array of bools
+        ``True`` for every galaxy inside the region.
+    """
+
+    if len(region_bounds) != len(pos):
+        print("The region has {0} spatial dimensions but the galaxies have {1}."
+              .format(len(region_bounds), len(pos)))
+        raise ValueError
+
+    # A galaxy is outside as soon as one of its coordinates is outside the bounds.
+    outside = np.zeros(pos.shape[1], dtype=bool)
+    for region_bound, dim_pos in zip(region_bounds, pos):
+
+        if boxsize is None:
+            outside |= dim_pos < region_bound[0]
+            outside |= dim_pos > region_bound[1]
+            continue
+
+        # Along a periodic dimension, a galaxy must be outside every covered interval.
+        dim_pos = np.mod(dim_pos, boxsize)
+        dim_outside = np.ones(pos.shape[1], dtype=bool)
+        for lower, upper in _periodic_intervals(region_bound, boxsize):
+            dim_outside &= (dim_pos < lower) | (dim_pos > upper)
+        outside |= dim_outside
+
+    return ~outside
+
+
+def _as_chunks(gals):
+    """
+    Returns ``gals`` as an iterable of ``GalaxyCatalog`` chunks.
+
+    ``gals`` can be a single ``GalaxyCatalog``, an iterable of ``GalaxyCatalog`` chunks
+    (e.g., from :py:func:`~read_data_chunks()`) or an iterable of ``Galaxy`` instances.
+    """
+
+    if isinstance(gals, GalaxyCatalog):
+        return [gals]
+
+    # Peek at the first element to tell a stream of chunks from a list of galaxies.
+    gals = iter(gals)
+    first = next(gals, None)
+
+    if first is None:
+        return []
+
+    if isinstance(first, GalaxyCatalog):
+        return itertools.chain([first], gals)
+
+    return [GalaxyCatalog.from_galaxies(itertools.chain([first], gals))]
+
+
+def _running_sum(total, masses):
+    """
+    Adds ``masses`` to ``total`` one at a time, in order.
+
+    ``np.cumsum`` adds sequentially (unlike ``np.sum``, which adds pairwise), so this
+    rounds exactly as ``for mass in masses: total += mass`` would.
+    """
+
+    if len(masses) == 0:
+        return total
+
+    # Adding the first mass to zero is exact, so there's nothing to prepend.
+    if total == 0.0:
+        return float(np.cumsum(masses)[-1])
+
+    return float(np.cumsum(np.concatenate(([total], masses)))[-1])
+
+
+def _block_running_sum(total, mass, mask, buffer):
+    """
+    Adds the masses of a block of galaxies flagged by ``mask`` to ``total`` one at a time,
+    in order. See :py:func:`~_running_sum()`.
+
+    The flagged masses are gathered straight into ``buffer`` after ``total`` and summed in
+    place, so no temporary copies are made.
+
+    Parameters
+    ----------
+
+    total: float
+        The running total carried from the previous blocks.
+
+    mass: ``(n,)`` array of floats
+        Masses of the galaxies in the block.
+
+    mask: ``(n,)`` array of bools
+        Flags the galaxies being added.
+
+    buffer: ``(m,)`` array of float64, ``m > n``
+        Scratch space reused between blocks.
+
+    Returns
+    -------
+
+    total: float
+        The running total including this block.
+
+    num_selected: int
+        The number of galaxies flagged.
+    """
+
+    num_selected = int(np.count_nonzero(mask))
+    if num_selected == 0:
+        return total, 0
+
+    running = buffer[:num_selected + 1]
+    running[0] = total
+    np.compress(mask, np.asarray(mass, dtype=np.float64), out=running[1:])
+    np.cumsum(running, out=running)
+
+    return float(running[-1]), num_selected
+
+
+def _reduce_region(chunks, region_mask):
+    """
+    Sums the mass and number of galaxies inside a region in blocks of
+    ``_REDUCTION_BLOCK`` galaxies.
+
+    The masses are added one at a time in catalog order with a running total carried
+    across blocks and chunks, so the mass is exactly that of a Python loop over the
+    galaxies and doesn't depend on how they were split into chunks.
+
+    Parameters
+    ----------
+
+    chunks: iterable of ``GalaxyCatalog``
+        Consecutive chunks of the galaxies. Only one chunk is held at a time.
+
+    region_mask: callable
+        Takes a ``(D, n)`` array of positions and flags the galaxies inside the region,
+        e.g., :py:func:`~_region_mask()` or :py:func:`~_aperture_mask()` with the region
+        bound to it using ``functools.partial``.
+
+    Returns
+    -------
+
+    mass_in_region: float
+        The total galaxy mass within the region.
+
+    num_gals_in_region: int
+        The number of galaxies within the region.
+    """
+
+    mass_in_region = 0.0
+    num_gals_in_region = 0
+
+    buffer = np.empty(_REDUCTION_BLOCK + 1, dtype=np.float64)
+
+    for chunk in chunks:
+        for start in range(0, len(chunk), _REDUCTION_BLOCK):
+            stop = min(len(chunk), start + _REDUCTION_BLOCK)
+
+            mask = region_mask(chunk._pos[:, start:stop])
+            mass_in_region, num_selected = _block_running_sum(mass_in_region,
+                                                              chunk.mass[start:stop],
+                                                              mask, buffer)
+            num_gals_in_region += num_selected
+
+    return mass_in_region, num_gals_in_region
+
+
+def _region_blocks(pos, mass, region_mask):
+    """
+    Sums the mass and number of galaxies inside a region separately for each block of
+    ``_REDUCTION_BLOCK`` galaxies, counted from the first galaxy. The masses within a
+    block are added one at a time in catalog order. See :py:func:`~_mass_within()`.
+
+    Returns
+    -------
+
+    block_masses: ``(B,)`` array of floats
+        The mass inside the region for each block.
+
+    block_counts: ``(B,)`` array of ints
+        The number of galaxies inside the region for each block.
+    """
+
+    num_blocks = -(-len(mass) // _REDUCTION_BLOCK)
+    block_masses = np.zeros(num_blocks, dtype=np.float64)
+    block_counts = np.zeros(num_blocks, dtype=np.int64)
+
+    buffer = np.empty(_REDUCTION_BLOCK + 1, dtype=np.float64)
+
+    for block_num in range(num_blocks):
+        start = block_num * _REDUCTION_BLOCK
+        stop = min(len(mass), start + _REDUCTION_BLOCK)
+
+        mask = region_mask(pos[:, start:stop])
+        block_masses[block_num], block_counts[block_num] = \
+            _block_running_sum(0.0, mass[start:stop], mask, buffer)
+
+    return block_masses, block_counts
+
+
+def mass_within_region(gals, *bounds, workers=None, periodic=False):
+    """
+    Calculate the total mass and number of galaxies within a specified region.
+
+    Parameters
+    ----------
+
+    gals: ``GalaxyCatalog``, ``GalaxyIndex`` or list of ``Galaxy`` class instances.
+        Galaxies that we're calculating the mass for. If a ``GalaxyIndex`` is passed, only
+        the galaxies near the region are looked at. An iterable of ``GalaxyCatalog``
+        chunks (e.g., from :py:func:`~read_data_chunks()`) is reduced one chunk at a
+        time, so only one chunk needs to be in memory.
+
+    *bounds: [float, float] for each spatial dimension
+        The minimum and maximum bounds that define the region we're averaging
+        inside. Either one argument per dimension, e.g., ``mass_within_region(gals,
+        x_bound, y_bound, z_bound)``, or a single list of them, e.g.,
+        ``mass_within_region(gals, [x_bound, y_bound, z_bound])``.
+
+    workers: int, optional
+        If specified, a ``GalaxyCatalog`` is split into shards that are reduced by a pool
+        of this many processes. Catalogs memory mapped from a binary file are mapped
+        again by each worker rather than copied to it. Chunks are handed to the pool as
+        they are read, with at most ``2 * workers`` of them in memory at once. Each
+        worker only returns the mass and number of galaxies of each of its blocks.
+
+    periodic: bool, optional
+        If ``True``, the box is periodic with the ``boxsize`` of the catalog. Positions are
+        wrapped into the box and the region wraps around its edges, so ``[95.0, 105.0]``
+        or ``[95.0, 5.0]`` both cover the 5 units either side of the edge of a box of size
+        100.
+
+    Returns
+    -------
+
+    mass_in_region: float
+        The total galaxy mass within the specified region.
+
+    num_gals_in_region: int
+        The number of galaxies within the specified region.
+
+    Notes
+    -----
+
+    The galaxies are processed in blocks of ``_REDUCTION_BLOCK`` so the temporary arrays
+    stay small. Without ``workers``, the masses inside the region are added one at a
+    time in catalog order, as a Python loop over the galaxies would, so the result is
+    exactly the same whatever the chunks. Each block is gathered into a reused buffer
+    holding the running total and summed in place by ``np.cumsum``, so a query covering
+    the whole box of 1e6 galaxies takes ~10 ms, around 70 times faster than looping over
+    ``Galaxy`` instances.
+
+    With ``workers``, each block (counted from the first galaxy) is summed on its own and
+    the block sums are then added in order. The result is exactly the same whatever the
+    number of workers or the chunks, and agrees with the one-at-a-time sum to rounding.
+    """
+
+    if isinstance(gals, GalaxyIndex):
+        return gals.mass_within_region(*bounds, periodic=periodic)
+
+    region_bounds = _region_bounds(bounds)
+
+    boxsize = None
+    if periodic:
+        gals, boxsize = _peek_boxsize(gals)
+        boxsize = _periodic_boxsize(boxsize)
+
+    region_mask = functools.partial(_region_mask, region_bounds=region_bounds,
+                                    boxsize=boxsize)
+
+    return _mass_within(gals, region_mask, workers)
+
+
+def mass_within_aperture(gals, centre, radius, workers=None, periodic=False):
+    """
+    Calculate the total mass and number of galaxies within a distance of a point.
+
+    Parameters
+    ----------
+
+    gals: ``GalaxyCatalog``, ``GalaxyIndex`` or list of ``Galaxy`` class instances.
+        Galaxies that we're calculating the mass for. If a ``GalaxyIndex`` is passed, only
+        the galaxies in cells overlapping the aperture are looked at. An iterable of
+        ``GalaxyCatalog`` chunks is reduced one chunk at a time. See
+        :py:func:`~mass_within_region()`.
+
+    centre: array-like of floats with shape ``(D,)``
+        Centre of the aperture.
+
+    radius: float
+        Radius of the aperture. Galaxies exactly ``radius`` away are inside.
+
+    workers: int, optional
+        If specified, the galaxies are reduced by a pool of this many processes. See
+        :py:func:`~mass_within_region()`.
+
+    periodic: bool, optional
+        If ``True``, the box is periodic with the ``boxsize`` of the catalog and distances
+        are measured to the nearest periodic image of each galaxy. The radius must then be
+        smaller than half the box.
+
+    Returns
+    -------
+
+    mass_in_aperture: float
+        The total galaxy mass within the aperture.
+
+    num_gals_in_aperture: int
+        The number of galaxies within the aperture.
+
+    Notes
+    -----
+
+    Without an index, the masses are summed exactly as in :py:func:`~mass_within_region()`.
+    Galaxies without a finite position are never inside an aperture.
+    """
+
+    if isinstance(gals, GalaxyIndex):
+        return gals.mass_within_aperture(centre, radius, periodic=periodic)
+
+    boxsize = None
+    if periodic:
+        gals, boxsize = _peek_boxsize(gals)
+        boxsize = _periodic_boxsize(boxsize)
+
+    centre, radius = _aperture(centre, radius, boxsize=boxsize)
+    region_mask = functools.partial(_aperture_mask, centre=centre, radius=radius,
+                                    boxsize=boxsize)
+
+    return _mass_within(gals, region_mask, workers)
+
+
+def _mass_within(gals, region_mask, workers):
+    """
+    Sums the mass and number of galaxies flagged by ``region_mask``.
+
+    If ``workers`` is ``None``, the masses are added one at a time in catalog order (see
+    :py:func:`~_reduce_region()`). Otherwise each block of ``_REDUCTION_BLOCK`` galaxies
+    is summed by a pool of ``workers`` processes (see :py:func:`~_region_blocks()`) and
+    the block sums are added in block order. The blocks are counted from the first
+    galaxy, so the result doesn't depend on the number of workers or on the chunks.
+    """
+
+    chunks = _as_chunks(gals)
+
+    if workers is None:
+        return _reduce_region(chunks, region_mask)
+
+    block_masses, block_counts = _map_blocks(_region_blocks_shard, chunks, workers,
+                                             region_mask)
+    if block_masses is None:
+        return 0.0, 0
+
+    return _running_sum(0.0, block_masses), int(block_counts.sum())
+
+
+def mass_within_regions(gals, region_bounds, workers=None, periodic=False):
+    """
+    Calculate the total mass and number of galaxies within many regions at once.
+
+    Rather than scanning every galaxy once per region, the galaxies are sorted by their x
+    position once. Each region then only has to look at the galaxies whose x position
+    falls inside its x bounds.
+
+    Parameters
+    ----------
+
+    gals: ``GalaxyCatalog``, ``GalaxyIndex`` or list of ``Galaxy`` class instances.
+        Galaxies that we're calculating the mass for. An iterable of ``GalaxyCatalog``
+        chunks is reduced one chunk at a time. See :py:func:`~mass_within_region()`.
+
+    region_bounds: array-like of floats with shape ``(R, D, 2)``
+        The bounds of each region, ordered as ``[[x_min, x_max], [y_min, y_max], ...]``
+        for the ``D`` spatial dimensions of the galaxies. As with
+        :py:func:`~mass_within_region()`, the bounds are inclusive.
+
+    workers: int, optional
+        If specified, the galaxies are split into shards and each shard is queried for
+        every region by a pool of this many processes. See
+        :py:func:`~mass_within_region()`.
+
+    periodic: bool, optional
+        If ``True``, the regions wrap around the edges of the periodic box. See
+        :py:func:`~mass_within_region()`.
+
+    Returns
+    -------
+
+    mass_in_regions: ``(R,)`` array of floats
+        The total galaxy mass within each region.
+
+    num_gals_in_regions: ``(R,)`` array of ints
+        The number of galaxies within each region.
+
+    Notes
+    -----
+
+    The masses are summed in the same order as :py:func:`~mass_within_region()` with the
+    same ``workers``, so the results are identical to calling it once per region.
+    """
+
+    region_bounds = np.asarray(region_bounds, dtype=np.float64)
+    if isinstance(gals, GalaxyIndex):
+        first = gals
+    else:
+        gals, first = _peek_chunks(gals)
+    ndim = first.ndim
+
+    if region_bounds.ndim != 3 or region_bounds.shape[1:] != (ndim, 2):
+        print("The region bounds must have shape (R, {0}, 2). The passed bounds had shape "
+              "{1}".format(ndim, region_bounds.shape))
+        raise ValueError
+
+    boxsize = _periodic_boxsize(first.boxsize) if periodic else None
+
+    # The index already avoids full scans so just query it region by region.
+    if isinstance(gals, GalaxyIndex):
+        return _query_index(gals._query, [(bounds,) for bounds in region_bounds], boxsize)
+
+    regions = []
+    for bounds in region_bounds:
+        x_intervals = [bounds[0]] if boxsize is None else \
+            _periodic_intervals(bounds[0], boxsize)
+        region_mask = functools.partial(_region_mask, region_bounds=bounds[1:],
+                                        boxsize=boxsize)
+        regions.append((x_intervals, region_mask, 1))
+
+    return _mass_within_many(gals, regions, workers, boxsize)
+
+
+def mass_within_apertures(gals, centres, radii, workers=None, periodic=False):
+    """
+    Calculate the total mass and number of galaxies within many apertures at once.
+
+    Parameters
+    ----------
+
+    gals: ``GalaxyCatalog``, ``GalaxyIndex`` or list of ``Galaxy`` class instances.
+        Galaxies that we're calculating the mass for. Pass a ``GalaxyIndex`` when querying
+        thousands of small apertures; each is then answered from the cells it overlaps.
+        An iterable of ``GalaxyCatalog`` chunks is reduced one chunk at a time.
+
+    centres: array-like of floats with shape ``(R, D)``
+        The centre of each aperture.
+
+    radii: float or array-like of floats with shape ``(R,)``
+        The radius of each aperture.
+
+    workers: int, optional
+        If specified, the galaxies are split into shards and each shard is queried for
+        every aperture by a pool of this many processes. See
+        :py:func:`~mass_within_region()`.
+
+    periodic: bool, optional
+        If ``True``, distances are measured to the nearest periodic image of each galaxy.
+        See :py:func:`~mass_within_aperture()`.
+
+    Returns
+    -------
+
+    mass_in_apertures: ``(R,)`` array of floats
+        The total galaxy mass within each aperture.
+
+    num_gals_in_apertures: ``(R,)`` array of ints
+        The number of galaxies within each aperture.
+
+    Notes
+    -----
+
+    Without an index, the galaxies are sorted by their x position once as in
+    :py:func:`~mass_within_regions()` and the results are identical to calling
+    :py:func:`~mass_within_aperture()` once per aperture.
+    """
+
+    centres = np.asarray(centres, dtype=np.float64)
+    if isinstance(gals, GalaxyIndex):
+        first = gals
+    else:
+        gals, first = _peek_chunks(gals)
+    ndim = first.ndim
+
+    if centres.ndim != 2 or centres.shape[1] != ndim:
+        print("The aperture centres must have shape (R, {0}). The passed centres had "
+              "shape {1}".format(ndim, centres.shape))
+        raise ValueError
+
+    radii = np.broadcast_to(np.asarray(radii, dtype=np.float64), (len(centres),))
+    boxsize = _periodic_boxsize(first.boxsize) if periodic else None
+
+    apertures = [_aperture(centre, radius, ndim, boxsize)
+                 for (centre, radius) in zip(centres, radii)]
+
+    if isinstance(gals, GalaxyIndex):
+        return _query_index(gals._aperture_query, apertures, boxsize)
+
+    regions = []
+    for (centre, radius) in apertures:
+        x_bound = [centre[0] - radius, centre[0] + radius]
+        x_intervals = [x_bound] if boxsize is None else \
+            _periodic_intervals(x_bound, boxsize)
+        region_mask = functools.partial(_aperture_mask, centre=centre, radius=radius,
+                                        boxsize=boxsize)
+        regions.append((x_intervals, region_mask, 0))
+
+    return _mass_within_many(gals, regions, workers, boxsize)
+
+
+def _query_index(query, regions, boxsize):
+    """
+    Answers many queries of a ``GalaxyIndex`` one at a time.
+
+    Parameters
+    ----------
+
+    query: callable
+        Bound query method of the index, called as ``query(*args, boxsize)``.
+
+    regions: list of tuples
+        The ``args`` of each query, e.g., ``(region_bounds,)`` or ``(centre, radius)``.
+
+    boxsize: float or ``None``
+        Size of the periodic box, if any.
+
+    Returns
+    -------
+
+    mass_in_regions, num_gals_in_regions: ``(R,)`` arrays
+        The results of each query.
+    """
+
+    num_regions = len(regions)
+    mass_in_regions = np.zeros(num_regions, dtype=np.float64)
+    num_gals_in_regions = np.zeros(num_regions, dtype=np.int64)
+
+    for region_num, args in enumerate(regions):
+        mass_in_regions[region_num], num_gals_in_regions[region_num] = \
+            query(*(args + (boxsize,)))
+
+    return mass_in_regions, num_gals_in_regions
+
+
+def _mass_within_many(chunks, regions, workers, boxsize):
+    """
+    Sums the mass and number of galaxies inside each of many regions of the chunks
+    returned by :py:func:`~_as_chunks()`. As for :py:func:`~_mass_within()`, either one
+    galaxy at a time (see :py:func:`~_reduce_regions()`) or, if ``workers`` is specified,
+    in blocks (see :py:func:`~_regions_blocks()`).
+    """
+
+    if workers is not None:
+        block_masses, block_counts = _map_blocks(_regions_blocks_shard, chunks, workers,
+                                                 regions, boxsize)
+        if block_masses is None:
+            return (np.zeros(len(regions), dtype=np.float64),
+                    np.zeros(len(regions), dtype=np.int64))
+
+        # ``np.cumsum`` adds the block sums of each region one at a time, in order.
+        return np.cumsum(block_masses, axis=-1)[:, -1], block_counts.sum(axis=-1)
+
+    # The running totals of each region are carried from one chunk to the next.
+    mass_in_regions = np.zeros(len(regions), dtype=np.float64)
+    num_gals_in_regions = np.zeros(len(regions), dtype=np.int64)
+
+    for chunk in chunks:
+        mass_in_regions, chunk_counts = _reduce_regions(chunk._pos, chunk.mass, regions,
+                                                        boxsize, mass_in_regions)
+        num_gals_in_regions += chunk_counts
+
+    return mass_in_regions, num_gals_in_regions
+
+
+def _reduce_regions(pos, mass, regions, boxsize=None, totals=None):
+    """
+    Sums the mass and number of galaxies inside each of many regions, adding the masses
+    one at a time in catalog order. See :py:func:`~mass_within_regions()`.
+
+    Parameters
+    ----------
+
+    pos: ``(D, N)`` array of floats
+        Positions of the galaxies, one row per spatial dimension.
+
+    mass: ``(N,)`` array of floats
+        Masses of the galaxies.
+
+    regions: list of ``(x_intervals, region_mask, first_dim)``
+        For each region, the inclusive x intervals it covers, and a callable flagging
+        which of the galaxies inside those intervals are inside the region. The callable
+        is passed the positions along dimensions ``first_dim`` onwards.
+
+    boxsize: float, optional
+        If specified, the box is periodic and the x positions are wrapped into it before
+        being compared with the x intervals.
+
+    totals: ``(R,)`` array of floats, optional
+        Running totals of the previous chunks that the masses are added to.
+
+    Returns
+    -------
+
+    mass_in_regions: ``(R,)`` array of floats
+        The total galaxy mass within each region.
+
+    num_gals_in_regions: ``(R,)`` array of ints
+        The number of galaxies within each region.
+    """
+
+    mass_in_regions = np.zeros(len(regions), dtype=np.float64) if totals is None else \
+        np.array(totals, dtype=np.float64)
+    num_gals_in_regions = np.zeros(len(regions), dtype=np.int64)
+
+    for region_num, selected in enumerate(_select_regions(pos, regions, boxsize)):
+        mass_in_regions[region_num] = _running_sum(mass_in_regions[region_num],
+                                                   mass[selected])
+        num_gals_in_regions[region_num] = len(selected)
+
+    return mass_in_regions, num_gals_in_regions
+
+
+def _regions_blocks(pos, mass, regions, boxsize=None):
+    """
+    Sums the mass and number of galaxies inside each of many regions separately for each
+    block of ``_REDUCTION_BLOCK`` galaxies, counted from the first galaxy. The masses
+    within a block are added one at a time in catalog order. See
+    :py:func:`~_reduce_regions()` for the parameters.
+
+    Returns
+    -------
+
+    block_masses: ``(R, B)`` array of floats
+        The mass inside each region for each block.
+
+    block_counts: ``(R, B)`` array of ints
+        The number of galaxies inside each region for each block.
+    """
+
+    num_blocks = -(-len(mass) // _REDUCTION_BLOCK)
+    block_masses = np.zeros((len(regions), num_blocks), dtype=np.float64)
+    block_counts = np.zeros((len(regions), num_blocks), dtype=np.int64)
+
+    block_edges = np.arange(_REDUCTION_BLOCK, len(mass), _REDUCTION_BLOCK)
+
+    for region_num, selected in enumerate(_select_regions(pos, regions, boxsize)):
+        splits = np.searchsorted(selected, block_edges)
+        block_counts[region_num] = np.diff(np.concatenate(([0], splits,
+                                                           [len(selected)])))
+
+        for block_num, selected_mass in enumerate(np.split(mass[selected], splits)):
+            block_masses[region_num, block_num] = _running_sum(0.0, selected_mass)
+
+    return block_masses, block_counts
+
+
+def _select_regions(pos, regions, boxsize=None):
+    """
+    Finds the galaxies inside each of many regions. See :py:func:`~_reduce_regions()`.
+
+    Rather than scanning every galaxy once per region, the galaxies are sorted by their x
+    position once. Each region then only looks at the galaxies inside its x intervals.
+
+    Returns
+    -------
+
+    selected: generator of arrays of ints
+        For each region, the indices of the galaxies inside it in catalog order.
+    """
+
+    # Sort once by x. ``argsort`` places any NaN at the end; those galaxies are never
+    # outside an x bound so they're candidates for every region.
+    x = pos[0] if boxsize is None else np.mod(pos[0], boxsize)
+    order = np.argsort(x, kind="stable")
+    sorted_x = x[order]
+    num_finite = len(sorted_x) - int(np.count_nonzero(np.isnan(sorted_x)))
+    nan_rows = order[num_finite:]
+
+    for x_intervals, region_mask, first_dim in regions:
+
+        candidates = []
+        for x_lower, x_upper in x_intervals:
+            lower = np.searchsorted(sorted_x[:num_finite], x_lower, side="left")
+            upper = np.searchsorted(sorted_x[:num_finite], x_upper, side="right")
+            candidates.append(order[lower:upper])
+        candidates = np.concatenate(candidates + [nan_rows])
+
+        mask = region_mask(pos[first_dim:, candidates])
+
+        # Put the selected galaxies back into catalog order so the masses are summed
+        # exactly as the single region query would.
+        yield np.sort(candidates[mask])
+
+
+def pair_counts(gals, bins, periodic=False, workers=None, mass_weighted=False):
+    """
+    Counts the pairs of galaxies as a function of their separation, i.e., the DD(r)
+    histogram of the two-point correlation function.
+
+    Parameters
+    ----------
+
+    gals: ``GalaxyCatalog``, ``GalaxyIndex`` or list of ``Galaxy`` class instances.
+        Galaxies being paired. A catalog is placed on a grid of cells at least as wide as
+        the largest separation (a cell list), so only galaxies in neighbouring cells are
+        compared. A ``GalaxyIndex`` is used as is, searching as many cells as needed.
+
+    bins: array-like of floats
+        Increasing separations bounding each bin, starting from at least 0. As with
+        ``numpy.histogram``, every bin is half open apart from the last, which also
+        includes its upper edge.
+
+    periodic: bool, optional
+        If ``True``, the box is periodic with the ``boxsize`` of the catalog (or index) and
+        each pair is separated by its nearest periodic image. The largest separation must
+        then be smaller than half the box.
+
+    workers: int, optional
+        If greater than 1, the galaxies are split between a pool of this many processes.
+
+    mass_weighted: bool, optional
+        If ``True``, each pair contributes the product of the masses of its galaxies rather
+        than 1.
+
+    Returns
+    -------
+
+    counts: ``(len(bins) - 1,)`` array of ints (or floats if ``mass_weighted``)
+        The number of distinct pairs separated by a distance inside each bin.
+
+    Notes
+    -----
+
+    Each galaxy is compared with the galaxies of the cells within the largest separation
+    of its own, and each pair of cells is only visited once. For a fixed largest
+    separation, the cost grows linearly with the number of galaxies rather than as
+    ``N**2``. Galaxies without a finite position are never paired.
+    """
+
+    edges = _separation_bins(bins)
+    index, boxsize = _pair_index(gals, edges[-1], periodic)
+
+    num_gals = len(index._mass)
+    counts, masses = _map_pair_shards(index, index._pos, np.arange(num_gals),
+                                      index._mass, edges, boxsize, False, workers)
+
+    if mass_weighted:
+        return masses
+
+    return counts
+
+
+def mass_profiles(gals, centres, bins, periodic=False, workers=None, cumulative=False):
+    """
+    Calculate the mass and number of galaxies in spherical shells around many centres at
+    once.
+
+    Parameters
+    ----------
+
+    gals: ``GalaxyCatalog``, ``GalaxyIndex`` or list of ``Galaxy`` class instances.
+        Galaxies whose mass is binned. See :py:func:`~pair_counts()`.
+
+    centres: array-like of floats with shape ``(R, D)``
+        The centre of each profile.
+
+    bins: array-like of floats
+        Increasing radii bounding each shell. See :py:func:`~pair_counts()`.
+
+    periodic: bool, optional
+        If ``True``, distances are measured to the nearest periodic image of each galaxy.
+        See :py:func:`~pair_counts()`.
+
+    workers: int, optional
+        If greater than 1, the centres are split between a pool of this many processes.
+
+    cumulative: bool, optional
+        If ``True``, returns the mass and number of galaxies within each radius (and beyond
+        the first) instead of within each shell.
+
+    Returns
+    -------
+
+    mass_in_shells: ``(R, len(bins) - 1)`` array of floats
+        The galaxy mass within each shell around each centre.
+
+    num_gals_in_shells: ``(R, len(bins) - 1)`` array of ints
+        The number of galaxies within each shell around each centre.
+
+    Notes
+    -----
+
+    The cumulative profile out to the last radius matches
+    :py:func:`~mass_within_apertures()` when the first radius is 0.
+    """
+
+    edges = _separation_bins(bins)
+    index, boxsize = _pair_index(gals, edges[-1], periodic)
+
+    centres = np.asarray(centres, dtype=np.float64)
+    if centres.ndim != 2 or centres.shape[1] != index.ndim:
+        print("The profile centres must have shape (R, {0}). The passed centres had shape "
+              "{1}".format(index.ndim, centres.shape))
+        raise ValueError
+
+    if boxsize is not None:
+        centres = np.mod(centres, boxsize)
+
+    num_gals_in_shells, mass_in_shells = _map_pair_shards(index, centres.T, None, None,
+                                                          edges, boxsize, True, workers)
+
+    num_bins = len(edges) - 1
+    mass_in_shells = mass_in_shells.reshape(-1, num_bins)
+    num_gals_in_shells = num_gals_in_shells.reshape(-1, num_bins)
+
+    if cumulative:
+        mass_in_shells = np.cumsum(mass_in_shells, axis=1)
+        num_gals_in_shells = np.cumsum(num_gals_in_shells, axis=1)
+
+    return mass_in_shells, num_gals_in_shells
+
+
+def _separation_bins(bins):
+    """
+    Checks the bin edges passed to :py:func:`~pair_counts()` or
+    :py:func:`~mass_profiles()`.
+    """
+
+    edges = np.asarray(bins, dtype=np.float64)
+
+    if edges.ndim != 1 or len(edges) < 2 or not edges[0] >= 0 or \
+       np.any(np.diff(edges) <= 0):
+        print("The bins must be at least 2 increasing, non-negative separations. The bins "
+              "passed were {0}".format(bins))
+        raise ValueError
+
+    return edges
+
+
+def _pair_index(gals, max_separation, periodic):
+    """
+    Returns the ``GalaxyIndex`` used to find the neighbours of galaxies up to
+    ``max_separation`` away, along with the size of the periodic box (or ``None``).
+
+    A passed ``GalaxyIndex`` is used as is. Otherwise, the cells are made at least
+    ``max_separation`` wide, but never so small there's less than about one galaxy per
+    cell. For a periodic box, the galaxies are wrapped into the box first.
+    """
+
+    if isinstance(gals, GalaxyIndex):
+        index = gals
+        boxsize = _periodic_boxsize(index.boxsize) if periodic else None
+    else:
+        gals = _as_catalog(gals)
+        boxsize = _periodic_boxsize(gals.boxsize) if periodic else None
+
+        pos = gals._pos if boxsize is None else np.mod(gals._pos, boxsize)
+        finite = np.all(np.isfinite(pos), axis=0)
+
+        extent = boxsize if boxsize is not None else gals.boxsize
+        if extent is None:
+            extent = float(pos[:, finite].max()) if np.any(finite) else 1.0
+
+        max_cells = max(int(math.ceil(np.count_nonzero(finite) ** (1.0 / gals.ndim))), 1)
+        if max_separation > 0:
+            cells_per_dim = min(int(extent // max_separation), max_cells)
+        else:
+            cells_per_dim = max_cells
+
+        index = GalaxyIndex(GalaxyCatalog._from_columns(pos, gals.mass, boxsize),
+                            cells_per_dim=max(cells_per_dim, 1),
+                            boxsize=boxsize if boxsize is not None else gals.boxsize)
+
+    if boxsize is not None and not max_separation < boxsize / 2.0:
+        print("In a periodic box, the largest separation must be smaller than half the "
+              "boxsize ({0}). It was {1}".format(boxsize, max_separation))
+        raise ValueError
+
+    return index, boxsize
+
+
+def _neighbour_offsets(reach, ndim, cells_per_dim, periodic, half):
+    """
+    Returns the offsets from a cell to every cell within ``reach`` cells of it along each
+    dimension.
+
+    Parameters
+    ----------
+
+    reach: int
+        Largest offset along each dimension.
+
+    ndim: int
+        Number of spatial dimensions.
+
+    cells_per_dim: int
+        Number of cells along each dimension.
+
+    periodic: bool
+        If ``True``, the offsets wrap around the grid and offsets landing on the same cell
+        are only returned once.
+
+    half: bool
+        If ``True``, only one of each offset and its opposite is returned, so every pair
+        of cells is visited once.
+
+    Returns
+    -------
+
+    offsets: list of ``((D,) array of ints, bool)``
+        Each offset, and whether it is its own opposite (e.g., no offset at all). Pairs of
+        galaxies between a cell and such an offset must only be counted one way round.
+    """
+
+    offsets = {}
+    for offset in itertools.product(range(-reach, reach + 1), repeat=ndim):
+        offset = np.array(offset, dtype=np.int64)
+        opposite = -offset
+
+        if periodic:
+            offset %= cells_per_dim
+            opposite %= cells_per_dim
+
+        key = tuple(offset.tolist())
+        opposite_key = tuple(opposite.tolist())
+
+        if half and opposite_key < key:
+            continue
+
+        offsets[key] = (offset, half and key == opposite_key)
+
+    return [offsets[key] for key in sorted(offsets)]
+
+
+def _map_pair_shards(index, pos, rows, weights, edges, boxsize, per_point, workers):
+    """
+    Splits the points being paired with the galaxies of ``index`` into shards and bins the
+    pairs of each shard, using a pool of ``workers`` processes if requested. See
+    :py:func:`~_bin_pairs()`.
+
+    Returns
+    -------
+
+    counts, masses: arrays
+        The binned number of pairs and their mass, summed over the shards or, if
+        ``per_point``, concatenated in the order of the points.
+    """
+
+    num_points = pos.shape[1]
+    num_shards = workers if workers is not None and workers > 1 else 1
+    bounds = np.linspace(0, num_points, min(num_shards, max(num_points, 1)) + 1)
+    bounds = bounds.astype(np.int64)
+
+    shards = [(pos[:, start:stop], None if rows is None else rows[start:stop],
+               None if weights is None else weights[start:stop])
+              for (start, stop) in zip(bounds[:-1], bounds[1:])]
+
+    if len(shards) <= 1:
+        results = [_bin_pairs(index, *(shard + (edges, boxsize, per_point)))
+                   for shard in shards]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_bin_pairs, index, *(shard + (edges, boxsize,
+                                                                 per_point)))
+                       for shard in shards]
+            results = [future.result() for future in futures]
+
+    counts = [shard_counts for (shard_counts, _) in results]
+    masses = [shard_masses for (_, shard_masses) in results]
+
+    if per_point:
+        return np.concatenate(counts), np.concatenate(masses)
+
+    return np.sum(counts, axis=0), np.sum(masses, axis=0)
+
+
+def _bin_pairs(index, pos, rows, weights, edges, boxsize, per_point):
+    """
+    Bins the separations between points and the galaxies of an index that lie within the
+    last bin edge.
+
+    Parameters
+    ----------
+
+    index: ``GalaxyIndex``
+        Galaxies being paired with the points.
+
+    pos: ``(D, M)`` array of floats
+        Positions of the points.
+
+    rows: ``(M,)`` array of ints or ``None``
+        If the points are the galaxies of the index, their rows in ``index._pos``. Each
+        pair of galaxies is then counted once and galaxies aren't paired with themselves.
+
+    weights: ``(M,)`` array of floats or ``None``
+        If specified, the mass of every pair is multiplied by the weight of its point.
+
+    edges: array of floats
+        The bin edges. See :py:func:`~pair_counts()`.
+
+    boxsize: float or ``None``
+        Size of the periodic box, if any.
+
+    per_point: bool
+        If ``True``, each point gets its own histogram.
+
+    Returns
+    -------
+
+    counts: array of ints
+        The number of pairs in each bin, with shape ``(M * num_bins,)`` if ``per_point``
+        or ``(num_bins,)`` otherwise.
+
+    masses: array of floats
+        The summed galaxy mass (times the weight of the point) of the pairs in each bin.
+    """
+
+    ndim, num_points = pos.shape
+    num_bins = len(edges) - 1
+    edges_sq = edges**2
+
+    hist_size = num_points * num_bins if per_point else num_bins
+    counts = np.zeros(hist_size, dtype=np.int64)
+    masses = np.zeros(hist_size, dtype=np.float64)
+
+    reach = int(math.ceil(edges[-1] / index.cell_width))
+    offsets = _neighbour_offsets(reach, ndim, index.cells_per_dim, boxsize is not None,
+                                 rows is not None)
+
+    coords = index._cell_coords(pos)
+
+    for (offset, self_opposite) in offsets:
+
+        partner = coords + offset[:, np.newaxis]
+        if boxsize is None:
+            points = np.nonzero(np.all((partner >= 0) &
+                                       (partner < index.cells_per_dim), axis=0))[0]
+        else:
+            partner %= index.cells_per_dim
+            points = np.arange(num_points)
+
+        cell_ids = np.ravel_multi_index(partner[:, points], index._cell_counts.shape)
+        starts = index._cell_start[cell_ids]
+        stops = index._cell_start[cell_ids + 1]
+        if self_opposite:
+            starts = np.maximum(starts, rows[points] + 1)
+        lengths = np.maximum(stops - starts, 0)
+
+        # Measure the candidate pairs ``_PAIR_BLOCK`` at a time.
+        total = np.cumsum(lengths)
+        splits = np.searchsorted(total, np.arange(_PAIR_BLOCK, total[-1] if len(total)
+                                                  else 0, _PAIR_BLOCK))
+
+        for block in np.split(np.arange(len(points)), splits):
+
+            point_rows = np.repeat(points[block], lengths[block])
+            gal_rows = _concatenate_ranges(starts[block], stops[block])
+
+            dist_sq = np.zeros(len(gal_rows))
+            for dim in range(ndim):
+                separation = index._pos[dim, gal_rows] - pos[dim, point_rows]
+                if boxsize is not None:
+                    separation -= boxsize * np.rint(separation / boxsize)
+                dist_sq += separation**2
+
+            # Half open bins, apart from the last which includes its upper edge.
+            bin_ids = np.searchsorted(edges_sq, dist_sq, side="right") - 1
+            bin_ids[dist_sq == edges_sq[-1]] = num_bins - 1
+            inside = (bin_ids >= 0) & (bin_ids < num_bins)
+
+            hist_ids = bin_ids[inside]
+            if per_point:
+                hist_ids += point_rows[inside] * num_bins
+
+            pair_mass = index._mass[gal_rows[inside]]
+            if weights is not None:
+                pair_mass = pair_mass * weights[point_rows[inside]]
+
+            counts += np.bincount(hist_ids, minlength=hist_size)
+            masses += np.bincount(hist_ids, weights=pair_mass, minlength=hist_size)
+
+    return counts, masses
+
+
+def _catalog_shards(gals, num_shards):
+    """
+    Splits a catalog into at most ``num_shards`` contiguous shards to be reduced by
+    separate processes.
+
+    Every shard (apart from the last) holds a whole number of ``_REDUCTION_BLOCK`` blocks,
+    so the blocks within each shard are the same as those of the full catalog.
+
+    Parameters
+    ----------
+
+    gals: ``GalaxyCatalog``
+        Galaxies being split.
+
+    num_shards: int
+        Maximum number of shards.
+
+    Returns
+    -------
+
+    shards: list of tuples
+        Each shard is ``(filename, start, stop, pos, mass)``. If the catalog is memory
+        mapped from ``filename``, ``pos`` and ``mass`` are ``None`` and the worker maps
+        rows ``start:stop`` itself. Otherwise ``filename`` is ``None`` and the rows are
+        passed directly.
+    """
+
+    num_blocks = -(-len(gals) // _REDUCTION_BLOCK)
+    shard_length = max(1, -(-num_blocks // num_shards)) * _REDUCTION_BLOCK
+
+    shards = []
+    for start in range(0, len(gals), shard_length):
+        stop = min(len(gals), start + shard_length)
+
+        if gals.filename is not None:
+            shards.append((gals.filename, start, stop, None, None))
+        else:
+            shards.append((None, start, stop, gals._pos[:, start:stop],
+                           gals.mass[start:stop]))
+
+    return shards
+
+
+def _shard_columns(shard):
+    """
+    Returns the ``(pos, mass)`` columns of a shard made by :py:func:`~_catalog_shards()`.
+    """
+
+    fname, start, stop, pos, mass = shard
+
+    if fname is None:
+        return pos, mass
+
+    header, offset = _read_binary_header(fname)
+    gals = _memmap_catalog(fname, header, offset)
+
+    return gals._pos[:, start:stop], gals.mass[start:stop]
+
+
+def _region_blocks_shard(shard, region_mask):
+    """
+    Worker for :py:func:`~mass_within_region()`. See :py:func:`~_region_blocks()`.
+    """
+
+    pos, mass = _shard_columns(shard)
+
+    return _region_blocks(pos, mass, region_mask)
+
+
+def _regions_blocks_shard(shard, regions, boxsize):
+    """
+    Worker for :py:func:`~mass_within_regions()`. See :py:func:`~_regions_blocks()`.
+    """
+
+    pos, mass = _shard_columns(shard)
+
+    return _regions_blocks(pos, mass, regions, boxsize)
+
+
+def _map_blocks(function, chunks, workers, *args):
+    """
+    Applies a block reduction worker, ``function(shard, *args)``, to the chunks returned
+    by :py:func:`~_as_chunks()` using a pool of ``workers`` processes. A catalog is split
+    into shards while a stream of chunks is re-split so each piece starts on a block.
+
+    Returns
+    -------
+
+    block_masses, block_counts: arrays or ``None``
+        The results of every shard or piece joined along their last (block) axis, in
+        catalog order. ``None`` if there are no galaxies.
+    """
+
+    if isinstance(chunks, list):
+        results = [result for catalog in chunks for result in
+                   _map_shards(function, catalog, workers, *args)]
+    else:
+        results = list(_map_chunks(function, _block_aligned(chunks), workers, *args))
+
+    if not results:
+        return None, None
+
+    block_masses = np.concatenate([masses for (masses, _) in results], axis=-1)
+    block_counts = np.concatenate([counts for (_, counts) in results], axis=-1)
+
+    return block_masses, block_counts
+
+
+def _block_aligned(chunks):
+    """
+    Re-splits a stream of ``GalaxyCatalog`` chunks into ``(pos, mass)`` pieces that each
+    (apart from the last) hold a whole number of ``_REDUCTION_BLOCK`` blocks, counted from
+    the first galaxy of the stream. Only a block spanning two chunks is copied.
+    """
+
+    leftover = None
+
+    for chunk in chunks:
+        pos, mass = chunk._pos, chunk.mass
+        start = 0
+
+        # Complete the block left over from the previous chunks.
+        if leftover is not None:
+            start = min(len(mass), _REDUCTION_BLOCK - len(leftover[1]))
+            leftover = (np.concatenate([leftover[0], pos[:, :start]], axis=1),
+                        np.concatenate([leftover[1], mass[:start]]))
+
+            if len(leftover[1]) < _REDUCTION_BLOCK:
+                continue
+
+            yield leftover
+            leftover = None
+
+        stop = start + (len(mass) - start) // _REDUCTION_BLOCK * _REDUCTION_BLOCK
+        if stop > start:
+            yield pos[:, start:stop], mass[start:stop]
+
+        if stop < len(mass):
+            leftover = (pos[:, stop:], mass[stop:])
+
+    if leftover is not None:
+        yield leftover
+
+
+def _map_shards(function, gals, workers, *args):
+    """
+    Splits a catalog into shards and applies ``function(shard, *args)`` to each using a
+    pool of ``workers`` processes.
+
+    Returns
+    -------
+
+    results: list
+        The result for each shard, in catalog order.
+    """
+
+    shards = _catalog_shards(gals, workers)
+
+    # Not worth starting a pool for a single shard.
+    if len(shards) <= 1:
+        return [function(shard, *args) for shard in shards]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(function, shards,
+                                *(itertools.repeat(arg) for arg in args)))
+
+    return results
+
+
+def _map_chunks(function, pieces, workers, *args):
+    """
+    Applies ``function(shard, *args)`` to each of a stream of ``(pos, mass)`` pieces using
+    a pool of ``workers`` processes. Each piece is passed as a shard holding its columns
+    (see :py:func:`~_catalog_shards()`).
+
+    At most ``2 * workers`` pieces are handed to the pool at once, so the stream is never
+    read into memory as a whole.
+
+    Returns
+    -------
+
+    results: generator
+        The result for each piece, in stream order.
+    """
+
+    # Memory mapped pieces are sent as plain arrays.
+    shards = ((None, 0, len(mass), np.asarray(pos), np.asarray(mass))
+              for (pos, mass) in pieces)
+
+    # Not worth starting a pool for a single worker.
+    if workers <= 1:
+        for shard in shards:
+            yield function(shard, *args)
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = collections.deque()
+
+        for shard in shards:
+            pending.append(pool.submit(function, shard, *args))
+
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def assign_mass(gals, gridsize, boxsize=None, scheme="cic", fname_out=None,
+                precision="double"):
+    """
+    Deposits the mass of galaxies onto a periodic grid covering the box.
+
+    Parameters
+    ----------
+
+    gals: ``GalaxyCatalog``, list of ``Galaxy`` class instances or iterable of
+          ``GalaxyCatalog`` chunks.
+        Galaxies whose mass is deposited. Chunks (e.g., from
+        :py:func:`~read_data_chunks()`) are deposited one at a time, so only one chunk
+        needs to be in memory.
+
+    gridsize: int or tuple of ints
+        Number of cells along every spatial dimension or, for non-cubic grids, along each
+        spatial dimension.
+
+    boxsize: float, optional
+        Size of the periodic box covered by the grid, starting from 0. If ``None``, uses
+        the ``boxsize`` of the catalog (or its first chunk).
+
+    scheme: string, optional
+        How each galaxy's mass is shared between cells. ``"ngp"`` (nearest grid point)
+        gives all the mass to the cell containing the galaxy, ``"cic"`` (cloud in cell)
+        shares it linearly between the 2 nearest cell centres along each dimension and
+        ``"tsc"`` (triangular shaped cloud) shares it quadratically between the 3 nearest.
+
+    fname_out: string, optional
+        File name where the grid is written to. If ``None``, will return the grid
+        instead.
+
+    precision: string, optional
+        Precision of the grid written to ``fname_out``, either ``"int"``, ``"float"`` or
+        ``"double"``.
+
+    Returns
+    -------
+
+    If ``fname_out`` is specified:
+        The grid saved to file ``fname_out`` as raw cells in C order, the binary layout
+        read by ``downsampler.read_grid(fname_out, gridsize, precision)``.
+
+    If ``fname_out`` is not specified:
+        grid: array of floats with shape ``gridsize``
+            The mass in each cell. Axis ``d`` of the grid runs along spatial dimension
+            ``d``, e.g., ``grid[i, j]`` holds the mass around ``x = i``, ``y = j`` cells.
+
+    Notes
+    -----
+
+    The grid is periodic, so mass deposited past an edge of the box wraps around to the
+    opposite edge and the total mass of the grid equals that of the galaxies. Galaxies
+    without a finite position are skipped. The deposits are summed with
+    ``numpy.bincount`` a block of ``_ASSIGN_BLOCK`` galaxies at a time, over only the cells
+    each block touches.
+    """
+
+    if scheme not in _ASSIGNMENT_SUPPORT:
+        print("The mass assignment scheme must be one of {0}. The scheme passed was {1}"
+              .format(sorted(_ASSIGNMENT_SUPPORT), scheme))
+        raise ValueError
+
+    if fname_out and precision not in _GRID_PRECISIONS:
+        print("The grid precision must be one of {0}. The precision passed was {1}"
+              .format(sorted(_GRID_PRECISIONS), precision))
+        raise ValueError
+
+    chunks = iter(_as_chunks(gals))
+    first = next(chunks, None)
+
+    if isinstance(gridsize, (int, np.integer)):
+        ndim = first.ndim if first is not None else 2
+        shape = (int(gridsize),) * ndim
+    else:
+        shape = tuple(int(num_cells) for num_cells in gridsize)
+
+    if len(shape) < 1 or min(shape) < 1:
+        print("The grid needs at least 1 cell along each dimension. The grid size was {0}"
+              .format(gridsize))
+        raise ValueError
+
+    if boxsize is None and first is not None:
+        boxsize = first.boxsize
+    if first is not None and (boxsize is None or boxsize <= 0):
+        print("A positive boxsize is needed to place the galaxies on the grid. The "
+              "boxsize was {0}".format(boxsize))
+        raise ValueError
+
+    grid = np.zeros(int(np.prod(shape)), dtype=np.float64)
+
+    if first is not None:
+        for chunk in itertools.chain([first], chunks):
+
+            if chunk.ndim != len(shape):
+                print("The galaxies have {0} spatial dimensions but the grid has {1}."
+                      .format(chunk.ndim, len(shape)))
+                raise ValueError
+
+            for start in range(0, len(chunk), _ASSIGN_BLOCK):
+                stop = start + _ASSIGN_BLOCK
+                _deposit_mass(grid, shape, chunk._pos[:, start:stop],
+                              chunk.mass[start:stop], boxsize, scheme)
+
+    grid.shape = shape
+
+    if fname_out:
+        grid.astype(_GRID_PRECISIONS[precision]).tofile(fname_out)
+        print("Successfully wrote to {0}".format(fname_out))
+        return None
+
+    return grid
+
+
+def _deposit_mass(grid, shape, pos, mass, boxsize, scheme):
+    """
+    Adds the mass of a block of galaxies to a flattened periodic grid. See
+    :py:func:`~_block_deposit()`.
+    """
+
+    touched, touched_mass = _block_deposit(shape, pos, mass, boxsize, scheme)
+    grid[touched] += touched_mass
+
+
+def _block_deposit(shape, pos, mass, boxsize, scheme):
+    """
+    Finds the mass a block of galaxies deposits onto a periodic grid. See
+    :py:func:`~assign_mass()`.
+
+    Only the cells the block touches are returned, so the cost doesn't depend on the size
+    of the grid.
+
+    Parameters
+    ----------
+
+    shape: tuple of ints
+        Number of cells along each spatial dimension.
+
+    pos: ``(D, N)`` array of floats
+        Positions of the galaxies, one row per spatial dimension.
+
+    mass: ``(N,)`` array of floats
+        Masses of the galaxies.
+
+    boxsize: float
+        Size of the periodic box covered by the grid.
+
+    scheme: string
+        Key of ``_ASSIGNMENT_SUPPORT``.
+
+    Returns
+    -------
+
+    touched: ``(M,)`` array of ints
+        Sorted flat indices of the cells the galaxies deposit mass onto.
+
+    touched_mass: ``(M,)`` array of floats
+        The mass deposited onto each of those cells.
+    """
+
+    finite = np.all(np.isfinite(pos), axis=0)
+    if not np.all(finite):
+        pos = pos[:, finite]
+        mass = mass[finite]
 
-        x, y, mass: float
-            The spatial positions and mass of the galaxy. Units are arbitrary.
-        """
-        self.x = x
-        self.y = y
+    # Build the flat index and weight of every (galaxy, cell) pair one dimension at a
+    # time. Each galaxy starts with its whole mass in a single cell.
+    cell_ids = np.zeros((1, pos.shape[1]), dtype=np.int64)
+    weights = np.asarray(mass, dtype=np.float64)[np.newaxis, :]
 
-        self.mass = mass
+    for dim_pos, num_cells in zip(pos, shape):
+        dim_ids, dim_weights = _assignment_weights(dim_pos, num_cells, boxsize / num_cells,
+                                                   _ASSIGNMENT_SUPPORT[scheme])
 
-    def __repr__(self):
-        """
-        A ``Galaxy`` will be represented as "[<x>, <y>] mass: <mass>". Much more useful than
-        <Galaxy object at BLAH-USELESS-MEMORY-ADDRESS>
-        """
+        cell_ids = (cell_ids[:, np.newaxis, :] * num_cells +
+                    dim_ids[np.newaxis, :, :]).reshape(-1, pos.shape[1])
+        weights = (weights[:, np.newaxis, :] *
+                   dim_weights[np.newaxis, :, :]).reshape(-1, pos.shape[1])
 
-        string = "[{0}, {1}] mass: {2}".format(self.x, self.x, self.mass)
-        return string
+    touched, touched_ids = np.unique(cell_ids.ravel(), return_inverse=True)
+    touched_mass = np.bincount(touched_ids.ravel(), weights=weights.ravel(),
+                               minlength=len(touched))
 
+    return touched, touched_mass
 
-def mass_within_region(gals, x_bound, y_bound):
+
+def _assignment_weights(dim_pos, num_cells, cell_width, support):
     """
-    Calculate the total mass and number of galaxies within a specified region.
+    Finds the cells a galaxy's mass is shared between along one dimension and the
+    fraction each receives.
 
     Parameters
     ----------
 
-    gals: list of ``Galaxy`` class instances.
-        Galaxies that we're calculating the mass for.
+    dim_pos: ``(N,)`` array of floats
+        Positions of the galaxies along this dimension.
 
-    x_bound, y_bound: [float, float]
-        The minimum and maximum bounds that define the region we're averaging
-        inside.
+    num_cells: int
+        Number of cells along this dimension.
+
+    cell_width: float
+        Width of each cell.
+
+    support: int
+        Number of cells each galaxy is shared between; 1 for NGP, 2 for CIC and 3 for TSC.
 
     Returns
     -------
 
-    mass_in_region: float
-        The total galaxy mass within the specified region.
+    cell_ids: ``(support, N)`` array of ints
+        The (periodically wrapped) cells receiving mass from each galaxy.
 
-    num_gals_in_region: int
-        The number of galaxies within the specified region.
+    weights: ``(support, N)`` array of floats
+        The fraction of each galaxy's mass given to each of those cells. Sums to 1 for
+        every galaxy.
     """
 
-    # Initialize our counters.
-    mass_in_region = 0.0
-    num_gals_in_region = 0
-    region_bounds = [x_bound, y_bound]
-
-    for gal in gals:
-
-        gal_pos = [gal.x, gal.y]
-        in_region = True
-
-        # We're going to go through each dimension of the galaxy and ask if the position is
-        # inside the region.
-        for region_bound, dim_pos in zip(region_bounds, gal_pos):
-
-            # Galaxy is outside the region. Flag it and move to the next galaxy.
-            if dim_pos < region_bound[0] or dim_pos > region_bound[1]:
-                in_region = False
-                break
+    # Position in units of cells; cell ``i`` is centred on ``i + 0.5``.
+    cell_pos = dim_pos / cell_width
+    nearest = np.floor(cell_pos)
+
+    if support == 1:
+        first = nearest
+        weights = np.ones((1, len(dim_pos)), dtype=np.float64)
+    elif support == 2:
+        first = np.floor(cell_pos - 0.5)
+        offset = cell_pos - 0.5 - first
+        weights = np.stack((1.0 - offset, offset))
+    else:
+        first = nearest - 1
+        offset = cell_pos - nearest - 0.5
+        weights = np.stack((0.5 * (0.5 - offset)**2, 0.75 - offset**2,
+                            0.5 * (0.5 + offset)**2))
 
-        # Galaxy was in the region, add it.
-        if in_region:
-            mass_in_region += gal.mass
-            num_gals_in_region += 1
+    cell_ids = (first.astype(np.int64) + np.arange(support)[:, np.newaxis]) % num_cells
 
-    return mass_in_region, num_gals_in_region
+    return cell_ids, weights
 
 
 def generate_random_data(boxsize=100.0, mass_factor=1.0, N=1000, seed=None,
-                         fname_out=None):
+                         fname_out=None, fmt="text", rng=None, ndim=2):
     """
     Generates random Galaxy instances. If ``fname_out`` is specified, then writes the
     galaxies to file; otherwise, returns them.
@@ -124,62 +3069,221 @@ def generate_random_data(boxsize=100.0, mass_factor=1.0, N=1000, seed=None,
         Number of galaxies to generate.
 
     seed: int
-        Seed used to initialize the state of the random generator. If ``None``, will use
-        the system clock as defined by ``numpy.random.seed()``.
+        Seed used to initialize the state of the random generator. The galaxies are
+        identical to those generated after calling ``numpy.random.seed(seed)``, although
+        the global ``numpy.random`` state is left untouched. If both ``seed`` and ``rng``
+        are ``None``, uses fresh entropy from the operating system.
 
     fname_out: string
         File name where the galaxies are written to. If ``None``, will return the galaxies
-        instead.
+        instead. The galaxies are generated and written ``_GENERATE_CHUNK`` at a time, so
+        all ``N`` galaxies are never held in memory.
+
+    fmt: string
+        Format of ``fname_out``, either ``"text"`` or ``"binary"``. See
+        :py:func:`~write_galaxies()`.
+
+    rng: ``numpy.random.Generator``, optional
+        Generator used to draw the galaxies instead of one built from ``seed``. Can't be
+        passed together with ``seed``.
+
+    ndim: int, optional
+        Number of spatial dimensions of the galaxies.
 
     Returns
     ---------
 
     If ``fname_out`` is specified:
-        ``N`` galaxies with random x/y positions and mass saved to file ``fname_out``.
-        The data format is three columns: x y Mass.
+        ``N`` galaxies with random positions and mass saved to file ``fname_out``.
+        The data format is ``ndim`` + 1 columns, e.g., x y Mass.
 
     If ``fname_out`` is not specified:
-        gals: a list of ``Galaxy`` instances with length ``N``.
-            Galaxies with random x/y positions and mass.
-    """
+        gals: ``GalaxyCatalog`` with length ``N``.
+            Galaxies with random positions and mass.
 
-    if seed:
-        np.random.seed(seed)
-    else:
-        np.random.seed()
+    Notes
+    -----
 
-    # Generate numbers between 0 and 1 then scale by the size of the box. We will generate
-    # 2N numbers then slice it later.
-    random_pos = np.random.uniform(size=2*N) * boxsize
+    The random numbers are always drawn as ``N`` x positions, then ``N`` y positions (and
+    so on for each further dimension), then ``N`` masses. Hence the same generator gives
+    the same galaxies whether they're returned or written to file.
+    """
 
-    x = random_pos[0:N]
-    y = random_pos[N:2*N]
+    if seed is not None and rng is not None:
+        print("Only one of seed ({0}) and rng ({1}) can be specified.".format(seed, rng))
+        raise ValueError
 
-    mass = np.random.uniform(size=N) * mass_factor
+    if ndim < 1:
+        print("The galaxies need at least 1 spatial dimension. ndim was {0}".format(ndim))
+        raise ValueError
 
-    # Generate the galaxies!
-    gals = []
-    for (pos_x, pos_y, mass_val) in zip(x, y, mass):
-        gal = Galaxy(pos_x, pos_y, mass_val)
-        gals.append(gal)
+    if rng is None:
+        rng = _seeded_generator(seed)
 
-    # We're either returning a list of galaxies or writing the values to file.
     if fname_out:
-        write_galaxies(gals, fname_out, boxsize, mass_factor, seed)
+        _stream_random_data(rng, boxsize, mass_factor, N, seed, fname_out, fmt, ndim)
         return None
+
+    # Fill the columns in place; no temporary arrays are needed.
+    pos = np.empty((ndim, N), dtype=np.float64)
+    mass = np.empty(N, dtype=np.float64)
+
+    for dim_pos in pos:
+        _fill_uniform(rng, dim_pos, boxsize)
+    _fill_uniform(rng, mass, mass_factor)
+
+    # Generate the galaxies!
+    gals = GalaxyCatalog._from_columns(pos, mass, boxsize, mass_factor, seed)
+
+    return gals
+
+
+def _seeded_generator(seed):
+    """
+    Builds a ``numpy.random.Generator`` that draws the same uniform numbers as the legacy
+    ``numpy.random`` functions after ``numpy.random.seed(seed)``.
+
+    Parameters
+    ----------
+
+    seed: int or ``None``
+        Seed of the legacy generator. If ``None``, a generator seeded with fresh entropy
+        from the operating system is returned.
+
+    Returns
+    -------
+
+    rng: ``numpy.random.Generator``
+        The seeded generator.
+    """
+
+    if seed is None:
+        return np.random.default_rng()
+
+    # Both the legacy ``RandomState`` and ``Generator`` use the same Mersenne Twister and
+    # the same conversion to doubles, so copying the legacy seeded state is enough.
+    legacy_state = np.random.RandomState(seed).get_state(legacy=False)
+
+    bit_generator = np.random.MT19937()
+    bit_generator.state = {"bit_generator": "MT19937", "state": legacy_state["state"]}
+
+    return np.random.Generator(bit_generator)
+
+
+def _fill_uniform(rng, out, scale):
+    """
+    Fills ``out`` in place with uniform random numbers in the range [0, 1) times by
+    ``scale``.
+    """
+
+    rng.random(out=out)
+    out *= scale
+
+
+def _copy_generator(rng, skip, scratch):
+    """
+    Returns an independent copy of ``rng`` that has been advanced by ``skip`` doubles.
+
+    Parameters
+    ----------
+
+    rng: ``numpy.random.Generator``
+        Generator being copied. Its state is untouched.
+
+    skip: int
+        Number of doubles the copy skips.
+
+    scratch: array of floats
+        Buffer used to hold the skipped numbers.
+
+    Returns
+    -------
+
+    rng_copy: ``numpy.random.Generator``
+        The advanced copy.
+    """
+
+    bit_generator = type(rng.bit_generator)()
+    bit_generator.state = rng.bit_generator.state
+    rng_copy = np.random.Generator(bit_generator)
+
+    while skip > 0:
+        num_skipped = min(skip, len(scratch))
+        rng_copy.random(out=scratch[:num_skipped])
+        skip -= num_skipped
+
+    return rng_copy
+
+
+def _stream_random_data(rng, boxsize, mass_factor, N, seed, fname_out, fmt, ndim=2):
+    """
+    Generates random galaxies ``_GENERATE_CHUNK`` at a time and writes them to file as
+    they're generated. See :py:func:`~generate_random_data()` for the parameters.
+
+    The random numbers are drawn in the same order as when all the galaxies are generated
+    at once, and ``rng`` is left in the same state.
+    """
+
+    chunk_size = min(N, _GENERATE_CHUNK)
+    chunk_pos = np.empty((ndim, chunk_size), dtype=np.float64)
+    chunk_mass = np.empty(chunk_size, dtype=np.float64)
+
+    if fmt == "binary":
+
+        header_bytes = _encode_binary_header(_binary_header(N, boxsize, mass_factor, seed,
+                                                            ndim))
+
+        # The file holds each column in turn, exactly the order the numbers are drawn in.
+        with open(fname_out, "wb") as f_out:
+            f_out.write(header_bytes)
+
+            for scale in (boxsize,) * ndim + (mass_factor,):
+                for start in range(0, N, _GENERATE_CHUNK):
+                    column = chunk_mass[:min(N - start, _GENERATE_CHUNK)]
+                    _fill_uniform(rng, column, scale)
+                    column.astype(_BINARY_DTYPE, copy=False).tofile(f_out)
+
+    elif fmt == "text":
+
+        # Each row needs a position per dimension and a mass, drawn N numbers apart. Use a
+        # copy of the generator for each column, starting at the right place in the stream.
+        column_rngs = [_copy_generator(rng, column * N, chunk_mass)
+                       for column in range(ndim + 1)]
+
+        with open(fname_out, "w") as f_out:
+            _write_text_header(f_out, boxsize, mass_factor, seed, ndim)
+
+            for start in range(0, N, _GENERATE_CHUNK):
+                num_gals = min(N - start, _GENERATE_CHUNK)
+
+                for dim in range(ndim):
+                    _fill_uniform(column_rngs[dim], chunk_pos[dim, :num_gals], boxsize)
+                _fill_uniform(column_rngs[ndim], chunk_mass[:num_gals], mass_factor)
+
+                chunk = GalaxyCatalog._from_columns(chunk_pos[:, :num_gals],
+                                                    chunk_mass[:num_gals])
+                _write_text_rows(f_out, chunk)
+
+        # Leave ``rng`` where it would be after drawing all (ndim + 1)N numbers.
+        rng.bit_generator.state = column_rngs[ndim].bit_generator.state
+
     else:
-        return gals
+        print("The only accepted galaxy file formats are 'text' or 'binary'. The format "
+              "passed was {0}".format(fmt))
+        raise ValueError
+
+    print("Successfully wrote to {0}".format(fname_out))
 
 
-def write_galaxies(gals, fname_out, boxsize, mass_factor, seed=None):
+def write_galaxies(gals, fname_out, boxsize, mass_factor, seed=None, fmt="text"):
     """
-    Writes a list of galaxies to file.
+    Writes a set of galaxies to file.
 
     Parameters
     ----------
 
-    gals: list of ``Galaxy`` class instances.
-        Galaxies that we're calculating the mass for.
+    gals: ``GalaxyCatalog`` or list of ``Galaxy`` class instances.
+        Galaxies that we're writing.
 
     fname_out: string
         File name where the galaxies are written to.
@@ -196,32 +3300,247 @@ def write_galaxies(gals, fname_out, boxsize, mass_factor, seed=None):
         Seed used to initialize the state of the random generator. This may have been used
         to generate random data using :py:func:`~generate_random_data()`.
 
+    fmt: string
+        Either ``"text"`` or ``"binary"``. Any other value will raise a ValueError.
+
     Generates
     ---------
 
-    Saves a file named ``fname_out`` with the x/y positions and mass saved. The data
-    format is three columns: x y Mass.
+    Saves a file named ``fname_out`` with the positions and mass saved. The number of
+    spatial dimensions is stored in the header.
+
+    For ``"text"``, the data format is a commented header followed by one column per
+    spatial dimension and the mass, e.g., x y Mass.
+
+    For ``"binary"``, the data format is a header (see :py:func:`~_encode_binary_header()`)
+    followed by the position columns and the Mass column, each stored as ``N`` contiguous
+    little-endian doubles.
     """
 
-    with open(fname_out, "w") as f_out:
+    gals = _as_catalog(gals)
 
-        # Be good to our future-selves and write a header.
-        f_out.write("# boxsize {0}\n".format(boxsize))
-        f_out.write("# mass_factor {0}\n".format(mass_factor))
-        f_out.write("# seed {0}\n".format(seed))
-        f_out.write("# x\ty\tMass\n")
+    if fmt == "binary":
+        header_bytes = _encode_binary_header(_binary_header(len(gals), boxsize,
+                                                            mass_factor, seed, gals.ndim))
 
-        for gal in gals:
-            f_out.write("{0} {1} {2}\n".format(gal.x, gal.y, gal.mass))
+        with open(fname_out, "wb") as f_out:
+            f_out.write(header_bytes)
+
+            for column in list(gals._pos) + [gals.mass]:
+                column.astype(_BINARY_DTYPE, copy=False).tofile(f_out)
+
+        print("Successfully wrote to {0}".format(fname_out))
+        return
+
+    if fmt != "text":
+        print("The only accepted galaxy file formats are 'text' or 'binary'. The format "
+              "passed was {0}".format(fmt))
+        raise ValueError
+
+    with open(fname_out, "w") as f_out:
+
+        _write_text_header(f_out, boxsize, mass_factor, seed, gals.ndim)
+        _write_text_rows(f_out, gals)
 
         print("Successfully wrote to {0}".format(fname_out))
 
     return
 
 
+def _write_text_header(f_out, boxsize, mass_factor, seed, ndim=2):
+    """
+    Writes the commented header of a text galaxy file. See :py:func:`~write_galaxies()`.
+    """
+
+    # Be good to our future-selves and write a header.
+    f_out.write("# boxsize {0}\n".format(boxsize))
+    f_out.write("# mass_factor {0}\n".format(mass_factor))
+    f_out.write("# seed {0}\n".format(seed))
+    f_out.write("# ndim {0}\n".format(ndim))
+    f_out.write("# {0}\tMass\n".format("\t".join(_column_names(ndim)[:-1])))
+
+
+def _column_names(ndim):
+    """
+    Returns the names of the columns of a galaxy file with ``ndim`` spatial dimensions,
+    e.g., ``["x", "y", "mass"]``.
+    """
+
+    dim_names = [_DIM_NAMES[dim] if dim < len(_DIM_NAMES) else "x{0}".format(dim)
+                 for dim in range(ndim)]
+
+    return dim_names + ["mass"]
+
+
+def _write_text_rows(f_out, gals):
+    """
+    Writes the position/mass rows of a text galaxy file.
+
+    Rows are formatted ``_TEXT_CHUNK`` galaxies at a time and each chunk is written with a
+    single call. Converting the columns with ``tolist()`` hands ``str.format`` plain Python
+    floats, which are formatted (as their shortest round-trip representation) much faster
+    than ``numpy`` scalars.
+
+    Even so, writing 1e6 galaxies takes ~3.3-3.5 seconds, only ~1.2-1.6x faster than
+    writing one row at a time (~4.0-5.5 seconds), as converting each float to its shortest
+    representation dominates. Use the binary format for large catalogs.
+
+    Parameters
+    ----------
+
+    f_out: file object
+        File opened in text write mode.
+
+    gals: ``GalaxyCatalog``
+        Galaxies being written.
+    """
+
+    columns = list(gals._pos) + [gals.mass]
+    row_format = (" ".join("{{{0}}}".format(num) for num in range(len(columns))) +
+                  "\n").format
+
+    for start in range(0, len(gals), _TEXT_CHUNK):
+        stop = start + _TEXT_CHUNK
+
+        rows = map(row_format, *(column[start:stop].tolist() for column in columns))
+        f_out.write("".join(rows))
+
+
+def _binary_header(N, boxsize, mass_factor, seed, ndim=2):
+    """
+    Returns the header describing a binary galaxy file holding ``N`` galaxies with
+    ``ndim`` spatial dimensions.
+    """
+
+    header = {"boxsize": boxsize, "mass_factor": mass_factor, "seed": seed, "N": N,
+              "ndim": ndim, "dtype": _BINARY_DTYPE, "columns": _column_names(ndim)}
+
+    return {key: _json_value(value) for (key, value) in header.items()}
+
+
+def _json_value(value):
+    """
+    Converts a ``numpy`` scalar (e.g., a seed passed as ``np.int64``) into the equivalent
+    Python scalar so it can be JSON encoded. Anything else is returned unchanged.
+    """
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+
+def _encode_binary_header(header):
+    """
+    Encodes the header of a binary galaxy file.
+
+    The header is the ``_BINARY_MAGIC`` bytes, the length of the JSON encoded ``header``
+    as a little-endian unsigned 32-bit integer, then the JSON itself. It is zero padded to
+    a multiple of ``_BINARY_ALIGN`` bytes so that the columns start on an aligned offset.
+
+    The header is encoded before the file is opened, so metadata that can't be encoded
+    doesn't leave a truncated file behind.
+
+    Parameters
+    ----------
+
+    header: dict
+        Metadata describing the catalog. Must hold the ``"N"``, ``"dtype"`` and
+        ``"columns"`` of the column blocks following it.
+
+    Returns
+    -------
+
+    header_bytes: bytes
+        The padded header. Its length is where the first column starts.
+    """
+
+    header_json = json.dumps(header).encode("utf-8")
+
+    unpadded = len(_BINARY_MAGIC) + 4 + len(header_json)
+    offset = -(-unpadded // _BINARY_ALIGN) * _BINARY_ALIGN
+
+    return (_BINARY_MAGIC + struct.pack("<I", len(header_json)) + header_json +
+            b"\0" * (offset - unpadded))
+
+
+def _read_binary_header(fname):
+    """
+    Reads the header encoded by :py:func:`~_encode_binary_header()`.
+
+    Parameters
+    ----------
+
+    fname: string
+        Name of file being read
+
+    Returns
+    -------
+
+    header: dict or ``None``
+        Metadata stored in the file. ``None`` if ``fname`` is not a binary galaxy file.
+
+    offset: int or ``None``
+        Where the first column starts. ``None`` if ``fname`` is not a binary galaxy file.
+    """
+
+    with open(fname, "rb") as f_in:
+
+        if f_in.read(len(_BINARY_MAGIC)) != _BINARY_MAGIC:
+            return None, None
+
+        header_length = struct.unpack("<I", f_in.read(4))[0]
+        header = json.loads(f_in.read(header_length).decode("utf-8"))
+
+    unpadded = len(_BINARY_MAGIC) + 4 + header_length
+    offset = -(-unpadded // _BINARY_ALIGN) * _BINARY_ALIGN
+
+    return header, offset
+
+
+def _read_header(fname):
+    """
+    Reads the metadata written by :py:func:`~write_galaxies()` at the top of a galaxy file.
+
+    Parameters
+    ----------
+
+    fname: string
+        Name of file being read
+
+    Returns
+    -------
+
+    header: dict
+        Keyed by ``"boxsize"``, ``"mass_factor"``, ``"seed"`` and ``"ndim"``. Any value
+        missing from the header (or written as ``None``) is ``None``.
+    """
+
+    header = {"boxsize": None, "mass_factor": None, "seed": None, "ndim": None}
+    parsers = {"boxsize": float, "mass_factor": float, "seed": int, "ndim": int}
+
+    with open(fname, "r") as f_in:
+        for line in f_in:
+            if not line.startswith("#"):
+                break
+
+            fields = line[1:].split()
+            if len(fields) != 2 or fields[0] not in parsers:
+                continue
+
+            key, value = fields
+            if value != "None":
+                header[key] = parsers[key](value)
+
+    return header
+
+
 def read_data(fname):
     """
-    Reads x/y/mass values from a file and initializes as a list of Galaxy class instances.
+    Reads position/mass values from a file and initializes them as a ``GalaxyCatalog``.
+
+    Both the text and binary formats written by :py:func:`~write_galaxies()` are read; the
+    format is detected from the start of the file.
 
     Parameters
     ----------
@@ -232,8 +3551,12 @@ def read_data(fname):
     Returns
     -------
 
-    galaxies: list of ``Galaxy`` class instances
-        Galaxy data read from the file.
+    galaxies: ``GalaxyCatalog``
+        Galaxy data read from the file. The ``boxsize``, ``mass_factor`` and ``seed``
+        stored in the header are attached to the catalog.
+
+        For binary files the columns are read-only ``np.memmap`` views of the file, so
+        nothing is read until it's used.
 
     Notes
     -----
@@ -241,14 +3564,130 @@ def read_data(fname):
     Written to pair with ``generate_random_data()``.
     """
 
+    header, offset = _read_binary_header(fname)
+    if header is not None:
+        gals = _memmap_catalog(fname, header, offset)
+        print("Read {0} galaxies from {1}".format(len(gals), fname))
+        return gals
+
     # We had a header with "#".
-    gal_data = np.loadtxt(fname, comments="#")
+    header = _read_header(fname)
+    gal_data = np.loadtxt(fname, comments="#", ndmin=2)
+    ndim = _text_ndim(header.pop("ndim"), gal_data)
 
-    gals = []
-    for gal_vals in gal_data:
-        gal = Galaxy(gal_vals[0], gal_vals[1], gal_vals[2])
-        gals.append(gal)
+    gal_data = gal_data.reshape(-1, ndim + 1)
+    gals = GalaxyCatalog.from_positions(gal_data[:, :-1], gal_data[:, -1], **header)
 
     print("Read {0} galaxies from {1}".format(len(gals), fname))
 
     return gals
+
+
+def _text_ndim(ndim, gal_data):
+    """
+    Returns the number of spatial dimensions of a text galaxy file. Files written before
+    the header held ``ndim`` have one column per dimension plus the mass.
+    """
+
+    if ndim is not None:
+        return ndim
+
+    if gal_data.size:
+        return gal_data.shape[1] - 1
+
+    return 2
+
+
+def _memmap_catalog(fname, header, offset):
+    """
+    Builds a ``GalaxyCatalog`` whose columns are memory mapped from a binary galaxy file.
+
+    Parameters
+    ----------
+
+    fname: string
+        Name of the binary galaxy file.
+
+    header, offset:
+        As returned by :py:func:`~_read_binary_header()`.
+
+    Returns
+    -------
+
+    gals: ``GalaxyCatalog``
+        Galaxies stored in the file.
+    """
+
+    N = header["N"]
+    num_columns = len(header["columns"])
+
+    # ``np.memmap`` refuses to map zero bytes.
+    if N > 0:
+        columns = np.memmap(fname, dtype=header["dtype"], mode="r", offset=offset,
+                            shape=(num_columns, N))
+    else:
+        columns = np.zeros((num_columns, 0), dtype=header["dtype"])
+
+    gals = GalaxyCatalog._from_columns(columns[:-1], columns[-1], header["boxsize"],
+                                       header["mass_factor"], header["seed"])
+    if N > 0:
+        gals.filename = fname
+
+    return gals
+
+
+def read_data_chunks(fname, chunk_size=_READ_CHUNK):
+    """
+    Reads a galaxy file as a sequence of ``GalaxyCatalog`` chunks, so files larger than
+    memory can be processed.
+
+    Parameters
+    ----------
+
+    fname: string
+        Name of file being read. Either format written by :py:func:`~write_galaxies()` is
+        accepted.
+
+    chunk_size: int, optional
+        Number of galaxies in each chunk. The final chunk may be shorter.
+
+    Yields
+    ------
+
+    gals: ``GalaxyCatalog``
+        The next ``chunk_size`` galaxies of the file. The ``boxsize``, ``mass_factor`` and
+        ``seed`` stored in the header are attached to every chunk. For binary files, the
+        chunks are ``np.memmap`` views of the file.
+    """
+
+    if chunk_size < 1:
+        print("The chunk size must be at least 1. It was {0}".format(chunk_size))
+        raise ValueError
+
+    header, offset = _read_binary_header(fname)
+    if header is not None:
+        gals = _memmap_catalog(fname, header, offset)
+        for start in range(0, len(gals), chunk_size):
+            yield gals[start:start + chunk_size]
+        return
+
+    header = _read_header(fname)
+    ndim = header.pop("ndim")
+
+    with open(fname, "r") as f_in:
+
+        # Skip the header so every chunk holds ``chunk_size`` galaxies.
+        rows = itertools.dropwhile(lambda line: line.startswith("#"), f_in)
+
+        while True:
+            lines = list(itertools.islice(rows, chunk_size))
+            if not lines:
+                return
+
+            gal_data = np.loadtxt(lines, comments="#", ndmin=2)
+            ndim = _text_ndim(ndim, gal_data)
+
+            gal_data = gal_data.reshape(-1, ndim + 1)
+            if len(gal_data):
+                yield GalaxyCatalog.from_positions(gal_data[:, :-1], gal_data[:, -1],
+                                                   **header)
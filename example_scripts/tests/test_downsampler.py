@@ -40,7 +40,11 @@ import numpy as np
 import itertools
 from os import path
 
-from example_scripts.downsampler import downsample_grid
+import pytest
+
+from example_scripts.downsampler import downsample_grid, downsample_file, \
+    downsample_pyramid, downsample_pyramid_file, power_of_two_gridsizes, \
+    main, read_bricked_grid, read_grid, read_pyramid, write_bricked_grid
 
 # Save the path to this directory
 dirpath = path.dirname(__file__)
@@ -298,3 +302,662 @@ def test_random(input_gridsize=128, output_gridsize=64,
 
     # Now run some unit tests that check some properties.
     unit_tests(output_grid, output_gridsize)
+
+
+@pytest.mark.parametrize("input_gridsize, output_gridsize",
+                         [(12, 6), (12, 4), (12, 3), (16, 4), (9, 1)])
+def test_block_alignment(input_gridsize, output_gridsize):
+    """
+    Each output cell should be the average of a (wrapped) block of input cells, centred
+    the same way as the periodic convolution the downsampler originally used. Check this
+    for odd and even conversion factors against a direct calculation.
+
+    Parameters
+    ----------
+
+    input_gridsize, output_gridsize : int
+        1D size of the input/output grids.
+    """
+
+    conversion = input_gridsize // output_gridsize
+    shift = (conversion - 1) // 2
+
+    np.random.seed(12)
+    input_grid = np.random.rand(input_gridsize, input_gridsize, input_gridsize)
+
+    output_grid = downsample_grid(input_grid, output_gridsize)
+
+    rolled = np.roll(input_grid, (shift, shift, shift), axis=(0, 1, 2))
+    expected_grid = rolled.reshape(output_gridsize, conversion,
+                                   output_gridsize, conversion,
+                                   output_gridsize, conversion).mean(axis=(1, 3, 5))
+
+    assert(np.allclose(output_grid, expected_grid, rtol=0.0, atol=1e-14))
+    unit_tests(output_grid, output_gridsize)
+
+
+@pytest.mark.parametrize("precision, dtype", [("double", np.float64),
+                                              ("float", np.float32)])
+def test_downsample_file(tmp_path, precision, dtype, input_gridsize=24,
+                         output_gridsize=8):
+    """
+    Downsampling a grid file slab by slab should write exactly the same grid as
+    downsampling the whole grid in memory.
+
+    Parameters
+    ----------
+
+    precision : String
+        Precision of the input grid written to file.
+
+    dtype : `~numpy.dtype`
+        The numpy datatype matching `precision`.
+
+    input_gridsize, output_gridsize : int, optional
+        1D size of the input/output grids.  Default : 24 and 8.
+    """
+
+    fname_in = str(tmp_path / "grid_in.bin")
+    fname_out = str(tmp_path / "grid_out.bin")
+
+    np.random.seed(12)
+    input_grid = np.random.rand(input_gridsize, input_gridsize,
+                                input_gridsize).astype(dtype)
+    input_grid.tofile(fname_in)
+
+    downsample_file(fname_in, fname_out, input_gridsize, output_gridsize,
+                    precision)
+
+    # The output grid keeps the precision of the input grid.
+    output_grid = np.fromfile(fname_out, dtype=dtype)
+    output_grid.shape = (output_gridsize, output_gridsize, output_gridsize)
+
+    assert(np.array_equal(output_grid,
+                          downsample_grid(input_grid, output_gridsize)))
+
+
+@pytest.mark.parametrize("input_dtype, dtype, accumulator, expected_dtype",
+                         [(np.float32, None, np.float64, np.float32),
+                          (np.float64, None, np.float64, np.float64),
+                          (np.int32, None, np.float64, np.float64),
+                          (np.float32, np.float64, np.float64, np.float64),
+                          (np.float64, np.float32, np.float32, np.float32)])
+def test_precision(input_dtype, dtype, accumulator, expected_dtype,
+                   input_gridsize=16, output_gridsize=4):
+    """
+    Floating point grids should keep their precision when downsampled, integer
+    grids should be averaged into doubles and the output/accumulator datatypes
+    can be chosen explicitly.
+
+    Parameters
+    ----------
+
+    input_dtype : `~numpy.dtype`
+        Datatype of the input grid.
+
+    dtype, accumulator : `~numpy.dtype`
+        Output and accumulator datatypes passed to `downsample_grid`.
+
+    expected_dtype : `~numpy.dtype`
+        Datatype the output grid should have.
+
+    input_gridsize, output_gridsize : int, optional
+        1D size of the input/output grids.  Default : 16 and 4.
+    """
+
+    np.random.seed(15)
+    input_grid = (np.random.rand(input_gridsize, input_gridsize,
+                                 input_gridsize) * 100).astype(input_dtype)
+
+    output_grid = downsample_grid(input_grid, output_gridsize, dtype=dtype,
+                                  accumulator=accumulator)
+
+    # The averages should only lose the precision of the output datatype.
+    conversion = input_gridsize // output_gridsize
+    shift = (conversion - 1) // 2
+
+    rolled = np.roll(input_grid.astype(np.float64), (shift, shift, shift),
+                     axis=(0, 1, 2))
+    expected_grid = rolled.reshape(output_gridsize, conversion,
+                                   output_gridsize, conversion,
+                                   output_gridsize, conversion).mean(axis=(1, 3, 5))
+
+    rtol = np.finfo(expected_dtype).eps * 10
+    assert(np.allclose(output_grid, expected_grid, rtol=rtol, atol=0.0))
+    unit_tests(output_grid, output_gridsize, expected_dtype)
+
+
+def test_precision_accumulator(input_gridsize=8, output_gridsize=4):
+    """
+    Summing a floating point grid with an integer accumulator would silently
+    truncate it, so a ValueError should be raised.
+    """
+
+    input_grid = np.ones((input_gridsize, input_gridsize, input_gridsize),
+                         dtype=np.float32)
+
+    with pytest.raises(ValueError):
+        downsample_grid(input_grid, output_gridsize, accumulator=np.int32)
+
+
+def test_read_grid_memmap(tmp_path, input_gridsize=16, output_gridsize=4):
+    """
+    Reading a grid as a memory map should give a read-only view with the same
+    values as reading it into memory, and downsampling it should give the same
+    answer.
+
+    Parameters
+    ----------
+
+    input_gridsize, output_gridsize : int, optional
+        1D size of the input/output grids.  Default : 16 and 4.
+    """
+
+    fname = str(tmp_path / "grid.bin")
+
+    np.random.seed(12)
+    np.random.rand(input_gridsize, input_gridsize,
+                   input_gridsize).astype(np.float32).tofile(fname)
+
+    grid = read_grid(fname, input_gridsize, "float")
+    mapped_grid = read_grid(fname, input_gridsize, "float", memmap=True)
+
+    assert(isinstance(mapped_grid, np.memmap))
+    assert(not mapped_grid.flags.writeable)
+    assert(mapped_grid.shape == grid.shape and mapped_grid.dtype == grid.dtype)
+    assert(np.array_equal(mapped_grid, grid))
+
+    assert(np.array_equal(downsample_grid(mapped_grid, output_gridsize),
+                          downsample_grid(grid, output_gridsize)))
+
+    # The size of the file is still checked.
+    with pytest.raises(RuntimeError):
+        read_grid(fname, input_gridsize + 1, "float", memmap=True)
+
+
+@pytest.mark.parametrize("workers, backend, use_memmap",
+                         [(3, "thread", False), (2, "process", False),
+                          (2, "process", True)])
+def test_parallel(tmp_path, workers, backend, use_memmap, input_gridsize=24,
+                  output_gridsize=8):
+    """
+    Downsampling in parallel should give a grid bit-for-bit identical to the
+    serial result, whether the input is in memory or memory mapped.
+
+    Parameters
+    ----------
+
+    workers : int
+        Number of workers.
+
+    backend : String
+        Either "thread" or "process".
+
+    use_memmap : Boolean
+        If True, the input grid is memory mapped from a file.
+
+    input_gridsize, output_gridsize : int, optional
+        1D size of the input/output grids.  Default : 24 and 8.
+    """
+
+    np.random.seed(12)
+    input_grid = np.random.rand(input_gridsize, input_gridsize, input_gridsize)
+
+    if use_memmap:
+        fname = str(tmp_path / "grid.bin")
+        input_grid.tofile(fname)
+        input_grid = read_grid(fname, input_gridsize, "double", memmap=True)
+
+    serial_grid = downsample_grid(input_grid, output_gridsize)
+    parallel_grid = downsample_grid(input_grid, output_gridsize,
+                                    workers=workers, backend=backend)
+
+    assert(np.array_equal(serial_grid, parallel_grid))
+
+
+@pytest.mark.parametrize("separate_files", [False, True])
+def test_pyramid(tmp_path, separate_files, input_gridsize=24):
+    """
+    Each level of a pyramid should be the downsampled previous level, and
+    writing the pyramid to file(s) should give exactly the same grids.
+
+    Parameters
+    ----------
+
+    separate_files : Boolean
+        If True, each level is written to its own file.  Otherwise, all the
+        levels are written to one file.
+
+    input_gridsize : int, optional
+        1D size of the input grid.  Default : 24.
+    """
+
+    gridsizes = [3, 12, 6]
+
+    fname_in = str(tmp_path / "grid_in.bin")
+    fname_out = str(tmp_path / "pyramid.bin")
+
+    np.random.seed(16)
+    input_grid = np.random.rand(input_gridsize, input_gridsize,
+                                input_gridsize).astype(np.float32)
+    input_grid.tofile(fname_in)
+
+    # Levels are returned from largest to smallest.
+    output_grids = downsample_pyramid(input_grid, gridsizes)
+    assert([grid.shape[0] for grid in output_grids] == [12, 6, 3])
+
+    expected_grid = input_grid
+    for output_grid in output_grids:
+        expected_grid = downsample_grid(expected_grid, output_grid.shape[0])
+        assert(np.array_equal(output_grid, expected_grid))
+        unit_tests(output_grid, output_grid.shape[0], np.float32)
+
+    if separate_files:
+        fnames_out = ["{0}_{1}".format(fname_out, gridsize)
+                      for gridsize in (12, 6, 3)]
+        downsample_pyramid_file(fname_in, fnames_out, input_gridsize,
+                                gridsizes, "float")
+        file_grids = [read_grid(fname, gridsize, "float") for
+                      (fname, gridsize) in zip(fnames_out, (12, 6, 3))]
+    else:
+        downsample_pyramid_file(fname_in, fname_out, input_gridsize,
+                                gridsizes, "float")
+        file_grids = read_pyramid(fname_out, gridsizes, "float")
+
+    for (file_grid, output_grid) in zip(file_grids, output_grids):
+        assert(np.array_equal(file_grid, output_grid))
+
+    # The gridsizes of a pyramid must nest.
+    with pytest.raises(RuntimeError):
+        downsample_pyramid(input_grid, [12, 8])
+
+
+def test_power_of_two_gridsizes():
+    """
+    The power of two levels should halve the gridsize until the minimum size
+    or an odd gridsize is reached.
+    """
+
+    assert(power_of_two_gridsizes(512, 64) == [256, 128, 64])
+    assert(power_of_two_gridsizes(24) == [12, 6, 3])
+    assert(power_of_two_gridsizes(7) == [])
+
+
+@pytest.mark.parametrize("input_shape, output_shape",
+                         [((12, 8, 4), (6, 2, 4)),
+                          ((9, 12, 16), (3, 3, 4)),
+                          ((16, 16, 4), (4, 4, 1))])
+def test_anisotropic(tmp_path, input_shape, output_shape):
+    """
+    Non-cubic grids should be downsampled by a different factor along each
+    dimension, with every block centred as for cubic grids.  Reading and
+    downsampling the grid from file should give the same answer.
+
+    Parameters
+    ----------
+
+    input_shape, output_shape : tuple of 3 ints
+        Shape of the input/output grids.
+    """
+
+    fname_in = str(tmp_path / "grid_in.bin")
+    fname_out = str(tmp_path / "grid_out.bin")
+
+    np.random.seed(17)
+    input_grid = np.random.rand(*input_shape)
+    input_grid.tofile(fname_in)
+
+    output_grid = downsample_grid(input_grid, output_shape, workers=2)
+    assert(output_grid.shape == output_shape)
+
+    factors = [size_in // size_out for (size_in, size_out) in
+               zip(input_shape, output_shape)]
+    shifts = [(factor - 1) // 2 for factor in factors]
+
+    rolled = np.roll(input_grid, shifts, axis=(0, 1, 2))
+    expected_grid = rolled.reshape(output_shape[0], factors[0],
+                                   output_shape[1], factors[1],
+                                   output_shape[2], factors[2]).mean(axis=(1, 3, 5))
+
+    assert(np.allclose(output_grid, expected_grid, rtol=0.0, atol=1e-14))
+
+    assert(np.array_equal(read_grid(fname_in, input_shape, "double"),
+                          input_grid))
+
+    downsample_file(fname_in, fname_out, input_shape, output_shape, "double")
+    assert(np.array_equal(read_grid(fname_out, output_shape, "double"),
+                          output_grid))
+
+    # Every dimension must be a multiple of the output.
+    with pytest.raises(RuntimeError):
+        downsample_grid(input_grid, (input_shape[0], input_shape[1], 3))
+
+
+def block_reference(input_grid, output_gridsize, reduce_blocks):
+    """
+    Reduces each (wrapped, centred) block of a cubic grid directly, for
+    comparison with the downsampler.
+
+    Parameters
+    ----------
+
+    input_grid : `~numpy.ndarray`
+        The 3D grid being downsampled.
+
+    output_gridsize : int
+        1D size of the output grid.
+
+    reduce_blocks : function
+        Called with the blocks of the grid, arranged with shape
+        (output_gridsize, output_gridsize, output_gridsize, cells per block).
+
+    Returns
+    ----------
+
+    expected_grid : `~numpy.ndarray`
+        The reduced blocks.
+    """
+
+    conversion = input_grid.shape[0] // output_gridsize
+    shift = (conversion - 1) // 2
+
+    rolled = np.roll(input_grid, (shift, shift, shift), axis=(0, 1, 2))
+    blocks = rolled.reshape(output_gridsize, conversion,
+                            output_gridsize, conversion,
+                            output_gridsize, conversion)
+    blocks = blocks.transpose(0, 2, 4, 1, 3, 5).reshape(output_gridsize,
+                                                        output_gridsize,
+                                                        output_gridsize, -1)
+
+    return reduce_blocks(blocks)
+
+
+def top_cell(blocks, weights, reduction):
+    """
+    A custom kernel that picks the first cell of each block.
+    """
+
+    return blocks[:, 0, :, 0, :, 0]
+
+
+@pytest.mark.parametrize("kernel, reduce_blocks",
+                         [("sum", lambda blocks: blocks.sum(axis=-1)),
+                          ("max", lambda blocks: blocks.max(axis=-1)),
+                          ("min", lambda blocks: blocks.min(axis=-1)),
+                          ("median", lambda blocks: np.median(blocks, axis=-1)),
+                          (top_cell, lambda blocks: blocks[..., 0])])
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_kernels(kernel, reduce_blocks, backend, input_gridsize=12,
+                 output_gridsize=4):
+    """
+    Each kernel should reduce every block of the input grid, for every backend.
+
+    Parameters
+    ----------
+
+    kernel : String or function
+        Kernel passed to `downsample_grid`.
+
+    reduce_blocks : function
+        The same reduction, for `block_reference`.
+
+    backend : String
+        Backend passed to `downsample_grid`.
+
+    input_gridsize, output_gridsize : int, optional
+        1D size of the input/output grids.  Default : 12 and 4.
+    """
+
+    np.random.seed(18)
+    input_grid = np.random.rand(input_gridsize, input_gridsize, input_gridsize)
+
+    output_grid = downsample_grid(input_grid, output_gridsize, workers=2,
+                                  backend=backend, kernel=kernel)
+    expected_grid = block_reference(input_grid, output_gridsize, reduce_blocks)
+
+    assert(np.allclose(output_grid, expected_grid, rtol=0.0, atol=1e-13))
+    unit_tests(output_grid, output_gridsize)
+
+
+def test_weighted_mean(tmp_path, input_gridsize=16, output_gridsize=4):
+    """
+    The weighted mean should weight each cell by a second grid, streamed
+    alongside the input when downsampling files, and a pyramid should weight
+    each level by the summed weights of the previous level.
+    """
+
+    fname_in = str(tmp_path / "grid_in.bin")
+    fname_weights = str(tmp_path / "weights.bin")
+    fname_out = str(tmp_path / "grid_out.bin")
+
+    np.random.seed(18)
+    input_grid = np.random.rand(input_gridsize, input_gridsize, input_gridsize)
+    weights = np.random.rand(input_gridsize, input_gridsize, input_gridsize)
+    input_grid.tofile(fname_in)
+    weights.tofile(fname_weights)
+
+    output_grid = downsample_grid(input_grid, output_gridsize,
+                                  kernel="weighted_mean", weights=weights)
+
+    weighted_sums = block_reference(input_grid * weights, output_gridsize,
+                                    lambda blocks: blocks.sum(axis=-1))
+    weight_sums = block_reference(weights, output_gridsize,
+                                  lambda blocks: blocks.sum(axis=-1))
+    assert(np.allclose(output_grid, weighted_sums / weight_sums, rtol=1e-14,
+                       atol=0.0))
+
+    # Uniform weights give the mean.
+    assert(np.allclose(downsample_grid(input_grid, output_gridsize,
+                                       kernel="weighted_mean",
+                                       weights=np.ones_like(input_grid)),
+                       downsample_grid(input_grid, output_gridsize),
+                       rtol=1e-14, atol=0.0))
+
+    for backend in ("thread", "process"):
+        downsample_file(fname_in, fname_out, input_gridsize, output_gridsize,
+                        "double", workers=2, backend=backend,
+                        kernel="weighted_mean", fname_weights=fname_weights)
+        assert(np.array_equal(read_grid(fname_out, output_gridsize, "double"),
+                              output_grid))
+
+    # Halving twice weights each 4x4x4 block (aligned at 0) in total.
+    pyramid = downsample_pyramid(input_grid, [8, 4], kernel="weighted_mean",
+                                 weights=weights)
+
+    weighted_sums = (input_grid * weights).reshape(4, 4, 4, 4, 4, 4)
+    weight_sums = weights.reshape(4, 4, 4, 4, 4, 4)
+    expected_grid = weighted_sums.sum(axis=(1, 3, 5)) / \
+                    weight_sums.sum(axis=(1, 3, 5))
+    assert(np.allclose(pyramid[1], expected_grid, rtol=1e-14, atol=0.0))
+
+    downsample_pyramid_file(fname_in, fname_out, input_gridsize, [8, 4],
+                            "double", kernel="weighted_mean",
+                            fname_weights=fname_weights)
+    for (file_grid, grid) in zip(read_pyramid(fname_out, [8, 4], "double"),
+                                 pyramid):
+        assert(np.array_equal(file_grid, grid))
+
+    # The weighted mean needs weights and the kernel must exist.
+    with pytest.raises(ValueError):
+        downsample_grid(input_grid, output_gridsize, kernel="weighted_mean")
+
+    with pytest.raises(ValueError):
+        downsample_grid(input_grid, output_gridsize, kernel="mode")
+
+
+def test_main(tmp_path, input_gridsize=8, output_gridsize=4):
+    """
+    The command line tool should downsample every grid matching a glob into the
+    output directory and return 0, return 1 if any grid fails and return 2 for
+    invalid arguments.
+    """
+
+    np.random.seed(19)
+    input_grids = []
+    for grid_num in range(3):
+        input_grid = np.random.rand(input_gridsize, input_gridsize,
+                                    input_gridsize)
+        input_grid.tofile(str(tmp_path / "grid_{0}.bin".format(grid_num)))
+        input_grids.append(input_grid)
+
+    output_dir = tmp_path / "output"
+    argv = ["-f", str(tmp_path / "grid_*.bin"), "-o", str(output_dir),
+            "-p", "double", "-s", str(input_gridsize),
+            "-d", str(output_gridsize), "-j", "2"]
+    assert(main(argv) == 0)
+
+    for (grid_num, input_grid) in enumerate(input_grids):
+        fname_out = str(output_dir / "grid_{0}.bin".format(grid_num))
+        assert(np.array_equal(read_grid(fname_out, output_gridsize, "double"),
+                              downsample_grid(input_grid, output_gridsize)))
+
+    # A single input is written to the output file itself.
+    fname_out = str(tmp_path / "single.bin")
+    argv = ["-f", str(tmp_path / "grid_0.bin"), "-o", fname_out,
+            "-p", "double", "-s", str(input_gridsize),
+            "-d", str(output_gridsize)]
+    assert(main(argv) == 0)
+    assert(np.array_equal(read_grid(fname_out, output_gridsize, "double"),
+                          downsample_grid(input_grids[0], output_gridsize)))
+
+    # Grids that are missing or the wrong size fail.
+    (tmp_path / "grid_3.bin").write_bytes(b"0" * 10)
+    argv = ["-f", str(tmp_path / "grid_*.bin"), str(tmp_path / "missing.bin"),
+            "-o", str(output_dir), "-p", "double", "-s", str(input_gridsize),
+            "-d", str(output_gridsize)]
+    assert(main(argv) == 1)
+
+    # Corrupt bricked grids fail without stopping the other grids.
+    bricked_dir = tmp_path / "bricked"
+    bricked_dir.mkdir()
+    write_bricked_grid(str(bricked_dir / "good.grd"), input_grids[0],
+                       brick_size=(4, 4, 4), compression="zlib")
+    data = bytearray((bricked_dir / "good.grd").read_bytes())
+    data[len(data) // 2:] = bytes(len(data) - len(data) // 2)
+    (bricked_dir / "corrupt.grd").write_bytes(bytes(data))
+    (bricked_dir / "truncated.grd").write_bytes(b"GRDBRK\x00\x01\x05")
+
+    argv = ["-f", str(bricked_dir / "*.grd"), "-o", str(output_dir),
+            "-p", "double", "-s", str(input_gridsize),
+            "-d", str(output_gridsize)]
+    assert(main(argv) == 1)
+    assert(np.array_equal(read_grid(str(output_dir / "good.grd"),
+                                    output_gridsize, "double"),
+                          downsample_grid(input_grids[0], output_gridsize)))
+
+    # Inputs from different directories with the same name would overwrite
+    # each other's output.
+    (bricked_dir / "grid_0.bin").write_bytes((tmp_path / "grid_0.bin")
+                                             .read_bytes())
+
+    # Invalid arguments.
+    for argv in (["-f", str(tmp_path / "none_*.bin"), "-o", fname_out,
+                  "-p", "double", "-s", "8", "-d", "4"],
+                 ["-f", fname_out, "-o", fname_out, "-p", "half", "-s", "8",
+                  "-d", "4"],
+                 ["-f", fname_out, "-o", fname_out, "-p", "double", "-s", "8",
+                  "-d", "3"],
+                 ["-f", fname_out, "-o", fname_out, "-p", "double",
+                  "--shape", "100", "100", "100", "--factors", "40", "40", "40"],
+                 ["-f", fname_out, "-o", fname_out, "-s", "eight"],
+                 ["-f", str(tmp_path / "grid_0.bin"),
+                  str(bricked_dir / "grid_0.bin"), "-o", str(output_dir),
+                  "-p", "double", "-s", "8", "-d", "4"],
+                 ["-f", str(tmp_path / "grid_*.bin"), "-o", fname_out,
+                  "-p", "double", "-s", "8", "-d", "4"]):
+        assert(main(argv) == 2)
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_bricked_grid(tmp_path, compression):
+    """
+    Reading a bricked grid (or any subvolume of it) should give the same cells
+    as the grid that was written, including for bricks clipped by the edge of
+    the grid.
+
+    Parameters
+    ----------
+
+    compression : String or None
+        Compression of the bricks.
+    """
+
+    fname = str(tmp_path / "grid.grd")
+
+    np.random.seed(20)
+    grid = np.random.rand(37, 20, 70).astype(np.float32)
+    write_bricked_grid(fname, grid, brick_size=(8, 16, 32),
+                       compression=compression)
+
+    bricked_grid = read_bricked_grid(fname)
+    assert(bricked_grid.shape == grid.shape)
+    assert(bricked_grid.dtype == grid.dtype)
+    assert(np.array_equal(np.asarray(bricked_grid), grid))
+
+    for key in [(slice(3, 30),), 5, (slice(None, None, -1), slice(2, 19, 3), -1),
+                (slice(30, 2, -4), Ellipsis, slice(60, 5, -7)),
+                (Ellipsis, 3), (slice(5, 5),), (-1, 0, 69)]:
+        assert(np.array_equal(bricked_grid[key], grid[key]))
+
+    assert(np.array_equal(bricked_grid.read_subvolume([8, 0, 30], [17, 16, 34]),
+                          grid[8:17, 0:16, 30:34]))
+
+    with pytest.raises(ValueError):
+        bricked_grid[37]
+
+    # Raw grids aren't bricked grids.
+    grid.tofile(str(tmp_path / "grid.bin"))
+    with pytest.raises(RuntimeError):
+        read_bricked_grid(str(tmp_path / "grid.bin"))
+
+
+@pytest.mark.parametrize("backend", ["thread", "process"])
+def test_bricked_downsampling(tmp_path, backend, input_gridsize=24,
+                              output_gridsize=6):
+    """
+    Downsampling a bricked grid, brick by brick, should give exactly the same
+    grid as downsampling it in memory, whichever format the output is written
+    in.
+
+    Parameters
+    ----------
+
+    backend : String
+        Backend used to downsample the grid.
+
+    input_gridsize, output_gridsize : int, optional
+        1D size of the input/output grids.  Default : 24 and 6.
+    """
+
+    fname_in = str(tmp_path / "grid_in.grd")
+    fname_raw = str(tmp_path / "grid_out.bin")
+    fname_bricks = str(tmp_path / "grid_out.grd")
+
+    np.random.seed(20)
+    input_grid = np.random.rand(input_gridsize, input_gridsize, input_gridsize)
+    write_bricked_grid(fname_in, input_grid, brick_size=8)
+
+    expected_grid = downsample_grid(input_grid, output_gridsize)
+
+    output_grid = downsample_grid(read_bricked_grid(fname_in), output_gridsize,
+                                  workers=2, backend=backend)
+    assert(np.array_equal(output_grid, expected_grid))
+
+    downsample_file(fname_in, fname_raw, input_gridsize, output_gridsize,
+                    "double", workers=2, backend=backend)
+    assert(np.array_equal(read_grid(fname_raw, output_gridsize, "double"),
+                          expected_grid))
+
+    downsample_file(fname_in, fname_bricks, input_gridsize, output_gridsize,
+                    "double", workers=2, backend=backend, fmt="bricks")
+    assert(np.array_equal(np.asarray(read_bricked_grid(fname_bricks)),
+                          expected_grid))
+
+    # Each level of a bricked pyramid is read back brick by brick.
+    fnames_out = [str(tmp_path / "level_{0}.grd".format(gridsize)) for
+                  gridsize in (12, 6)]
+    downsample_pyramid_file(fname_in, fnames_out, input_gridsize, [12, 6],
+                            "double", fmt="bricks")
+    for (fname, grid) in zip(fnames_out,
+                             downsample_pyramid(input_grid, [12, 6])):
+        assert(np.array_equal(np.asarray(read_bricked_grid(fname)), grid))
@@ -47,9 +47,28 @@ def test_gal_class():
 
     assert(gal.x == 0.5)
     assert(gal.y == -21.5)
-    #assert(gal.z == 142.4)
     assert(gal.mass == -20)
 
+    gal = galaxy.Galaxy(0.5, -21.5, 142.4, -20)
+
+    assert(gal.x == 0.5)
+    assert(gal.y == -21.5)
+    assert(gal.z == 142.4)
+    assert(gal.mass == -20)
+
+    # The position and mass can also be passed by keyword.
+    gal = galaxy.Galaxy(x=0.5, y=-21.5, mass=-20)
+    assert((gal.pos, gal.mass) == ([0.5, -21.5], -20))
+
+    gal = galaxy.Galaxy(0.5, -21.5, 142.4, mass=-20)
+    assert((gal.pos, gal.mass) == ([0.5, -21.5, 142.4], -20))
+
+    gal = galaxy.Galaxy(0.5, mass=-20)
+    assert((gal.pos, gal.mass) == ([0.5], -20))
+
+    with pytest.raises(ValueError):
+        galaxy.Galaxy(0.5)
+
 
 @pytest.mark.parametrize(
         "x_bound, y_bound, expected_mass, expected_N, seed",
@@ -112,3 +131,826 @@ def test_mass_in_region(x_bound, y_bound, expected_mass, expected_N, seed):
         # Is this enough for a debug message...?
         print("Tests for testing seeds other than 777 not implemented.")
         assert False
+
+
+def test_catalog_views():
+    """
+    A ``GalaxyCatalog`` should behave like the list of ``Galaxy`` instances it replaces:
+    integer indexing and iteration give ``Galaxy`` instances holding the right values.
+    These are read-only, as changing them couldn't change the catalog.
+    """
+
+    import numpy as np
+
+    gals = [galaxy.Galaxy(1.0, 2.0, 3.0), galaxy.Galaxy(4.0, 5.0, 6.0),
+            galaxy.Galaxy(7.0, 8.0, 9.0)]
+    cat = galaxy.GalaxyCatalog.from_galaxies(gals)
+
+    assert(len(cat) == 3)
+    assert(np.array_equal(cat.x, [1.0, 4.0, 7.0]))
+
+    gal = cat[1]
+    assert(isinstance(gal, galaxy.Galaxy))
+    assert(gal.x == 4.0 and gal.y == 5.0 and gal.mass == 6.0)
+
+    for gal_list, gal_cat in zip(gals, cat):
+        assert((gal_list.x, gal_list.y, gal_list.mass) == (gal_cat.x, gal_cat.y,
+                                                           gal_cat.mass))
+
+    # The galaxies are read-only copies, so changing them raises rather than being lost.
+    for attribute in ("x", "y", "mass", "pos"):
+        with pytest.raises(AttributeError):
+            setattr(cat[1], attribute, 10.0)
+    with pytest.raises(TypeError):
+        cat[1].pos[0] = 10.0
+    with pytest.raises(AttributeError):
+        next(iter(cat)).mass = 10.0
+    assert(np.array_equal(cat.mass, [3.0, 6.0, 9.0]))
+
+    # Slicing gives back a catalog rather than a single galaxy.
+    assert(isinstance(cat[1:], galaxy.GalaxyCatalog))
+    assert(len(cat[1:]) == 2)
+
+    # Lists of galaxies and catalogs should give the same answer.
+    assert(galaxy.mass_within_region(gals, [0, 5], [0, 5]) ==
+           galaxy.mass_within_region(cat, [0, 5], [0, 5]))
+
+    # Rows are changed through the catalog instead.
+    with cat.modify():
+        cat.mass[1] = 10.0
+    assert(cat[1].mass == 10.0)
+
+
+def test_write_read_roundtrip(tmp_path):
+    """
+    Galaxies written using ``generate_random_data`` should be read back with the same
+    values and header information.
+    """
+
+    import numpy as np
+
+    fname = str(tmp_path / "gals.txt")
+
+    galaxy.generate_random_data(N=50, seed=777, fname_out=fname)
+    gals = galaxy.read_data(fname)
+
+    known_gals = galaxy.generate_random_data(N=50, seed=777)
+
+    assert(len(gals) == 50)
+    assert(np.allclose(gals.x, known_gals.x))
+    assert(np.allclose(gals.y, known_gals.y))
+    assert(np.allclose(gals.mass, known_gals.mass))
+
+    assert(gals.boxsize == 100.0)
+    assert(gals.mass_factor == 1.0)
+    assert(gals.seed == 777)
+
+
+@pytest.mark.parametrize(
+        "x_bound, y_bound, expected_mass, expected_N",
+        [([1.0, 2.0], [1.0, 3.0], 7.0, 3),  # Galaxies on every edge are included.
+         ([1.5, 1.9], [0.0, 10.0], 0.0, 0),  # No galaxies in the region.
+         ([-10.0, 10.0], [-10.0, 10.0], 15.0, 5)]
+        )
+def test_region_boundaries(x_bound, y_bound, expected_mass, expected_N):
+    """
+    The bounds passed to ``mass_within_region`` are inclusive. Place galaxies exactly on
+    the edges of the region and ensure they're counted.
+    """
+
+    cat = galaxy.GalaxyCatalog([0.0, 1.0, 2.0, 1.0, 5.0],
+                               [1.0, 1.0, 3.0, 3.0, 1.0],
+                               [1.0, 2.0, 3.0, 2.0, 7.0])
+
+    mass_in_region, N_in_region = galaxy.mass_within_region(cat, x_bound, y_bound)
+
+    assert(mass_in_region == expected_mass)
+    assert(N_in_region == expected_N)
+
+
+def test_matches_loop(tmp_path):
+    """
+    The mass should be exactly that of adding the galaxies up one at a time in a Python
+    loop, to the last bit, however the galaxies are chunked. With ``workers`` the block
+    sums are added instead, which agrees to rounding.
+    """
+
+    import numpy as np
+
+    N = 200000
+    fname = str(tmp_path / "gals.bin")
+    galaxy.generate_random_data(N=N, seed=777, fname_out=fname, fmt="binary")
+    gals = galaxy.read_data(fname)
+
+    x_bound, y_bound = [0.0, 90.0], [5.0, 95.0]
+
+    mass_in_region = 0.0
+    N_in_region = 0
+    for x, y, mass in zip(gals.x.tolist(), gals.y.tolist(), gals.mass.tolist()):
+        if x_bound[0] <= x <= x_bound[1] and y_bound[0] <= y <= y_bound[1]:
+            mass_in_region += mass
+            N_in_region += 1
+
+    # Make sure a pairwise sum would actually differ.
+    selected = ((gals.x >= x_bound[0]) & (gals.x <= x_bound[1]) &
+                (gals.y >= y_bound[0]) & (gals.y <= y_bound[1]))
+    assert(gals.mass[selected].sum() != mass_in_region)
+
+    expected = (mass_in_region, N_in_region)
+    assert(galaxy.mass_within_region(gals, x_bound, y_bound) == expected)
+    assert(galaxy.mass_within_region(galaxy.read_data_chunks(fname, chunk_size=12345),
+                                     x_bound, y_bound) == expected)
+
+    region_bounds = np.array([[x_bound, y_bound]])
+    masses, counts = galaxy.mass_within_regions(gals, region_bounds)
+    assert((masses[0], counts[0]) == expected)
+    masses, counts = galaxy.mass_within_regions(
+        galaxy.read_data_chunks(fname, chunk_size=12345), region_bounds)
+    assert((masses[0], counts[0]) == expected)
+
+    parallel_mass, parallel_N = galaxy.mass_within_region(gals, x_bound, y_bound,
+                                                          workers=2)
+    assert(np.isclose(parallel_mass, mass_in_region, rtol=1e-12, atol=0.0))
+    assert(parallel_N == N_in_region)
+
+
+def test_batch_regions():
+    """
+    Querying many regions at once should give exactly the same answer as querying each
+    region individually.
+    """
+
+    import numpy as np
+
+    gals = galaxy.generate_random_data(N=5000, seed=777)
+
+    rng = np.random.RandomState(12)
+    lower = rng.uniform(0.0, 80.0, size=(20, 2))
+    width = rng.uniform(0.0, 30.0, size=(20, 2))
+    region_bounds = np.stack([lower, lower + width], axis=2)
+
+    # Add a region whose bounds sit exactly on a galaxy.
+    region_bounds[0] = [[gals.x[0], gals.x[0] + 10.0], [gals.y[0] - 10.0, gals.y[0]]]
+
+    masses, counts = galaxy.mass_within_regions(gals, region_bounds)
+
+    for (x_bound, y_bound), mass_in_region, N_in_region in zip(region_bounds, masses,
+                                                               counts):
+        assert((mass_in_region, N_in_region) ==
+               galaxy.mass_within_region(gals, x_bound, y_bound))
+
+
+def test_index(tmp_path):
+    """
+    Region queries answered by a ``GalaxyIndex`` should match a scan over every galaxy,
+    both when the index is freshly built and when it's reloaded from disk.
+    """
+
+    import numpy as np
+
+    fname = str(tmp_path / "gals.txt")
+    galaxy.generate_random_data(N=5000, seed=777, fname_out=fname)
+    gals = galaxy.read_data(fname)
+
+    # The first call builds and saves the index, the second reloads it.
+    built_index = galaxy.GalaxyIndex.for_file(fname, cells_per_dim=8)
+    loaded_index = galaxy.GalaxyIndex.for_file(fname)
+    assert(loaded_index.cells_per_dim == 8)
+    assert(loaded_index.catalog_header["seed"] == 777)
+
+    # Asking for a different grid rebuilds the saved index rather than ignoring it.
+    assert(galaxy.GalaxyIndex.for_file(fname, cells_per_dim=4).cells_per_dim == 4)
+    assert(galaxy.GalaxyIndex.for_file(fname).cells_per_dim == 4)
+    assert(galaxy.GalaxyIndex.for_file(fname, boxsize=200.0).boxsize == 200.0)
+
+    # Index files are loaded without unpickling, so planted objects are refused.
+    fname_pickled = str(tmp_path / "pickled.index.npz")
+    with np.load("{0}.index.npz".format(fname)) as data:
+        arrays = dict(data)
+    arrays["catalog_header"] = np.array([100.0, 1.0, 777], dtype=object)
+    np.savez(fname_pickled, **arrays)
+
+    with pytest.raises(ValueError):
+        galaxy.GalaxyIndex.load(fname_pickled)
+
+    # Bounds that sit exactly on galaxies and span a few cells.
+    region_bounds = [([0, 50.0], [23.0, 28.0]),
+                     (sorted(gals.x[0:2]), sorted(gals.y[2:4])),
+                     ([-10.0, 200.0], [-10.0, 200.0]),
+                     ([40.0, 30.0], [0.0, 100.0])]
+
+    for x_bound, y_bound in region_bounds:
+        expected_mass, expected_N = galaxy.mass_within_region(gals, x_bound, y_bound)
+
+        for index in (built_index, loaded_index):
+            mass_in_region, N_in_region = galaxy.mass_within_region(index, x_bound,
+                                                                    y_bound)
+            assert(np.allclose(mass_in_region, expected_mass))
+            assert(N_in_region == expected_N)
+
+
+def test_index_approximate():
+    """
+    When the region bounds fall on the edges of the index cells, the approximate
+    (summed-area table only) query should count the same galaxies as a full scan.
+    """
+
+    import numpy as np
+
+    gals = galaxy.generate_random_data(N=5000, seed=777)
+    index = galaxy.GalaxyIndex(gals, cells_per_dim=10)
+
+    # Cells are 10 units wide. The upper bounds are nudged down so galaxies sitting
+    # exactly on the next cell edge aren't counted by the full scan.
+    x_bound = [20.0, np.nextafter(60.0, 0)]
+    y_bound = [0.0, np.nextafter(30.0, 0)]
+
+    expected_mass, expected_N = galaxy.mass_within_region(gals, x_bound, y_bound)
+    mass_in_region, N_in_region = index.mass_within_region(x_bound, y_bound,
+                                                           approximate=True)
+
+    assert(np.allclose(mass_in_region, expected_mass))
+    assert(N_in_region == expected_N)
+
+
+def test_binary_roundtrip(tmp_path):
+    """
+    Galaxies written in the binary format should be memory mapped back with the same values
+    and header information, and give the same answers as galaxies kept in memory.
+    """
+
+    import numpy as np
+
+    fname = str(tmp_path / "gals.bin")
+
+    galaxy.generate_random_data(N=1000, seed=777, fname_out=fname, fmt="binary")
+    gals = galaxy.read_data(fname)
+
+    known_gals = galaxy.generate_random_data(N=1000, seed=777)
+
+    assert(isinstance(gals.mass, np.memmap))
+    assert(np.array_equal(gals.x, known_gals.x))
+    assert(np.array_equal(gals.y, known_gals.y))
+    assert(np.array_equal(gals.mass, known_gals.mass))
+    assert((gals.boxsize, gals.mass_factor, gals.seed) == (100.0, 1.0, 777))
+
+    assert(galaxy.mass_within_region(gals, [0, 50.0], [23.0, 28.0]) ==
+           galaxy.mass_within_region(known_gals, [0, 50.0], [23.0, 28.0]))
+
+    # An empty catalog can't be memory mapped but should still be readable.
+    galaxy.write_galaxies(known_gals[:0], fname, 100.0, 1.0, fmt="binary")
+    assert(len(galaxy.read_data(fname)) == 0)
+
+    # numpy scalars in the header should be written as their Python equivalents.
+    galaxy.generate_random_data(N=10, seed=np.int64(5), boxsize=np.float32(100.),
+                                fname_out=fname, fmt="binary")
+    gals = galaxy.read_data(fname)
+
+    assert((gals.boxsize, gals.seed) == (100.0, 5))
+    assert(np.array_equal(gals.mass, galaxy.generate_random_data(N=10, seed=5).mass))
+
+    # A header that can't be encoded shouldn't leave a truncated file behind.
+    fname_bad = tmp_path / "bad.bin"
+
+    with pytest.raises(TypeError):
+        galaxy.write_galaxies(known_gals, str(fname_bad), 100.0, 1.0, seed=object(),
+                              fmt="binary")
+
+    assert(not fname_bad.exists())
+
+
+def test_text_format(tmp_path):
+    """
+    The text writer formats whole chunks of galaxies at once. Make sure the file still
+    holds the same header and values as writing each galaxy individually.
+    """
+
+    fname = str(tmp_path / "gals.txt")
+
+    gals = galaxy.generate_random_data(N=10, seed=777)
+    galaxy.write_galaxies(gals, fname, 100.0, 1.0, 777)
+
+    expected_lines = ["# boxsize 100.0", "# mass_factor 1.0", "# seed 777", "# ndim 2",
+                      "# x\ty\tMass"]
+    expected_lines += ["{0} {1} {2}".format(gal.x, gal.y, gal.mass) for gal in gals]
+
+    with open(fname, "r") as f_in:
+        assert(f_in.read().splitlines() == expected_lines)
+
+
+@pytest.mark.parametrize("fmt", ["text", "binary"])
+def test_read_chunks(tmp_path, monkeypatch, fmt):
+    """
+    Reading a file in chunks and streaming them through ``mass_within_region`` should give
+    exactly the same answer as reading the whole file at once, even when the chunks don't
+    line up with the blocks the masses are summed in.
+    """
+
+    import numpy as np
+
+    # Use small blocks so they span multiple chunks.
+    monkeypatch.setattr(galaxy, "_REDUCTION_BLOCK", 64)
+
+    fname = str(tmp_path / "gals.{0}".format(fmt))
+    galaxy.generate_random_data(N=1000, seed=777, fname_out=fname, fmt=fmt)
+    gals = galaxy.read_data(fname)
+
+    chunks = list(galaxy.read_data_chunks(fname, chunk_size=101))
+    assert([len(chunk) for chunk in chunks] == [101] * 9 + [91])
+    assert(np.array_equal(np.concatenate([chunk.mass for chunk in chunks]), gals.mass))
+
+    expected = galaxy.mass_within_region(gals, [0, 50.0], [23.0, 28.0])
+    streamed = galaxy.mass_within_region(galaxy.read_data_chunks(fname, chunk_size=101),
+                                         [0, 50.0], [23.0, 28.0])
+    assert(streamed == expected)
+
+
+@pytest.mark.parametrize("fmt", ["text", "binary"])
+def test_parallel_chunks(tmp_path, fmt):
+    """
+    Streamed chunks should be handed to the worker processes and give exactly the same
+    answer as the whole catalog, for one region or many, even though the chunks don't
+    line up with the blocks the workers sum.
+    """
+
+    import numpy as np
+
+    fname = str(tmp_path / "gals.{0}".format(fmt))
+    galaxy.generate_random_data(N=2 * galaxy._REDUCTION_BLOCK + 7, seed=777,
+                                fname_out=fname, fmt=fmt)
+    gals = galaxy.read_data(fname)
+
+    def chunks():
+        return galaxy.read_data_chunks(fname, chunk_size=50001)
+
+    expected = galaxy.mass_within_region(gals, [0, 50.0], [23.0, 28.0], workers=1)
+    streamed = galaxy.mass_within_region(chunks(), [0, 50.0], [23.0, 28.0], workers=2)
+    assert(streamed == expected)
+
+    region_bounds = np.array([[[0, 50.0], [23.0, 28.0]], [[10.0, 90.0], [5.0, 95.0]]])
+
+    for workers in (None, 2):
+        expected_masses, expected_counts = galaxy.mass_within_regions(gals, region_bounds,
+                                                                      workers=workers)
+        masses, counts = galaxy.mass_within_regions(chunks(), region_bounds,
+                                                    workers=workers)
+        assert(np.array_equal(masses, expected_masses))
+        assert(np.array_equal(counts, expected_counts))
+
+    centres, radii = np.array([[50.0, 50.0], [5.0, 95.0]]), [20.0, 30.0]
+    masses, counts = galaxy.mass_within_apertures(chunks(), centres, radii, workers=2,
+                                                  periodic=True)
+    assert((masses[1], counts[1]) ==
+           galaxy.mass_within_aperture(gals, centres[1], radii[1], workers=1,
+                                       periodic=True))
+
+
+@pytest.mark.parametrize("fmt", [None, "binary"])
+def test_parallel_regions(tmp_path, fmt):
+    """
+    Splitting the galaxies across worker processes should give exactly the same answer,
+    whatever the number of workers, and agree with the one-at-a-time sum to rounding.
+    Tested with galaxies held in memory and memory mapped from a binary file.
+    """
+
+    import numpy as np
+
+    # Enough galaxies for a few reduction blocks.
+    N = 3 * galaxy._REDUCTION_BLOCK + 5
+
+    if fmt is None:
+        gals = galaxy.generate_random_data(N=N, seed=777)
+    else:
+        fname = str(tmp_path / "gals.bin")
+        galaxy.generate_random_data(N=N, seed=777, fname_out=fname, fmt=fmt)
+        gals = galaxy.read_data(fname)
+
+    x_bound, y_bound = [0, 50.0], [23.0, 28.0]
+    expected = galaxy.mass_within_region(gals, x_bound, y_bound, workers=1)
+
+    for workers in (2, 3):
+        assert(galaxy.mass_within_region(gals, x_bound, y_bound, workers=workers) ==
+               expected)
+
+    serial_mass, serial_N = galaxy.mass_within_region(gals, x_bound, y_bound)
+    assert(np.isclose(expected[0], serial_mass, rtol=1e-12, atol=0.0))
+    assert(expected[1] == serial_N)
+
+    region_bounds = np.array([[x_bound, y_bound], [[10.0, 90.0], [5.0, 95.0]]])
+    for workers in (1, 2, 3):
+        masses, counts = galaxy.mass_within_regions(gals, region_bounds, workers=workers)
+
+        assert((masses[0], counts[0]) == expected)
+        assert((masses[1], counts[1]) ==
+               galaxy.mass_within_region(gals, [10.0, 90.0], [5.0, 95.0], workers=1))
+
+
+@pytest.mark.parametrize("fmt", ["text", "binary"])
+def test_streamed_generation(tmp_path, monkeypatch, fmt):
+    """
+    Galaxies streamed to file in chunks should be identical to those generated in memory
+    using the same seed or generator. Generating galaxies shouldn't touch the global
+    ``numpy.random`` state.
+    """
+
+    import numpy as np
+
+    # Use small chunks so the galaxies are written over several of them.
+    monkeypatch.setattr(galaxy, "_GENERATE_CHUNK", 64)
+
+    fname = str(tmp_path / "gals.{0}".format(fmt))
+
+    np.random.seed(12)
+    galaxy.generate_random_data(N=1000, seed=777, fname_out=fname, fmt=fmt)
+    assert(np.random.uniform() == np.random.RandomState(12).uniform())
+
+    gals = galaxy.read_data(fname)
+    known_gals = galaxy.generate_random_data(N=1000, seed=777)
+    assert(np.array_equal(gals.x, known_gals.x))
+    assert(np.array_equal(gals.y, known_gals.y))
+    assert(np.array_equal(gals.mass, known_gals.mass))
+
+    galaxy.generate_random_data(N=1000, fname_out=fname, fmt=fmt,
+                                rng=np.random.default_rng(42))
+    gals = galaxy.read_data(fname)
+    known_gals = galaxy.generate_random_data(N=1000, rng=np.random.default_rng(42))
+    assert(np.array_equal(gals.mass, known_gals.mass))
+
+
+@pytest.mark.parametrize("fmt", ["text", "binary"])
+def test_3d_regions(tmp_path, fmt):
+    """
+    Catalogs with 3 spatial dimensions should give the same answer through the scan, the
+    index and the batched queries, and keep their dimensionality when written to file.
+    """
+
+    import numpy as np
+
+    gals = galaxy.generate_random_data(N=2000, seed=777, ndim=3)
+    assert(gals.ndim == 3 and gals.pos.shape == (2000, 3))
+
+    region_bounds = [[0, 50.0], [23.0, 68.0], [10.0, 40.0]]
+    inside = np.all((gals.pos >= np.array(region_bounds)[:, 0]) &
+                    (gals.pos <= np.array(region_bounds)[:, 1]), axis=1)
+
+    mass, N = galaxy.mass_within_region(gals, region_bounds)
+    assert(N == np.count_nonzero(inside))
+    assert(np.isclose(mass, gals.mass[inside].sum()))
+    assert(galaxy.mass_within_region(gals, *region_bounds) == (mass, N))
+
+    index_mass, index_N = galaxy.mass_within_region(galaxy.GalaxyIndex(gals),
+                                                    region_bounds)
+    assert(index_N == N and np.isclose(index_mass, mass))
+
+    masses, counts = galaxy.mass_within_regions(gals, [region_bounds], workers=2)
+    assert((masses[0], counts[0]) == (mass, N))
+
+    # Bounds must cover every spatial dimension.
+    with pytest.raises(ValueError):
+        galaxy.mass_within_region(gals, [0, 50.0], [23.0, 68.0])
+
+    fname = str(tmp_path / "gals.{0}".format(fmt))
+    galaxy.generate_random_data(N=2000, seed=777, fname_out=fname, fmt=fmt, ndim=3)
+
+    read_gals = galaxy.read_data(fname)
+    assert(read_gals.ndim == 3)
+    assert(np.array_equal(read_gals.pos, gals.pos))
+    assert(np.array_equal(read_gals.mass, gals.mass))
+    assert(galaxy.mass_within_region(galaxy.read_data_chunks(fname, chunk_size=300),
+                                     region_bounds) == (mass, N))
+
+
+@pytest.mark.parametrize("scheme", ["ngp", "cic", "tsc"])
+def test_assign_mass(tmp_path, monkeypatch, scheme):
+    """
+    Mass assignment should conserve the total mass, agree with a histogram for NGP, give
+    the same grid when the catalog is deposited in chunks, and write grids that the
+    downsampler can read and downsample.
+    """
+
+    import numpy as np
+    from example_scripts import downsampler
+
+    # Use small blocks so the galaxies are deposited over several of them.
+    monkeypatch.setattr(galaxy, "_ASSIGN_BLOCK", 100)
+
+    gals = galaxy.generate_random_data(N=1000, seed=777, ndim=3)
+    grid = galaxy.assign_mass(gals, 8, scheme=scheme)
+
+    assert(grid.shape == (8, 8, 8))
+    assert(np.isclose(grid.sum(), gals.mass.sum()))
+
+    if scheme == "ngp":
+        expected, _ = np.histogramdd(gals.pos, bins=8, range=[(0, 100.0)] * 3,
+                                     weights=gals.mass)
+        assert(np.allclose(grid, expected))
+
+    chunks = [gals[start:start + 300] for start in range(0, len(gals), 300)]
+    assert(np.allclose(galaxy.assign_mass(chunks, 8, scheme=scheme), grid))
+
+    fname = str(tmp_path / "grid.bin")
+    galaxy.assign_mass(gals, 8, scheme=scheme, fname_out=fname)
+    read_grid = downsampler.read_grid(fname, 8, "double")
+    assert(np.array_equal(read_grid, grid))
+    assert(np.allclose(downsampler.downsample_grid(read_grid, 4, kernel="sum"),
+                       grid.reshape(4, 2, 4, 2, 4, 2).sum(axis=(1, 3, 5))))
+
+
+def test_assign_mass_block_cost():
+    """
+    Depositing a block of galaxies should only work on the cells it touches, so the
+    temporary arrays don't grow with the size of the grid.
+    """
+
+    import numpy as np
+
+    gals = galaxy.generate_random_data(N=100, seed=777, ndim=3)
+
+    # A huge grid is never allocated; each galaxy touches at most 3^3 cells.
+    for gridsize in (1024, 8):
+        shape = (gridsize,) * 3
+        touched, touched_mass = galaxy._block_deposit(shape, gals._pos, gals.mass,
+                                                      gals.boxsize, "tsc")
+
+        assert(len(touched) == len(touched_mass) <= 100 * 3**3)
+        assert(np.all(np.diff(touched) > 0))
+        assert(np.isclose(touched_mass.sum(), gals.mass.sum()))
+
+    # Placing the touched cells onto the grid gives the full deposit.
+    grid = np.zeros(8**3)
+    grid[touched] = touched_mass
+    assert(np.allclose(grid.reshape(8, 8, 8), galaxy.assign_mass(gals, 8, scheme="tsc")))
+
+
+def test_assign_mass_weights():
+    """
+    Check the weights of a single galaxy for each scheme, including wrapping around the
+    periodic box.
+    """
+
+    import numpy as np
+
+    # Cell width 1; the galaxy sits a quarter of a cell left of the centre of cell 0.
+    gals = galaxy.GalaxyCatalog.from_positions([[0.25]], [1.0], boxsize=4.0)
+
+    assert(np.allclose(galaxy.assign_mass(gals, 4, scheme="ngp"), [1, 0, 0, 0]))
+    assert(np.allclose(galaxy.assign_mass(gals, 4, scheme="cic"), [0.75, 0, 0, 0.25]))
+    assert(np.allclose(galaxy.assign_mass(gals, 4, scheme="tsc"),
+                       [0.6875, 0.03125, 0, 0.28125]))
+
+    gals = galaxy.GalaxyCatalog.from_positions([[0.25, 1.0]], [2.0], boxsize=4.0)
+    assert(np.allclose(galaxy.assign_mass(gals, (4, 2), scheme="cic"),
+                       [[1.5, 0], [0, 0], [0, 0], [0.5, 0]]))
+
+    with pytest.raises(ValueError):
+        galaxy.assign_mass(gals, 4, scheme="pcs")
+
+
+@pytest.mark.parametrize("ndim", [2, 3])
+def test_periodic_regions(ndim):
+    """
+    Periodic regions wrap around the box. Compare against rolling the galaxies so the
+    region no longer wraps, for the scan, the index and the batched queries.
+    """
+
+    import numpy as np
+
+    gals = galaxy.generate_random_data(N=3000, seed=777, ndim=ndim)
+
+    # Wraps around x, and given as an inverted bound along y.
+    region_bounds = [[90.0, 115.0], [80.0, 20.0]] + [[10.0, 60.0]] * (ndim - 2)
+
+    shifted = np.mod(gals.pos + np.array([10.0, 20.0] + [0.0] * (ndim - 2)), 100.0)
+    inside = np.all((shifted >= [0.0, 0.0] + [10.0] * (ndim - 2)) &
+                    (shifted <= [25.0, 40.0] + [60.0] * (ndim - 2)), axis=1)
+
+    mass, N = galaxy.mass_within_region(gals, region_bounds, periodic=True)
+    assert(N == np.count_nonzero(inside))
+    assert(np.isclose(mass, gals.mass[inside].sum()))
+
+    index = galaxy.GalaxyIndex(gals)
+    index_mass, index_N = galaxy.mass_within_region(index, region_bounds, periodic=True)
+    assert(index_N == N and np.isclose(index_mass, mass))
+
+    batch = [region_bounds, [[-50.0, 250.0]] * ndim]
+    masses, counts = galaxy.mass_within_regions(gals, batch, periodic=True)
+    assert((masses[0], counts[0]) == (mass, N))
+    assert(counts[1] == len(gals))
+
+    index_masses, index_counts = galaxy.mass_within_regions(index, batch, periodic=True)
+    assert(np.array_equal(index_counts, counts) and np.allclose(index_masses, masses))
+
+    # Periodic queries need to know the size of the box.
+    with pytest.raises(ValueError):
+        galaxy.mass_within_region(list(gals[:10]), region_bounds, periodic=True)
+
+
+@pytest.mark.parametrize("periodic", [False, True])
+def test_apertures(periodic):
+    """
+    Aperture queries through the scan, the index and the batched scan should all match a
+    brute force calculation of the distances.
+    """
+
+    import numpy as np
+
+    gals = galaxy.generate_random_data(N=5000, seed=777, ndim=3)
+    index = galaxy.GalaxyIndex(gals)
+
+    rng = np.random.default_rng(12)
+    centres = rng.uniform(0.0, 100.0, size=(50, 3))
+    centres[0] = [1.0, 99.0, 50.0]
+    radii = rng.uniform(0.0, 20.0, size=50)
+
+    offsets = gals.pos[np.newaxis, :, :] - centres[:, np.newaxis, :]
+    if periodic:
+        offsets -= 100.0 * np.rint(offsets / 100.0)
+    inside = np.sum(offsets**2, axis=2) <= radii[:, np.newaxis]**2
+
+    masses, counts = galaxy.mass_within_apertures(gals, centres, radii, periodic=periodic)
+    assert(np.array_equal(counts, np.count_nonzero(inside, axis=1)))
+    assert(np.allclose(masses, inside.dot(gals.mass)))
+
+    index_masses, index_counts = galaxy.mass_within_apertures(index, centres, radii,
+                                                              periodic=periodic)
+    assert(np.array_equal(index_counts, counts) and np.allclose(index_masses, masses))
+
+    for num in range(3):
+        assert(galaxy.mass_within_aperture(gals, centres[num], radii[num],
+                                           periodic=periodic) ==
+               (masses[num], counts[num]))
+        assert(galaxy.mass_within_aperture(gals, centres[num], radii[num], workers=2,
+                                           periodic=periodic) ==
+               (masses[num], counts[num]))
+
+    if periodic:
+        # The aperture would overlap its own periodic image.
+        with pytest.raises(ValueError):
+            galaxy.mass_within_aperture(index, [50.0] * 3, 50.0, periodic=True)
+
+
+@pytest.mark.parametrize("ndim, periodic", [(2, False), (3, False), (3, True)])
+def test_pair_counts(ndim, periodic):
+    """
+    The cell list pair counts should match counting every pair by brute force, however the
+    galaxies are split between workers or binned into cells.
+    """
+
+    import numpy as np
+
+    gals = galaxy.generate_random_data(N=800, seed=777, ndim=ndim)
+    bins = [0.0, 2.0, 5.0, 10.0, 20.0]
+
+    separations = gals.pos[:, np.newaxis, :] - gals.pos[np.newaxis, :, :]
+    if periodic:
+        separations -= 100.0 * np.rint(separations / 100.0)
+    distances = np.sqrt(np.sum(separations**2, axis=2))
+    first, second = np.triu_indices(len(gals), k=1)
+    expected, _ = np.histogram(distances[first, second], bins=bins)
+    expected_mass, _ = np.histogram(distances[first, second], bins=bins,
+                                    weights=gals.mass[first] * gals.mass[second])
+
+    counts = galaxy.pair_counts(gals, bins, periodic=periodic)
+    assert(np.array_equal(counts, expected))
+    assert(np.allclose(galaxy.pair_counts(gals, bins, periodic=periodic,
+                                          mass_weighted=True), expected_mass))
+
+    assert(np.array_equal(galaxy.pair_counts(gals, bins, periodic=periodic, workers=2),
+                          expected))
+
+    # An index with cells much smaller than the largest separation searches further.
+    index = galaxy.GalaxyIndex(gals, cells_per_dim=12)
+    assert(np.array_equal(galaxy.pair_counts(index, bins, periodic=periodic), expected))
+
+
+@pytest.mark.parametrize("periodic", [False, True])
+def test_mass_profiles(periodic):
+    """
+    Mass profiles should match binning the distances to every galaxy, and the cumulative
+    profile should match the aperture queries.
+    """
+
+    import numpy as np
+
+    gals = galaxy.generate_random_data(N=2000, seed=777, ndim=3)
+    centres = np.random.default_rng(12).uniform(0.0, 100.0, size=(40, 3))
+    centres[0] = [1.0, 99.0, 50.0]
+    bins = [0.0, 5.0, 10.0, 15.0]
+
+    masses, counts = galaxy.mass_profiles(gals, centres, bins, periodic=periodic)
+    assert(masses.shape == counts.shape == (40, 3))
+
+    separations = gals.pos[np.newaxis, :, :] - centres[:, np.newaxis, :]
+    if periodic:
+        separations -= 100.0 * np.rint(separations / 100.0)
+    distances = np.sqrt(np.sum(separations**2, axis=2))
+
+    for num in range(len(centres)):
+        expected, _ = np.histogram(distances[num], bins=bins)
+        expected_mass, _ = np.histogram(distances[num], bins=bins, weights=gals.mass)
+        assert(np.array_equal(counts[num], expected))
+        assert(np.allclose(masses[num], expected_mass))
+
+    cumulative_masses, cumulative_counts = galaxy.mass_profiles(gals, centres, bins,
+                                                                periodic=periodic,
+                                                                workers=2,
+                                                                cumulative=True)
+    aperture_masses, aperture_counts = galaxy.mass_within_apertures(gals, centres, 15.0,
+                                                                    periodic=periodic)
+    assert(np.array_equal(cumulative_counts[:, -1], aperture_counts))
+    assert(np.allclose(cumulative_masses[:, -1], aperture_masses))
+
+    with pytest.raises(ValueError):
+        galaxy.mass_profiles(gals, centres, [5.0, 1.0])
+
+
+def test_region_cache(tmp_path):
+    """
+    Repeated queries should be served from the cache until the catalog is modified,
+    reloaded or garbage collected, with the least recently used results evicted first.
+    """
+
+    import gc
+
+    fname = str(tmp_path / "gals.bin")
+    galaxy.generate_random_data(N=1000, seed=777, fname_out=fname, fmt="binary")
+    gals = galaxy.read_data(fname)
+
+    cache = galaxy.RegionCache(maxsize=2)
+    expected = galaxy.mass_within_region(gals, [0, 50.0], [23.0, 28.0])
+
+    assert(cache.mass_within_region(gals, [0, 50.0], [23.0, 28.0]) == expected)
+    assert(cache.mass_within_region(gals, [[0, 50.0], [23.0, 28.0]]) == expected)
+    assert(cache.cache_info() == (1, 1, 2, 1))
+
+    # Fill the cache, touch the first region and check the aperture was evicted.
+    cache.mass_within_aperture(gals, [50.0, 50.0], 10.0)
+    cache.mass_within_region(gals, [0, 50.0], [23.0, 28.0])
+    cache.mass_within_region(gals, [0, 10.0], [0, 10.0])
+    assert(cache.cache_info() == (2, 3, 2, 2))
+    cache.mass_within_region(gals, [0, 50.0], [23.0, 28.0])
+    cache.mass_within_aperture(gals, [50.0, 50.0], 10.0)
+    assert(cache.cache_info() == (3, 4, 2, 2))
+
+    # Reloading the file gives a catalog with a new fingerprint.
+    gals = galaxy.read_data(fname)
+    assert(cache.mass_within_region(gals, [0, 50.0], [23.0, 28.0]) == expected)
+    assert(cache.misses == 5)
+
+    # The results of the old catalog are dropped once it's gone.
+    gc.collect()
+    assert(len(cache) == 1)
+
+    # Memory mapped columns can't be modified.
+    with pytest.raises(ValueError):
+        with gals.modify():
+            pass
+
+    gals = galaxy.GalaxyCatalog.from_positions(gals.pos, gals.mass)
+    cache.mass_within_region(gals, [0, 50.0], [23.0, 28.0])
+    with gals.modify():
+        gals.mass[:] = 1.0
+    assert(cache.mass_within_region(gals, [0, 50.0], [23.0, 28.0]) == (expected[1],
+                                                                       expected[1]))
+    assert(cache.misses == 7)
+
+    index = galaxy.GalaxyIndex(gals)
+    cache.mass_within_region(index, [0, 50.0], [23.0, 28.0])
+    cache.mass_within_region(index, [0, 50.0], [23.0, 28.0])
+    assert(cache.hits == 4)
+
+
+def test_region_cache_in_place_edits():
+    """
+    Columns can't be changed behind the cache's back. Edits made through ``modify``, by
+    assigning a new mass column or through a slice sharing the catalog's memory all
+    invalidate the cached results.
+    """
+
+    import numpy as np
+
+    gals = galaxy.generate_random_data(N=1000, seed=777)
+    cache = galaxy.RegionCache()
+    region = ([0, 50.0], [23.0, 28.0])
+
+    mass, N = cache.mass_within_region(gals, *region)
+    assert(N == 29)
+
+    with pytest.raises(ValueError):
+        gals.mass[:] = 0.0
+    with pytest.raises(ValueError):
+        gals.x[0] = 0.0
+
+    with gals.modify():
+        gals.mass[:] = 0.0
+    assert(cache.mass_within_region(gals, *region) == (0.0, 29))
+
+    gals.mass = np.ones(len(gals))
+    assert(cache.mass_within_region(gals, *region) == (29.0, 29))
+
+    first_half = gals[:500]
+    with first_half.modify():
+        first_half.mass[:] = 2.0
+    assert(cache.mass_within_region(gals, *region) ==
+           galaxy.mass_within_region(gals, *region))
+    assert(cache.hits == 0)